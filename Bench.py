@@ -0,0 +1,812 @@
+# Offline load test: drives the handlers of main.py with synthetic or recorded updates against an
+# in-process stub of the Bot API and an in-memory stand-in of the database.
+#
+#   python Bench.py funnel --users 2000 --concurrency 200
+#   python Bench.py buyers --buyers 50 --stock 10
+#   python Bench.py payments --users 200
+#   python Bench.py referrals --users 2000 --referrers 20
+#   python Bench.py states --chats 1000 --ttl 1
+#   python Bench.py tickets --users 500
+#   python Bench.py replay updates.jsonl
+#
+# Libraries
+import os
+import re
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import datetime
+import tempfile
+import itertools
+import threading
+import contextlib
+import collections
+from aiohttp import web
+
+# The bot reads its settings when imported: no real limits, no metrics port, logs out of the repo
+os.environ.setdefault('API_KEY', '1:bench')
+os.environ.setdefault('VIPS_ID', '1')
+os.environ.setdefault('MAHSA_ID', '2')
+os.environ.setdefault('ADMIN_ID', '3')
+os.environ.setdefault('SUPPORT_IDS', '4,5')
+os.environ.setdefault('SEND_RATE', '1000000')
+os.environ.setdefault('SEND_CHAT_RATE', '1000000')
+os.environ.setdefault('SEND_CHAT_BURST', '1000000')
+os.environ.setdefault('METRICS_PORT', '0')
+os.environ.setdefault('METRICS_LOG_INTERVAL', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+os.environ.setdefault('LOG_FILE', os.path.join(tempfile.gettempdir(), 'mochi-bench.log'))
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+# Payments go to the local fake gateway and come back to a local callback endpoint
+GATEWAY_PORT = free_port()
+os.environ.setdefault('PAYMENT_PORT', str(free_port()))
+os.environ.setdefault('PAYMENT_HOST', '127.0.0.1')
+os.environ.setdefault('PAYMENT_MERCHANT_ID', 'bench')
+os.environ.setdefault('PAYMENT_GATEWAY_URL', f'http://127.0.0.1:{GATEWAY_PORT}')
+os.environ.setdefault('PAYMENT_CALLBACK_URL', f"http://127.0.0.1:{os.environ['PAYMENT_PORT']}/payment")
+
+import aiohttp
+import telebot
+import mysql.connector
+from telebot import asyncio_filters
+
+# Files
+import main
+import Log
+import Metrics
+import Outbox
+import Webhook
+import Products
+import Payments
+import States
+import Config as Keys
+import Database as Db
+
+
+# Bot API stub answering every call like Telegram would, after an optional network latency
+class FakeTelegram:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = collections.Counter()
+        self.texts = collections.Counter()     # (chat id, text) of every sendMessage
+        self._ids = itertools.count(1000)
+
+    async def process_request(self, token, url, method='get', params=None, files=None, **kwargs):
+        self.calls[url] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if url == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}
+        if url == 'copyMessage':
+            return {'message_id': next(self._ids)}
+        if url.startswith(('send', 'edit')):
+            chat_id = int(params.get('chat_id', 0))
+            if url == 'sendMessage':
+                self.texts[chat_id, params.get('text')] += 1
+            message = {'message_id': next(self._ids), 'date': 1, 'chat': {'id': chat_id, 'type': 'private'}, 'text': ''}
+            if url == 'sendPhoto':
+                message['photo'] = [{'file_id': 'photo', 'file_unique_id': 'photo', 'width': 1, 'height': 1}]
+            if url == 'sendVideo':
+                message['video'] = {'file_id': 'video', 'file_unique_id': 'video', 'width': 1, 'height': 1, 'duration': 1}
+            return message
+        return True
+
+
+# Payment gateway answering the zarinpal requests, payments are paid by calling pay(authority)
+class FakeGateway:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.payments = {}      # authority -> {'amount', 'paid', 'verified'}
+        self.calls = collections.Counter()
+        self._ids = itertools.count(1)
+
+    async def request(self, http):
+        self.calls['request'] += 1
+        body = await http.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        authority = f"A{next(self._ids):035d}"
+        self.payments[authority] = {'amount': body['amount'], 'paid': False, 'verified': False}
+        return web.json_response({'data': {'code': 100, 'message': 'Success', 'authority': authority}, 'errors': []})
+
+    async def verify(self, http):
+        self.calls['verify'] += 1
+        body = await http.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        payment = self.payments.get(body['authority'])
+        if payment is None or not payment['paid'] or payment['amount'] != body['amount']:
+            return web.json_response({'data': [], 'errors': {'code': -51, 'message': 'Session is not paid'}})
+        code = 101 if payment['verified'] else 100
+        payment['verified'] = True
+        return web.json_response({'data': {'code': code, 'message': 'Verified', 'ref_id': int(body['authority'][1:])}, 'errors': []})
+
+    def pay(self, authority):
+        self.payments[authority]['paid'] = True
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post(Payments.REQUEST_PATH, self.request)
+        app.router.add_post(Payments.VERIFY_PATH, self.verify)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        return runner
+
+
+# In-memory stand-in of the MySQL tables, knows the statements the bot runs.
+# Every statement holds one lock like a row lock would, after an optional round trip latency.
+class FakeDatabase:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.users = {}         # id -> [id, username, first_name, last_name, balance, test_config_used]
+        self.orders = []
+        self.tickets = {}       # id -> [id, user_id, agent_id, status]
+        self.configs = []       # [id, product, config, user_id, order_id, locked]
+        self.payments = []      # [id, user_id, amount, product, authority, status, ref_id, order_id]
+        self.ledger = []        # (id, user_id, kind, amount, balance, order_id, note, created_at)
+        self.referrals = {}     # user_id -> referrer_id
+        self.referral_stats = {}    # referrer_id -> [referrals, rewarded]
+        self.statements = 0
+        self.unknown = collections.Counter()
+
+        self.handlers = {}
+        for sql, handler in (
+            ("SELECT id, username, first_name, last_name, balance, test_config_used FROM users WHERE id = %s", self._user),
+            ("INSERT INTO users (id, username, first_name, last_name, balance) VALUES (%s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE id = id", self._insert_user),
+            ("UPDATE users SET balance = balance - %s WHERE id = %s AND balance >= %s", self._debit),
+            ("UPDATE users SET test_config_used = TRUE WHERE id = %s AND test_config_used = FALSE", self._test_used),
+            ("INSERT INTO orders (user_id, product, price, status) VALUES (%s, %s, %s, %s)", self._insert_order),
+            ("SELECT id, config FROM configs WHERE product = %s AND user_id IS NULL ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED", self._free_config),
+            ("UPDATE configs SET user_id = %s, order_id = %s, claimed_at = CURRENT_TIMESTAMP WHERE id = %s", self._assign_config),
+            ("INSERT INTO configs (product, config) VALUES (%s, %s)", self._insert_config),
+            ("SELECT COUNT(*) FROM (SELECT id FROM configs WHERE product = %s AND user_id IS NULL LIMIT %s) AS free", self._free_configs),
+            ("SELECT product, COUNT(*) FROM configs WHERE user_id IS NULL GROUP BY product", self._config_stock),
+            ("INSERT INTO payments (user_id, amount, product, authority) VALUES (%s, %s, %s, %s)", self._insert_payment),
+            ("SELECT id, user_id, amount, product, status FROM payments WHERE authority = %s", self._payment),
+            ("UPDATE payments SET status = 'paid', ref_id = %s, paid_at = CURRENT_TIMESTAMP WHERE id = %s AND status = 'pending'", self._pay),
+            ("SELECT user_id, amount, product FROM payments WHERE id = %s", self._payment_of),
+            ("UPDATE users SET balance = balance + %s WHERE id = %s", self._credit),
+            ("SELECT balance FROM users WHERE id = %s FOR UPDATE", self._balance),
+            ("INSERT IGNORE INTO referrals (user_id, referrer_id) VALUES (%s, %s)", self._insert_referral),
+            ("INSERT INTO referral_stats (referrer_id, referrals, rewarded) VALUES (%s, 1, %s) "
+             "ON DUPLICATE KEY UPDATE referrals = referrals + 1, rewarded = rewarded + VALUES(rewarded)", self._count_referral),
+            ("SELECT referrals, rewarded FROM referral_stats WHERE referrer_id = %s", self._referral_stats),
+            ("SELECT s.referrer_id, u.first_name, s.referrals, s.rewarded FROM referral_stats s LEFT JOIN users u ON u.id = s.referrer_id "
+             "ORDER BY s.referrals DESC, s.referrer_id DESC LIMIT %s", self._top_referrers),
+            ("UPDATE users SET username = %s, first_name = %s, last_name = %s, balance = %s WHERE id = %s", self._update_user),
+            ("UPDATE payments SET order_id = %s WHERE id = %s", self._payment_order),
+            ("INSERT INTO ledger (user_id, kind, amount, balance, order_id, note) "
+             "SELECT id, %s, %s, balance, %s, %s FROM users WHERE id = %s", self._record),
+            ("INSERT INTO ledger (user_id, kind, amount, balance) SELECT id, 'bonus', balance, balance FROM users "
+             "WHERE id = %s AND NOT EXISTS (SELECT 1 FROM ledger WHERE user_id = %s)", self._record_bonus),
+            ("SELECT id, kind, amount, balance, note, created_at FROM ledger WHERE user_id = %s "
+             "ORDER BY created_at DESC, id DESC LIMIT %s", self._history),
+            ("SELECT id, kind, amount, balance, note, created_at FROM ledger WHERE user_id = %s "
+             "AND (created_at < %s OR (created_at = %s AND id < %s)) ORDER BY created_at DESC, id DESC LIMIT %s", self._history_before),
+            ("SELECT id, first_name FROM users WHERE id > %s ORDER BY id LIMIT %s", self._users_after),
+            ("SELECT agent_id, COUNT(*) FROM tickets WHERE status IN ('open', 'answering') GROUP BY agent_id", self._ticket_load),
+            ("INSERT INTO tickets (user_id, agent_id, kind, order_id) VALUES (%s, %s, %s, %s)", self._insert_ticket),
+            ("SELECT id, user_id, agent_id, status FROM tickets WHERE id = %s", self._ticket),
+            ("UPDATE tickets SET status = 'answering', agent_id = %s WHERE id = %s AND status != 'closed'", self._take_ticket),
+            ("UPDATE tickets SET status = 'closed', closed_at = CURRENT_TIMESTAMP WHERE id = %s AND status != 'closed'", self._close_ticket),
+            ("SELECT agent_id, status, COUNT(*) FROM tickets WHERE status IN ('open', 'answering') GROUP BY agent_id, status", self._ticket_stats),
+            ("SELECT id, first_name FROM users WHERE id < %s ORDER BY id DESC LIMIT %s", self._users_before),
+            ("""(SELECT id, first_name FROM users WHERE id = %s)
+             UNION (SELECT id, first_name FROM users WHERE username LIKE %s ORDER BY username LIMIT %s)
+             UNION (SELECT id, first_name FROM users WHERE first_name LIKE %s ORDER BY first_name LIMIT %s)
+             UNION (SELECT id, first_name FROM users WHERE last_name LIKE %s ORDER BY last_name LIMIT %s)
+             ORDER BY id LIMIT %s""", self._search_users),
+        ):
+            self.handlers[self._normalize(sql)] = handler
+
+    @staticmethod
+    def _normalize(sql):
+        return re.sub(r'\s+', ' ', sql).strip()
+
+    def add_user(self, user_id, balance=0):
+        self.users[user_id] = [user_id, f'user{user_id}', 'bench', None, balance, False]
+        if balance:
+            self._record(None, 'opening', balance, None, None, user_id)
+
+    # Every user's ledger adds up to the balance and its last entry left that balance
+    def audit(self):
+        totals, last = collections.Counter(), {}
+        for entry in self.ledger:
+            totals[entry[1]] += entry[3]
+            last[entry[1]] = entry[4]
+        return all(totals[user[0]] == user[4] == last.get(user[0], 0) for user in self.users.values())
+
+    def add_configs(self, product, count):
+        for _ in range(count):
+            self._insert_config(None, product, f'vless://bench-{len(self.configs) + 1}')
+
+    def execute(self, cursor, sql, params):
+        if self.latency:
+            time.sleep(self.latency)
+        handler = self.handlers.get(self._normalize(sql))
+        with self.lock:
+            self.statements += 1
+            if handler is None:
+                self.unknown[self._normalize(sql)[:80]] += 1
+                return
+            handler(cursor, *params)
+
+    def _user(self, cursor, user_id):
+        user = self.users.get(user_id)
+        cursor.rows = [tuple(user)] if user else []
+
+    def _insert_user(self, cursor, user_id, username, first_name, last_name, balance):
+        if user_id not in self.users:
+            self.users[user_id] = [user_id, username, first_name, last_name, balance, False]
+            cursor.rowcount = 1
+
+    def _debit(self, cursor, price, user_id, minimum):
+        user = self.users.get(user_id)
+        if user and user[4] >= minimum:
+            user[4] -= price
+            cursor.rowcount = 1
+
+    def _test_used(self, cursor, user_id):
+        if user_id in self.users and not self.users[user_id][5]:
+            self.users[user_id][5] = True
+            cursor.rowcount = 1
+
+    def _insert_order(self, cursor, user_id, product, price, status):
+        self.orders.append((user_id, product, price, status))
+        cursor.rowcount, cursor.lastrowid = 1, len(self.orders)
+
+    # The selected row stays locked until it is assigned, other claims skip it
+    def _free_config(self, cursor, product):
+        for config in self.configs:
+            if config[1] == product and config[3] is None and not config[5]:
+                config[5] = True
+                cursor.rows = [(config[0], config[2])]
+                return
+
+    def _assign_config(self, cursor, user_id, order_id, config_id):
+        config = self.configs[config_id - 1]
+        config[3], config[4] = user_id, order_id
+        cursor.rowcount = 1
+
+    def _insert_config(self, cursor, product, config):
+        self.configs.append([len(self.configs) + 1, product, config, None, None, False])
+        if cursor is not None:
+            cursor.rowcount, cursor.lastrowid = 1, len(self.configs)
+
+    def _free_configs(self, cursor, product, limit):
+        cursor.rows = [(min(limit, sum(1 for config in self.configs if config[1] == product and config[3] is None)),)]
+
+    def _config_stock(self, cursor):
+        cursor.rows = list(collections.Counter(config[1] for config in self.configs if config[3] is None).items())
+
+    def _insert_payment(self, cursor, user_id, amount, product, authority):
+        if any(payment[4] == authority for payment in self.payments):
+            raise mysql.connector.IntegrityError(msg=f"Duplicate entry '{authority}' for key 'payments_authority'")
+        self.payments.append([len(self.payments) + 1, user_id, amount, product, authority, 'pending', None, None])
+        cursor.rowcount, cursor.lastrowid = 1, len(self.payments)
+
+    def _payment(self, cursor, authority):
+        cursor.rows = [tuple(payment[:4]) + (payment[5],) for payment in self.payments if payment[4] == authority]
+
+    def _pay(self, cursor, ref_id, payment_id):
+        payment = self.payments[payment_id - 1]
+        if payment[5] == 'pending':
+            payment[5], payment[6] = 'paid', ref_id
+            cursor.rowcount = 1
+
+    def _payment_of(self, cursor, payment_id):
+        cursor.rows = [tuple(self.payments[payment_id - 1][1:4])]
+
+    def _credit(self, cursor, amount, user_id):
+        if user_id in self.users:
+            self.users[user_id][4] += amount
+            cursor.rowcount = 1
+
+    def _balance(self, cursor, user_id):
+        user = self.users.get(user_id)
+        cursor.rows = [(user[4],)] if user else []
+
+    def _update_user(self, cursor, username, first_name, last_name, balance, user_id):
+        if user_id in self.users:
+            self.users[user_id][1:5] = [username, first_name, last_name, balance]
+            cursor.rowcount = 1
+
+    def _insert_referral(self, cursor, user_id, referrer_id):
+        if user_id not in self.referrals:
+            self.referrals[user_id] = referrer_id
+            cursor.rowcount = 1
+
+    def _count_referral(self, cursor, referrer_id, reward):
+        stats = self.referral_stats.setdefault(referrer_id, [0, 0])
+        stats[0] += 1
+        stats[1] += reward
+        cursor.rowcount = 1
+
+    def _referral_stats(self, cursor, referrer_id):
+        stats = self.referral_stats.get(referrer_id)
+        cursor.rows = [tuple(stats)] if stats else []
+
+    def _top_referrers(self, cursor, limit):
+        ranked = sorted(self.referral_stats.items(), key=lambda item: (item[1][0], item[0]), reverse=True)[:limit]
+        cursor.rows = [(referrer_id, self.users.get(referrer_id, [None] * 3)[2], referrals, rewarded) for referrer_id, (referrals, rewarded) in ranked]
+
+    def _payment_order(self, cursor, order_id, payment_id):
+        self.payments[payment_id - 1][7] = order_id
+        cursor.rowcount = 1
+
+    def _record(self, cursor, kind, amount, order_id, note, user_id):
+        user = self.users.get(user_id)
+        if user is not None:
+            self.ledger.append((len(self.ledger) + 1, user_id, kind, amount, user[4], order_id, note, datetime.datetime.now().replace(microsecond=0)))
+            if cursor is not None:
+                cursor.rowcount = 1
+
+    def _record_bonus(self, cursor, user_id, _):
+        if not any(entry[1] == user_id for entry in self.ledger):
+            self._record(cursor, 'bonus', self.users[user_id][4], None, None, user_id)
+
+    def _history(self, cursor, user_id, limit):
+        self._history_before(cursor, user_id, datetime.datetime.max, datetime.datetime.max, float('inf'), limit)
+
+    def _history_before(self, cursor, user_id, created_at, _, entry_id, limit):
+        entries = [entry for entry in self.ledger if entry[1] == user_id and (entry[7], entry[0]) < (created_at, entry_id)]
+        cursor.rows = [(entry[0], entry[2], entry[3], entry[4], entry[6], entry[7]) for entry in reversed(entries)][:limit]
+
+    def _users_after(self, cursor, after_id, limit):
+        cursor.rows = [(user[0], user[2]) for user in sorted(self.users.values()) if user[0] > after_id][:limit]
+
+    def _users_before(self, cursor, before_id, limit):
+        cursor.rows = [(user[0], user[2]) for user in sorted(self.users.values(), reverse=True) if user[0] < before_id][:limit]
+
+    # LIKE 'prefix%' with the escaping of Database._prefix_pattern, case insensitive like the default collation
+    def _search_users(self, cursor, user_id, pattern, limit, *_):
+        prefix = re.sub(r'\\(.)', r'\1', pattern[:-1]).lower()
+        found = {user[0]: (user[0], user[2]) for user in self.users.values() if user[0] == user_id}
+        for column in (1, 2, 3):
+            matches = sorted((user for user in self.users.values() if user[column] and user[column].lower().startswith(prefix)),
+                             key=lambda user: user[column])[:limit]
+            found.update((user[0], (user[0], user[2])) for user in matches)
+        cursor.rows = [found[key] for key in sorted(found)][:limit]
+
+    def _ticket(self, cursor, ticket_id):
+        ticket = self.tickets.get(ticket_id)
+        cursor.rows = [tuple(ticket)] if ticket else []
+
+    def _take_ticket(self, cursor, agent_id, ticket_id):
+        ticket = self.tickets.get(ticket_id)
+        if ticket and ticket[3] != 'closed':
+            ticket[2], ticket[3] = agent_id, 'answering'
+            cursor.rowcount = 1
+
+    def _close_ticket(self, cursor, ticket_id):
+        ticket = self.tickets.get(ticket_id)
+        if ticket and ticket[3] != 'closed':
+            ticket[3] = 'closed'
+            cursor.rowcount = 1
+
+    def _ticket_stats(self, cursor):
+        counts = collections.Counter((ticket[2], ticket[3]) for ticket in self.tickets.values() if ticket[3] != 'closed')
+        cursor.rows = [(agent_id, status, count) for (agent_id, status), count in counts.items()]
+
+    def _ticket_load(self, cursor):
+        cursor.rows = list(collections.Counter(ticket[2] for ticket in self.tickets.values() if ticket[3] != 'closed').items())
+
+    def _insert_ticket(self, cursor, user_id, agent_id, kind, order_id):
+        ticket_id = len(self.tickets) + 1
+        self.tickets[ticket_id] = [ticket_id, user_id, agent_id, 'open']
+        cursor.rowcount, cursor.lastrowid = 1, ticket_id
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.rows = []
+        self.rowcount = 0
+        self.lastrowid = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=()):
+        self.rows, self.rowcount = [], 0
+        self.db.execute(self, sql, params)
+
+    def executemany(self, sql, rows):
+        total = 0
+        for params in rows:
+            self.execute(sql, params)
+            total += self.rowcount
+        self.rowcount = total
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self):
+        return FakeCursor(self.db)
+
+    def start_transaction(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+# Replaces Database.ConnectionPool
+class FakePool:
+    def __init__(self, db):
+        self.db = db
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield FakeConnection(self.db)
+
+    def stats(self):
+        return {'checkouts': self.db.statements, 'waits': 0, 'timeouts': 0, 'failures': 0, 'reconnects': 0,
+                'size': 0, 'opened': 0, 'in_use': 0, 'idle': 0}
+
+
+# Wire the bot to the stubs, the same way main does it in production
+def prepare(telegram, db):
+    Outbox.outbox._send = telegram.process_request
+    Db._pool = FakePool(db)
+    main.bot.add_custom_filter(asyncio_filters.StateFilter(main.bot))
+    Metrics.track(main.bot)
+    Log.trace(main.bot)
+
+
+_update_ids = itertools.count(1)
+
+
+def message(user_id, text):
+    update = {'update_id': next(_update_ids), 'message': {
+        'message_id': next(_update_ids), 'date': 1, 'text': text,
+        'chat': {'id': user_id, 'type': 'private', 'first_name': 'bench', 'username': f'user{user_id}'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench', 'username': f'user{user_id}'}}}
+    if text.startswith('/'):
+        update['message']['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return update
+
+
+def callback(user_id, data):
+    return {'update_id': next(_update_ids), 'callback_query': {
+        'id': str(next(_update_ids)), 'chat_instance': 'bench', 'data': data,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench', 'username': f'user{user_id}'},
+        'message': {'message_id': next(_update_ids), 'date': 1, 'text': 'menu', 'chat': {'id': user_id, 'type': 'private'}}}}
+
+
+def funnel(user_id):
+    return [message(user_id, '/start'), callback(user_id, 'start_buy'), callback(user_id, 'buy_NL'),
+            callback(user_id, 'NL_alone'), callback(user_id, 'NL_alone_ircell'), callback(user_id, 'wallet_NL_alone_ircell')]
+
+
+# Handle the updates of every chat in order, at most `concurrency` chats at a time
+async def drive(chats, concurrency):
+    latencies = []
+    limit = asyncio.Semaphore(concurrency)
+
+    async def chat(updates):
+        async with limit:
+            for update in updates:
+                start = time.perf_counter()
+                await main.bot.process_new_updates([telebot.types.Update.de_json(update)])
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(chat(updates) for updates in chats))
+    return latencies, time.perf_counter() - start
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0
+
+
+def report(latencies, seconds, telegram, db):
+    queries = sum(entry[-1] for entry in Metrics.update_queries.values.values())
+    print(f"updates      {len(latencies)} in {seconds:.2f}s, {len(latencies) / seconds:.0f} updates/s")
+    print(f"latency      p50 {percentile(latencies, 0.5) * 1000:.1f}ms  p95 {percentile(latencies, 0.95) * 1000:.1f}ms  "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f}ms")
+    print(f"db           {queries / max(1, len(latencies)):.2f} calls/update, {db.statements} statements")
+    print(f"bot api      {sum(telegram.calls.values())} calls: {dict(telegram.calls.most_common(5))}")
+    print("handlers\n" + Metrics.summary())
+    for sql, count in db.unknown.items():
+        print(f"unknown statement x{count}: {sql}")
+
+
+async def run_funnel(args, telegram, db):
+    price = Products.PRODUCTS['NL_alone_ircell']['price']
+    users = range(10_000_000, 10_000_000 + args.users)
+    for user_id in users:
+        db.add_user(user_id, balance=price)
+    db.add_configs('NL_alone_ircell', args.users if args.configs is None else args.configs)
+
+    latencies, seconds = await drive([funnel(user_id) for user_id in users], args.concurrency)
+    report(latencies, seconds, telegram, db)
+    delivered = sum(1 for order in db.orders if order[3] == 'delivered')
+    print(f"orders       {len(db.orders)} of {args.users}, {delivered} delivered from the inventory")
+
+
+# Many purchases of one user at once: the wallet may never go negative or sell more than it can pay for,
+# and no config may be handed out twice
+async def run_buyers(args, telegram, db):
+    user_id = 20_000_000
+    price = Products.PRODUCTS['NL_alone_ircell']['price']
+    db.add_user(user_id, balance=price * args.stock)
+    db.add_configs('NL_alone_ircell', args.configs)
+
+    latencies, seconds = await drive([[callback(user_id, 'wallet_NL_alone_ircell')] for _ in range(args.buyers)], args.buyers)
+    report(latencies, seconds, telegram, db)
+
+    balance = db.users[user_id][4]
+    orders = {config[4] for config in db.configs if config[4] is not None}
+    claimed = sum(1 for config in db.configs if config[3] is not None)
+    delivered = sum(1 for order in db.orders if order[3] == 'delivered')
+    audit = db.audit()
+    ok = len(db.orders) == args.stock and balance == 0 and claimed == len(orders) == delivered == min(args.stock, args.configs) and audit
+    print(f"orders       {len(db.orders)} for a balance of {args.stock}, balance left {balance}, "
+          f"{delivered} delivered from {args.configs} configs, ledger {'adds up' if audit else 'does not add up'}: {'ok' if ok else 'FAILED'}")
+    return ok
+
+
+# Users top up and buy online: every callback arrives before the payment and then several times at once,
+# every paid payment must be credited or delivered exactly once and unpaid ones never
+async def run_payments(args, telegram, db):
+    gateway = FakeGateway(args.gateway_latency)
+    gateway_runner = await gateway.start(GATEWAY_PORT)
+    payments_runner = await main.start_payments()
+    try:
+        price = Products.PRODUCTS['NL_alone_ircell']['price']
+        amount = Products.TOP_UPS[0]['amount']
+        users = range(30_000_000, 30_000_000 + args.users)
+        for user_id in users:
+            db.add_user(user_id)
+        db.add_configs('NL_alone_ircell', args.users)
+
+        latencies, seconds = await drive([[callback(user_id, f"topup_{amount}"), callback(user_id, 'pay_NL_alone_ircell')] for user_id in users],
+                                         args.concurrency)
+        report(latencies, seconds, telegram, db)
+
+        # Every third user leaves without paying
+        paid = [payment for index, payment in enumerate(db.payments) if index % 3 != 2]
+        url = Keys.PAYMENT_CALLBACK_URL
+        async with aiohttp.ClientSession() as session:
+            async def hit(authority):
+                async with session.get(url, params={'Authority': authority, 'Status': 'OK'}) as response:
+                    await response.read()
+
+            await asyncio.gather(*(hit(payment[4]) for payment in db.payments))
+            for payment in paid:
+                gateway.pay(payment[4])
+
+            start = time.perf_counter()
+            await asyncio.gather(*(hit(payment[4]) for payment in db.payments for _ in range(args.duplicates)))
+            seconds = time.perf_counter() - start
+    finally:
+        await main.stop_payments(payments_runner)
+        await gateway_runner.cleanup()
+
+    callbacks = len(db.payments) * (1 + args.duplicates)
+    print(f"callbacks    {callbacks}, after payment {len(db.payments) * args.duplicates} in {seconds:.2f}s, "
+          f"results {dict((labels[0], count) for labels, count in Payments.callbacks.values.items())}")
+    print(f"gateway      {dict(gateway.calls)}")
+
+    top_ups = sum(1 for payment in paid if payment[3] is None)
+    purchases = len(paid) - top_ups
+    credited = sum(user[4] for user in db.users.values())
+    delivered = sum(1 for order in db.orders if order[3] == 'delivered')
+    completed = sum(1 for payment in db.payments if payment[5] == 'paid')
+    audit = db.audit()
+    ok = completed == len(paid) and credited == top_ups * amount and len(db.orders) == delivered == purchases \
+        and all(order[2] == price for order in db.orders) and audit
+    print(f"payments     {completed} completed of {len(paid)} paid, {credited} credited for {top_ups} top-ups, "
+          f"{delivered} orders delivered for {purchases} purchases, ledger {'adds up' if audit else 'does not add up'}: {'ok' if ok else 'FAILED'}")
+    return ok
+
+
+# New users arrive through the links of a few referrers, some open /start twice or with their own or a bogus id:
+# every new user is referred once, counters match the referrals and rewards and bonuses are in the ledger
+async def run_referrals(args, telegram, db):
+    referrers = range(40_000_000, 40_000_000 + args.referrers)
+    for referrer_id in referrers:
+        db.add_user(referrer_id)
+    users = range(41_000_000, 41_000_000 + args.users)
+
+    chats = []
+    for index, user_id in enumerate(users):
+        link = f"/start {referrers[index % len(referrers)]}"
+        if index % 10 == 9:
+            chats.append([message(user_id, f"/start {user_id}"), message(user_id, link)])
+        elif index % 10 == 8:
+            chats.append([message(user_id, "/start 123"), message(user_id, link)])
+        else:
+            chats.append([message(user_id, link), message(user_id, link)])
+
+    latencies, seconds = await drive(chats, args.concurrency)
+    await Db.registrations.flush()
+    report(latencies, seconds, telegram, db)
+
+    start = time.perf_counter()
+    for _ in range(100):
+        top = await Db.top_referrers(Keys.LEADERBOARD_SIZE)
+    print(f"leaderboard  {len(top)} referrers, 100 reads in {(time.perf_counter() - start) * 1000:.1f}ms, first {top[0][2] if top else 0} referrals")
+
+    # The first /start of users 8 and 9 of every ten was not a valid referral, they registered without one
+    referred = sum(1 for index in range(args.users) if index % 10 < 8)
+    counted = sum(stats[0] for stats in db.referral_stats.values())
+    rewarded = sum(stats[1] for stats in db.referral_stats.values())
+    audit = db.audit()
+    ok = len(db.referrals) == counted == referred and rewarded == referred * Keys.REFERRER_REWARD \
+        and sum(db.users[referrer_id][4] for referrer_id in referrers) == rewarded and audit
+    print(f"referrals    {len(db.referrals)} stored, {counted} counted for {referred} referred users, {rewarded} rewarded, "
+          f"ledger {'adds up' if audit else 'does not add up'}: {'ok' if ok else 'FAILED'}")
+    return ok
+
+
+# Users asking support (the test configs are out of stock) and every agent answering every ticket at once:
+# each ticket is taken, answered once and closed, and the agents that lost are told so. Then the admin searches
+# the users by username prefix and pages back through them
+async def run_tickets(args, telegram, db):
+    users = range(60_000_000, 60_000_000 + args.users)
+    for user_id in users:
+        db.add_user(user_id)
+
+    latencies, seconds = await drive([[callback(user_id, 'request_test')] for user_id in users], args.concurrency)
+    tickets = dict(db.tickets)
+    answers = [[update for ticket_id in tickets for update in (callback(agent_id, f"answer_{ticket_id}"), message(agent_id, f"config {ticket_id}"))]
+               for agent_id in Keys.SUPPORT_IDS]
+    answer_latencies, answer_seconds = await drive(answers, len(answers))
+    prefix = f"user{users[0] // 10}"
+    search = await drive([[message(Keys.ADMIN_ID[0], f"/find {prefix}")]], 1)
+    report(latencies + answer_latencies + search[0], seconds + answer_seconds + search[1], telegram, db)
+
+    closed = sum(1 for ticket in db.tickets.values() if ticket[3] == 'closed')
+    delivered = sum(telegram.texts[ticket[1], f"config {ticket_id}"] for ticket_id, ticket in tickets.items())
+    once = all(telegram.texts[ticket[1], f"config {ticket_id}"] == 1 for ticket_id, ticket in tickets.items())
+    lost = sum(telegram.texts[agent_id, f"Ticket #{ticket_id} was already answered."] for agent_id in Keys.SUPPORT_IDS for ticket_id in tickets)
+    found = [row[0] for row in await Db.search_users(prefix, Keys.ADMIN_PAGE_SIZE)]
+    expected = [user_id for user_id in users if str(user_id).startswith(prefix[4:])][:Keys.ADMIN_PAGE_SIZE]
+    before = [row[0] for row in await Db.users_before(users[-1] + 1, 5)]
+    ok = len(tickets) == args.users and closed == delivered == len(tickets) and once and found == expected \
+        and before == list(users[-5:]) and not db.unknown
+    print(f"tickets      {len(tickets)} opened, {closed} closed, {delivered} answers delivered, {lost} late answers refused, "
+          f"/find {prefix} {len(found)} users, {len(db.unknown)} unknown statements: {'ok' if ok else 'FAILED'}")
+    return ok
+
+
+# Conversation states of many chats through the persistent storage, on Redis (FakeRedis) and SQLite: a fresh storage
+# over the same backend, as after a restart, finds the states and data that were set and not the deleted ones,
+# and nothing is left once the TTL passed
+async def run_states(args, telegram, db):
+    chats = range(50_000_000, 50_000_000 + args.chats)
+
+    async def converse(storage, chat_id):
+        await storage.set_state(chat_id, chat_id, 'buy:edit')
+        await storage.set_data(chat_id, chat_id, 'edit_user_id', str(chat_id))
+        if chat_id % 4 == 0:
+            await storage.delete_state(chat_id, chat_id)
+
+    async def read(storage):
+        return [(await storage.get_state(chat_id, chat_id), await storage.get_data(chat_id, chat_id)) for chat_id in chats]
+
+    expected = [(None, {}) if chat_id % 4 == 0 else ('buy:edit', {'edit_user_id': str(chat_id)}) for chat_id in chats]
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        redis = States.FakeRedis()
+        path = os.path.join(directory, 'states.db')
+        for name, backend in (('redis', lambda: States.RedisBackend(redis)), ('sqlite', lambda: States.SQLiteBackend(path))):
+            storage = States.PersistentStateStorage(backend(), args.ttl, Keys.STATE_BATCH_SIZE, Keys.STATE_FLUSH_INTERVAL)
+            start = time.perf_counter()
+            await asyncio.gather(*(converse(storage, chat_id) for chat_id in chats))
+            await storage.flush()
+            seconds = time.perf_counter() - start
+
+            restarted = await read(States.PersistentStateStorage(backend(), args.ttl))
+            await asyncio.sleep(args.ttl + 0.5)
+            expired = sum(state is not None for state, _ in await read(States.PersistentStateStorage(backend(), args.ttl)))
+
+            kept = sum(state is not None for state, _ in restarted)
+            passed = restarted == expected and expired == 0
+            ok = ok and passed
+            print(f"states       {name}: {len(chats)} chats in {seconds:.2f}s, {kept} kept and {len(chats) - kept} deleted "
+                  f"after a restart, {expired} left after the ttl: {'ok' if passed else 'FAILED'}")
+    return ok
+
+
+# Recorded raw updates, one JSON object per line
+async def run_replay(args, telegram, db):
+    chats = collections.defaultdict(list)
+    with open(args.path, encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                update = json.loads(line)
+                chats[Webhook.chat_id_of(update)].append(update)
+
+    latencies, seconds = await drive(list(chats.values()), args.concurrency)
+    report(latencies, seconds, telegram, db)
+
+
+async def bench(args):
+    telegram = FakeTelegram(args.api_latency)
+    db = FakeDatabase(args.db_latency)
+    prepare(telegram, db)
+    try:
+        return await args.scenario(args, telegram, db)
+    finally:
+        await Db.registrations.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline load test of the bot handlers")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="seconds every Bot API call takes")
+    parser.add_argument('--db-latency', type=float, default=0.0, help="seconds every database statement takes")
+    commands = parser.add_subparsers(required=True)
+
+    command = commands.add_parser('funnel', help="users buying through start_buy -> buy_NL -> NL_alone -> NL_alone_ircell -> wallet")
+    command.add_argument('--users', type=int, default=1000)
+    command.add_argument('--concurrency', type=int, default=100)
+    command.add_argument('--configs', type=int, help="configs in the inventory, one per user by default")
+    command.set_defaults(scenario=run_funnel)
+
+    command = commands.add_parser('buyers', help="parallel wallet purchases of one user")
+    command.add_argument('--buyers', type=int, default=50)
+    command.add_argument('--stock', type=int, default=10, help="purchases the balance pays for")
+    command.add_argument('--configs', type=int, default=5, help="configs in the inventory")
+    command.set_defaults(scenario=run_buyers)
+
+    command = commands.add_parser('payments', help="online top-ups and purchases against a local fake gateway, with duplicate callbacks")
+    command.add_argument('--users', type=int, default=200)
+    command.add_argument('--concurrency', type=int, default=100)
+    command.add_argument('--duplicates', type=int, default=3, help="callbacks of every payment after it was paid")
+    command.add_argument('--gateway-latency', type=float, default=0.0, help="seconds every gateway call takes")
+    command.set_defaults(scenario=run_payments)
+
+    command = commands.add_parser('referrals', help="new users opening referral links, with repeated and invalid links")
+    command.add_argument('--users', type=int, default=2000)
+    command.add_argument('--referrers', type=int, default=20)
+    command.add_argument('--concurrency', type=int, default=100)
+    command.set_defaults(scenario=run_referrals)
+
+    command = commands.add_parser('tickets', help="support tickets opened, taken, answered and closed by competing agents, and /find")
+    command.add_argument('--users', type=int, default=500)
+    command.add_argument('--concurrency', type=int, default=100)
+    command.set_defaults(scenario=run_tickets)
+
+    command = commands.add_parser('states', help="conversation states surviving a restart, deleted and expiring, on redis and sqlite")
+    command.add_argument('--chats', type=int, default=1000)
+    command.add_argument('--ttl', type=int, default=1, help="seconds the states live")
+    command.set_defaults(scenario=run_states)
+
+    command = commands.add_parser('replay', help="recorded updates, one JSON object per line")
+    command.add_argument('path')
+    command.add_argument('--concurrency', type=int, default=100)
+    command.set_defaults(scenario=run_replay)
+
+    result = asyncio.run(bench(parser.parse_args()))
+    sys.exit(0 if result is not False else 1)
@@ -0,0 +1,66 @@
+# Libraries
+import time
+import threading
+from collections import OrderedDict
+
+
+# In-process cache with a time to live and least recently used eviction
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()      # key -> (expires at, value), least recently used first
+        self._lock = threading.Lock()
+        self.writes = 0                 # bumped by every invalidation, see read_through
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self.writes += 1
+            self._data.pop(key, None)
+
+    # Fetch through the cache, a value read while a write happened is not cached since it may already be stale
+    async def read_through(self, key, fetch):
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        writes = self.writes
+        value = await fetch()
+        if value is not None and writes == self.writes:
+            self.set(key, value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0,
+                'evictions': self.evictions,
+            }
@@ -9,6 +9,28 @@ load_dotenv()
 # Token
 API_KEY = os.getenv('API_KEY')
 
+# Run mode: 'polling' or 'webhook'
+RUN_MODE = os.getenv('RUN_MODE', 'polling')
+
+# Webhook
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')                          # public https base url, empty to skip registering with Telegram
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')                    # checked against the X-Telegram-Bot-Api-Secret-Token header
+WEBHOOK_CERT = os.getenv('WEBHOOK_CERT', '')                        # optional TLS certificate and key files
+WEBHOOK_KEY = os.getenv('WEBHOOK_KEY', '')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 32))             # worker tasks handling updates
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))     # updates waiting for a worker before we answer 503
+WORKERS = int(os.getenv('WORKERS', 1))                              # bot processes, more than 1 starts the supervisor
+
+# outgoing messages (telegram allows about 30 messages per second, 1 per second in a chat and 20 per minute in a group)
+SEND_RATE = float(os.getenv('SEND_RATE', 30))                       # messages per second for the whole bot, all processes included
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))              # messages per second in one private chat
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', 3))              # messages a private chat may get at once
+SEND_GROUP_RATE = float(os.getenv('SEND_GROUP_RATE', 20 / 60))      # messages per second in one group
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', 1000)) # users read from the database at a time while broadcasting
+
 # on pythonanywhere server
 db_config = {
     'host': os.getenv('DB_HOST'),
@@ -17,6 +39,11 @@ db_config = {
     'database': os.getenv('DB_NAME')
 }
 
+# Database connection pool
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))                   # connections shared by all handlers
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))          # seconds to wait for a free connection
+DB_POOL_PING_AFTER = float(os.getenv('DB_POOL_PING_AFTER', 30))    # ping connections idle longer than this (seconds)
+
 # VIPS ID  Faramarz, Farzaneh, Arash
 VIPS_ID = [int(id) for id in os.getenv('VIPS_ID').split(',')]
 
@@ -26,12 +53,79 @@ MAHSA_ID = int(os.getenv('MAHSA_ID'))
 # Admin ID
 ADMIN_ID = [int(id) for id in os.getenv('ADMIN_ID').split(',')]
 
-# Support ID
-SUPPORT_ID = int(os.getenv('SUPPORT_ID'))
+# Support IDs, tickets go to the least busy one (SUPPORT_ID still works for a single account)
+SUPPORT_IDS = [int(id) for id in os.getenv('SUPPORT_IDS', os.getenv('SUPPORT_ID')).split(',')]
+
+# Online payments through a zarinpal compatible gateway, without a merchant id the fixed payment links are shown
+PAYMENT_MERCHANT_ID = os.getenv('PAYMENT_MERCHANT_ID', '')
+PAYMENT_GATEWAY_URL = os.getenv('PAYMENT_GATEWAY_URL', 'https://payment.zarinpal.com')     # request and verify api
+PAYMENT_START_URL = os.getenv('PAYMENT_START_URL', PAYMENT_GATEWAY_URL + '/pg/StartPay/')  # the user pays on this url + authority
+PAYMENT_CALLBACK_URL = os.getenv('PAYMENT_CALLBACK_URL', '')        # public url of the callback endpoint, the gateway sends users back to it
+PAYMENT_RETURN_URL = os.getenv('PAYMENT_RETURN_URL', 'https://t.me/MochiServer_bot')       # link back to the bot on the result page
+PAYMENT_HOST = os.getenv('PAYMENT_HOST', '0.0.0.0')
+PAYMENT_PORT = int(os.getenv('PAYMENT_PORT', 8080))
+PAYMENT_PATH = os.getenv('PAYMENT_PATH', '/payment')
+PAYMENT_TIMEOUT = float(os.getenv('PAYMENT_TIMEOUT', 10))           # seconds to wait for the gateway
+
+# Config inventory
+CONFIG_LOW_STOCK = int(os.getenv('CONFIG_LOW_STOCK', 10))           # admins are told when a product has this many unused configs left
+
+# Referrals
+REFERRAL_BONUS = int(os.getenv('REFERRAL_BONUS', 40000))           # starting balance of a new user opening a referral link
+REFERRER_REWARD = int(os.getenv('REFERRER_REWARD', 20000))         # added to the referrer's balance for every new user
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', 10))          # referrers shown by /top
+LEADERBOARD_INTERVAL = float(os.getenv('LEADERBOARD_INTERVAL', 300))   # seconds before the leaderboard is read again
+
+# Logging, files rotate by size and age so disk use stays bounded
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')                        # 'text' or 'json' (one object per line with update, user and handler)
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))   # rotate when the file grows past this size
+LOG_ROTATE_INTERVAL = int(os.getenv('LOG_ROTATE_INTERVAL', 86400))  # and at least this often (seconds, 0 disables)
+LOG_BACKUPS = int(os.getenv('LOG_BACKUPS', 5))                      # rotated files kept
+
+# Metrics, served in the Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9464))                 # 0 disables the endpoint, worker processes use the next ports
+METRICS_LOG_INTERVAL = int(os.getenv('METRICS_LOG_INTERVAL', 300))  # seconds between summaries of the slowest handlers in the log, 0 disables
+
+# Free text answers: intents file, and an optional slower responder for everything else
+FAQ_PATH = os.getenv('FAQ_PATH', 'faq.json')
+FALLBACK_URL = os.getenv('FALLBACK_URL', '')                        # POST {"text": ...} -> {"answer": ...}, empty disables it
+FALLBACK_TIMEOUT = float(os.getenv('FALLBACK_TIMEOUT', 5))
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 10000))  # fallback answers cached by normalized text
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 3600))
+
+# Conversation states: 'memory', 'sqlite' or 'redis'
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'states.sqlite3')
+STATE_REDIS_URL = os.getenv('STATE_REDIS_URL', 'redis://localhost:6379/0')
+STATE_TTL = float(os.getenv('STATE_TTL', 24 * 3600))               # seconds before an unfinished conversation is dropped
+STATE_BATCH_SIZE = int(os.getenv('STATE_BATCH_SIZE', 100))         # changed states written per batch
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', 0.5))   # seconds before a partial batch is written
+
+# Pending support requests
+PENDING_SIZE = int(os.getenv('PENDING_SIZE', 10000))               # requests kept, oldest are dropped first
+PENDING_TTL = float(os.getenv('PENDING_TTL', 7 * 24 * 3600))       # seconds before a request expires
+PENDING_DB_PATH = os.getenv('PENDING_DB_PATH', '')                 # optional SQLite file to keep requests across restarts
+
+# User record cache
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))         # users kept in memory
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 60))            # seconds before a cached user is read again
+
+# Registration
+KNOWN_USERS_SIZE = int(os.getenv('KNOWN_USERS_SIZE', 100000))      # user ids remembered as already registered
+REGISTER_BATCH_SIZE = int(os.getenv('REGISTER_BATCH_SIZE', 100))   # new users inserted per batch
+REGISTER_FLUSH_INTERVAL = float(os.getenv('REGISTER_FLUSH_INTERVAL', 1))   # seconds before a partial batch is written
+
+# Users per page in the admin panel
+ADMIN_PAGE_SIZE = int(os.getenv('ADMIN_PAGE_SIZE', 20))
+
+# Balance history entries per page in the profile
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 10))
 
-# Variables
-texts = {}
-price = 0
+# Telegram file_ids of uploaded media, kept across restarts
+MEDIA_CACHE_PATH = os.getenv('MEDIA_CACHE_PATH', 'media_cache.json')
 
 ### Text configs
 
@@ -0,0 +1,709 @@
+# Libraries
+import time
+import asyncio
+import functools
+import itertools
+import queue
+import logging
+import threading
+import contextlib
+import mysql.connector
+from concurrent.futures import ThreadPoolExecutor
+
+# Files
+import Config as Keys
+import Cache
+import Metrics
+
+
+# Raised when no connection becomes free within the pool timeout
+class PoolTimeout(mysql.connector.errors.PoolError):
+    pass
+
+
+# Process-wide pool of MySQL connections shared by all handlers
+class ConnectionPool:
+    def __init__(self, db_config, size=5, timeout=10, ping_after=30):
+        self.db_config = dict(db_config, autocommit=True)
+        self.size = size
+        self.timeout = timeout
+        self.ping_after = ping_after
+
+        self._idle = queue.LifoQueue()      # (connection, last used) pairs, most recently used first
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._in_use = 0
+
+        self.metrics = {
+            'checkouts': 0,     # connections handed out
+            'waits': 0,         # checkouts that had to wait for a free connection
+            'timeouts': 0,      # waits that gave up after the pool timeout
+            'failures': 0,      # connect or health check failures
+            'reconnects': 0,    # stale connections revived on checkout
+        }
+
+    def _count(self, metric):
+        with self._lock:
+            self.metrics[metric] += 1
+
+    # Open a new connection if the pool still has room for one
+    def _open(self):
+        with self._lock:
+            if self._opened >= self.size:
+                return None
+            self._opened += 1
+
+        try:
+            return mysql.connector.connect(**self.db_config)
+        except mysql.connector.Error:
+            with self._lock:
+                self._opened -= 1
+                self.metrics['failures'] += 1
+            raise
+
+    # Close a connection for good and free its slot
+    def _discard(self, connection):
+        with self._lock:
+            self._opened -= 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    # Make sure a connection that sat idle for a while is still alive
+    def _check(self, connection, last_used):
+        if time.monotonic() - last_used < self.ping_after:
+            return connection
+
+        try:
+            connection.ping(reconnect=False)
+            return connection
+        except mysql.connector.Error:
+            pass
+
+        try:
+            connection.reconnect(attempts=1)
+            self._count('reconnects')
+            return connection
+        except mysql.connector.Error:
+            self._count('failures')
+            self._discard(connection)
+            raise
+
+    def acquire(self):
+        try:
+            connection, last_used = self._idle.get_nowait()
+        except queue.Empty:
+            connection = self._open()
+            last_used = time.monotonic()
+
+            if connection is None:
+                self._count('waits')
+                try:
+                    connection, last_used = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    self._count('timeouts')
+                    raise PoolTimeout(f"No database connection free after {self.timeout} seconds")
+
+        connection = self._check(connection, last_used)
+
+        with self._lock:
+            self.metrics['checkouts'] += 1
+            self._in_use += 1
+        return connection
+
+    def release(self, connection, broken=False):
+        with self._lock:
+            self._in_use -= 1
+
+        if not broken and connection.in_transaction:
+            try:
+                connection.rollback()
+            except mysql.connector.Error:
+                broken = True
+
+        if broken:
+            self._discard(connection)
+        else:
+            self._idle.put((connection, time.monotonic()))
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self.acquire()
+        broken = False
+        try:
+            yield connection
+        except (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.release(connection, broken=broken)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.metrics, size=self.size, opened=self._opened, in_use=self._in_use, idle=self._idle.qsize())
+
+
+# The pool is created on first use so importing this module never touches the network
+_pool = None
+_pool_lock = threading.Lock()
+
+# Blocking driver calls run on their own threads, one per pooled connection, so the event loop never waits on MySQL
+_executor = ThreadPoolExecutor(max_workers=Keys.DB_POOL_SIZE, thread_name_prefix='db')
+
+
+def pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(Keys.db_config,
+                                       size=Keys.DB_POOL_SIZE,
+                                       timeout=Keys.DB_POOL_TIMEOUT,
+                                       ping_after=Keys.DB_POOL_PING_AFTER)
+                logging.info("Database pool created with %s connections", Keys.DB_POOL_SIZE)
+    return _pool
+
+
+def pool_stats():
+    return pool().stats()
+
+
+Metrics.gauge('bot_db_pool_connections', 'Database connections, by state', ('state',),
+              lambda: {(state,): _pool.stats()[state] for state in ('in_use', 'idle')} if _pool else {})
+
+
+# Run a blocking function on the database threads and await its result
+async def run(function, *args):
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_executor, functools.partial(function, *args))
+    finally:
+        Metrics.query(time.perf_counter() - start)
+
+
+def _fetch_one(sql, params):
+    with pool().connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchone()
+
+
+def _fetch_all(sql, params):
+    with pool().connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+
+def _execute(sql, params):
+    with pool().connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+
+# Run several statements atomically, commits on success and rolls back on error
+@contextlib.contextmanager
+def transaction():
+    with pool().connection() as connection:
+        connection.start_transaction()
+        try:
+            with connection.cursor() as cursor:
+                yield cursor
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+
+def _transact(function, args):
+    with transaction() as cursor:
+        return function(cursor, *args)
+
+
+# Run a query and return its first row
+async def fetch_one(sql, params=()):
+    return await run(_fetch_one, sql, params)
+
+
+# Run a query and return all rows
+async def fetch_all(sql, params=()):
+    return await run(_fetch_all, sql, params)
+
+
+# Run a single write statement and return the number of affected rows
+async def execute(sql, params=()):
+    return await run(_execute, sql, params)
+
+
+# Run function(cursor, *args) inside one transaction and return its result
+async def transact(function, *args):
+    return await run(_transact, function, args)
+
+
+# Buffers rows and writes them with one executemany, when the batch is full or after the flush interval.
+# then(cursor, rows) runs in the same transaction as the batch
+class WriteBehind:
+    def __init__(self, sql, batch_size, interval, then=None):
+        self.sql = sql
+        self.batch_size = batch_size
+        self.interval = interval
+        self.then = then
+        self.pending = {}       # key -> row, a key queued twice is written once
+        self.writing = {}       # key -> future of the batch being written with it, done once it committed or failed
+        self._timer = None
+        self._tasks = set()
+
+    def add(self, key, row):
+        self.pending[key] = row
+        if len(self.pending) >= self.batch_size:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.interval)
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._start_flush)
+
+    def _start_flush(self):
+        self._timer = None
+        task = asyncio.create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _write(self, rows):
+        with transaction() as cursor:
+            cursor.executemany(self.sql, rows)
+            if self.then is not None:
+                self.then(cursor, rows)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        done = asyncio.get_running_loop().create_future()
+        for key in batch:
+            self.writing[key] = done
+
+        try:
+            await run(self._write, list(batch.values()))
+        except Exception as e:
+            logging.error("Error while writing %s queued rows, retrying: %s", len(batch), e)
+            # Rows queued again meanwhile are newer and win
+            self.pending = {**batch, **self.pending}
+            if self._timer is None:
+                self._schedule(self.interval)
+        finally:
+            for key in batch:
+                if self.writing.get(key) is done:
+                    del self.writing[key]
+            done.set_result(None)
+
+    # Drop a key still waiting, its row must not be written anymore
+    def discard(self, key):
+        self.pending.pop(key, None)
+
+    # Queued or being written
+    def queued(self, key):
+        return key in self.pending or key in self.writing
+
+    # Write a key now if it is not in the database yet, used before anything else touches its row.
+    # A key in a batch being written waits for that batch, and is written again if the batch failed
+    async def flush_key(self, key):
+        writing = self.writing.get(key)
+        if writing is not None:
+            await writing
+        if key in self.pending:
+            await self.flush()
+
+
+### Users
+
+# Recently used user rows, every write to a user goes through invalidate_user
+user_cache = Cache.TTLCache(Keys.USER_CACHE_SIZE, Keys.USER_CACHE_TTL)
+
+
+# (id, username, first_name, last_name, balance, test_config_used) or None
+async def get_user(user_id):
+    return await user_cache.read_through(user_id, lambda: fetch_one(
+        "SELECT id, username, first_name, last_name, balance, test_config_used FROM users WHERE id = %s", (user_id,)))
+
+
+# With WORKERS > 1 a user is cached by the worker handling its chat, so writes to the user made in another process
+# are passed to that worker. Set by Supervisor to notify(kind, user_id), kind is 'invalidate' or 'forget'
+notify = None
+
+
+def _invalidate_user(user_id):
+    user_cache.invalidate(user_id)
+    history_cache.invalidate(user_id)
+
+
+def invalidate_user(user_id):
+    _invalidate_user(user_id)
+    if notify is not None:
+        notify('invalidate', user_id)
+
+
+# Users already in the database, /start skips the database entirely for them
+known_users = Cache.TTLCache(Keys.KNOWN_USERS_SIZE, float('inf'))
+
+# Starting balances of the users just inserted, a user with ledger entries was not new and gets nothing
+def _record_bonuses(cursor, rows):
+    bonuses = [(row[0], row[0]) for row in rows if row[4]]
+    if bonuses:
+        cursor.executemany("INSERT INTO ledger (user_id, kind, amount, balance) SELECT id, 'bonus', balance, balance FROM users "
+                           "WHERE id = %s AND NOT EXISTS (SELECT 1 FROM ledger WHERE user_id = %s)", bonuses)
+
+
+# New users are inserted in batches, inserting an existing id changes nothing
+registrations = WriteBehind(
+    "INSERT INTO users (id, username, first_name, last_name, balance) VALUES (%s, %s, %s, %s, %s) "
+    "ON DUPLICATE KEY UPDATE id = id",
+    Keys.REGISTER_BATCH_SIZE, Keys.REGISTER_FLUSH_INTERVAL, then=_record_bonuses)
+Metrics.gauge('bot_registrations_queued', 'New users waiting to be inserted', (), lambda: {(): len(registrations.pending)})
+
+
+# Returns True for a new user, who is queued for insertion with the given starting balance
+async def register_user(chat, balance=0):
+    if known_users.get(chat.id):
+        return False
+
+    if registrations.queued(chat.id) or await get_user(chat.id):
+        known_users.set(chat.id, True)
+        return False
+
+    registrations.add(chat.id, (chat.id, chat.username, chat.first_name, chat.last_name, balance))
+    known_users.set(chat.id, True)
+    # Readers see the new user before the batch is written
+    user_cache.set(chat.id, (chat.id, chat.username, chat.first_name, chat.last_name, balance, False))
+    return True
+
+
+# The user row was deleted, a registration still queued is dropped so it does not bring the user back
+def _forget_user(user_id):
+    _invalidate_user(user_id)
+    known_users.invalidate(user_id)
+    registrations.discard(user_id)
+
+
+def forget_user(user_id):
+    _forget_user(user_id)
+    if notify is not None:
+        notify('forget', user_id)
+
+
+# A notify() of another process reached the worker of the user
+def notified(kind, user_id):
+    {'invalidate': _invalidate_user, 'forget': _forget_user}[kind](user_id)
+
+
+# Make sure a freshly registered user is written before updating or deleting its row
+async def ensure_user(user_id):
+    await registrations.flush_key(user_id)
+
+
+# Debit the price only if the balance covers it, record the order and claim a config for it in the same transaction.
+# Returns (order id, config or None when the product is out of stock) or None
+def _purchase(cursor, user_id, product, price):
+    cursor.execute("UPDATE users SET balance = balance - %s WHERE id = %s AND balance >= %s", (price, user_id, price))
+    if cursor.rowcount != 1:
+        return None
+
+    order_id, config = _order(cursor, user_id, product, price)
+    _record(cursor, user_id, 'purchase', -price, order_id, product)
+    return order_id, config
+
+
+# Record a paid order and claim a config for it, returns (order id, config or None when the product is out of stock)
+def _order(cursor, user_id, product, price):
+    config = _free_config(cursor, product)
+    status = 'paid' if config is None else 'delivered'
+    cursor.execute("INSERT INTO orders (user_id, product, price, status) VALUES (%s, %s, %s, %s)", (user_id, product, price, status))
+    order_id = cursor.lastrowid
+    if config is None:
+        return order_id, None
+
+    _assign_config(cursor, config[0], user_id, order_id)
+    return order_id, config[1]
+
+
+async def purchase(user_id, product, price):
+    await ensure_user(user_id)
+    try:
+        return await transact(_purchase, user_id, product, price)
+    finally:
+        invalidate_user(user_id)
+
+
+# Admin edit of a user, the change of the balance is recorded like any other
+def _update_user(cursor, user_id, username, first_name, last_name, balance, admin_id):
+    cursor.execute("SELECT balance FROM users WHERE id = %s FOR UPDATE", (user_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return False
+
+    cursor.execute("UPDATE users SET username = %s, first_name = %s, last_name = %s, balance = %s WHERE id = %s",
+                   (username, first_name, last_name, balance, user_id))
+    if balance != row[0]:
+        _record(cursor, user_id, 'admin', balance - row[0], None, str(admin_id))
+    return True
+
+
+async def update_user(user_id, username, first_name, last_name, balance, admin_id):
+    await ensure_user(user_id)
+    try:
+        return await transact(_update_user, user_id, username, first_name, last_name, balance, admin_id)
+    finally:
+        invalidate_user(user_id)
+
+
+# Escape LIKE wildcards so user input only matches as a plain prefix
+def _prefix_pattern(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+# Keyset pagination over users.id, memory and latency do not depend on the size of the table
+async def users_after(after_id, limit):
+    return await fetch_all("SELECT id, first_name FROM users WHERE id > %s ORDER BY id LIMIT %s", (after_id, limit))
+
+
+async def users_before(before_id, limit):
+    rows = await fetch_all("SELECT id, first_name FROM users WHERE id < %s ORDER BY id DESC LIMIT %s", (before_id, limit))
+    return rows[::-1]
+
+
+# Match an exact id or a username / first name / last name prefix, every branch is an index range scan
+async def search_users(text, limit):
+    pattern = _prefix_pattern(text.lstrip('@'))
+    user_id = int(text) if text.isdigit() else None
+    sql = """(SELECT id, first_name FROM users WHERE id = %s)
+             UNION (SELECT id, first_name FROM users WHERE username LIKE %s ORDER BY username LIMIT %s)
+             UNION (SELECT id, first_name FROM users WHERE first_name LIKE %s ORDER BY first_name LIMIT %s)
+             UNION (SELECT id, first_name FROM users WHERE last_name LIKE %s ORDER BY last_name LIMIT %s)
+             ORDER BY id LIMIT %s"""
+    return await fetch_all(sql, (user_id, pattern, limit, pattern, limit, pattern, limit, limit))
+
+
+### Ledger
+# Every balance movement and purchase is appended with the balance it left, users.balance is the running total.
+# Rows are only inserted, the history of a user is read newest first with a (created_at, id) cursor
+
+
+# Record a movement of a balance already changed in this transaction, the balance is read from the locked user row
+def _record(cursor, user_id, kind, amount, order_id=None, note=None):
+    cursor.execute("INSERT INTO ledger (user_id, kind, amount, balance, order_id, note) "
+                   "SELECT id, %s, %s, balance, %s, %s FROM users WHERE id = %s", (kind, amount, order_id, note, user_id))
+
+
+# Newest entries of every user looked at recently, invalidated with the user row
+history_cache = Cache.TTLCache(Keys.USER_CACHE_SIZE, Keys.USER_CACHE_TTL)
+
+
+# Entries (id, kind, amount, balance, note, created_at) older than the cursor (created_at, id), the newest without one.
+# A user still queued for insertion is written first, so the cached first page has its starting bonus
+async def history(user_id, limit, before=None):
+    await ensure_user(user_id)
+    if before is None:
+        return await history_cache.read_through(user_id, lambda: fetch_all(
+            "SELECT id, kind, amount, balance, note, created_at FROM ledger WHERE user_id = %s "
+            "ORDER BY created_at DESC, id DESC LIMIT %s", (user_id, limit)))
+
+    return await fetch_all(
+        "SELECT id, kind, amount, balance, note, created_at FROM ledger WHERE user_id = %s "
+        "AND (created_at < %s OR (created_at = %s AND id < %s)) ORDER BY created_at DESC, id DESC LIMIT %s",
+        (user_id, before[0], before[0], before[1], limit))
+
+
+### Config inventory
+# A config is unused until a user is set on it, claims lock the row until the purchase commits
+
+
+# Oldest unused config of a product, rows locked by concurrent purchases are skipped instead of waited for
+def _free_config(cursor, product):
+    cursor.execute("SELECT id, config FROM configs WHERE product = %s AND user_id IS NULL ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED", (product,))
+    return cursor.fetchone()
+
+
+def _assign_config(cursor, config_id, user_id, order_id):
+    cursor.execute("UPDATE configs SET user_id = %s, order_id = %s, claimed_at = CURRENT_TIMESTAMP WHERE id = %s", (user_id, order_id, config_id))
+
+
+# Mark the test config as used and claim one, returns the config, None when out of stock or False when it was already used
+def _claim_test(cursor, user_id, product):
+    cursor.execute("UPDATE users SET test_config_used = TRUE WHERE id = %s AND test_config_used = FALSE", (user_id,))
+    if cursor.rowcount != 1:
+        return False
+
+    config = _free_config(cursor, product)
+    if config is None:
+        return None
+
+    _assign_config(cursor, config[0], user_id, None)
+    return config[1]
+
+
+async def claim_test(user_id, product):
+    await ensure_user(user_id)
+    try:
+        return await transact(_claim_test, user_id, product)
+    finally:
+        invalidate_user(user_id)
+
+
+def _import_configs(cursor, product, configs):
+    cursor.executemany("INSERT INTO configs (product, config) VALUES (%s, %s)", [(product, config) for config in configs])
+    return cursor.rowcount
+
+
+# Add configs to the inventory of a product, returns how many were added
+async def import_configs(product, configs):
+    return await transact(_import_configs, product, configs)
+
+
+# Unused configs of a product, counted up to limit so the query stays an index range of at most limit rows
+async def free_configs(product, limit):
+    row = await fetch_one("SELECT COUNT(*) FROM (SELECT id FROM configs WHERE product = %s AND user_id IS NULL LIMIT %s) AS free", (product, limit))
+    return row[0]
+
+
+# Unused configs per product
+async def config_stock():
+    return await fetch_all("SELECT product, COUNT(*) FROM configs WHERE user_id IS NULL GROUP BY product")
+
+
+### Payments
+# The gateway's authority is the idempotency key of a payment: it is unique and a payment leaves 'pending' only once
+
+
+def _create_payment(cursor, user_id, amount, product, authority):
+    cursor.execute("INSERT INTO payments (user_id, amount, product, authority) VALUES (%s, %s, %s, %s)", (user_id, amount, product, authority))
+    return cursor.lastrowid
+
+
+async def create_payment(user_id, amount, product, authority):
+    await ensure_user(user_id)
+    return await transact(_create_payment, user_id, amount, product, authority)
+
+
+# (id, user_id, amount, product, status) or None
+async def get_payment(authority):
+    return await fetch_one("SELECT id, user_id, amount, product, status FROM payments WHERE authority = %s", (authority,))
+
+
+# Mark a verified payment paid, then credit the balance (top-ups, product NULL) or record the order and claim its config.
+# Returns (user_id, amount, product, order id, config) or None when the payment was already completed
+def _complete_payment(cursor, payment_id, ref_id):
+    cursor.execute("UPDATE payments SET status = 'paid', ref_id = %s, paid_at = CURRENT_TIMESTAMP WHERE id = %s AND status = 'pending'", (ref_id, payment_id))
+    if cursor.rowcount != 1:
+        return None
+
+    cursor.execute("SELECT user_id, amount, product FROM payments WHERE id = %s", (payment_id,))
+    user_id, amount, product = cursor.fetchone()
+    if product is None:
+        cursor.execute("UPDATE users SET balance = balance + %s WHERE id = %s", (amount, user_id))
+        _record(cursor, user_id, 'top_up', amount, None, ref_id)
+        return user_id, amount, None, None, None
+
+    # Paid online, the balance does not move but the purchase is in the history
+    order_id, config = _order(cursor, user_id, product, amount)
+    cursor.execute("UPDATE payments SET order_id = %s WHERE id = %s", (order_id, payment_id))
+    _record(cursor, user_id, 'order', 0, order_id, product)
+    return user_id, amount, product, order_id, config
+
+
+async def complete_payment(payment_id, user_id, ref_id):
+    try:
+        return await transact(_complete_payment, payment_id, ref_id)
+    finally:
+        invalidate_user(user_id)
+
+
+### Referrals
+# A referral is stored once per referred user, the counters of the referrer are updated in the same transaction
+# so nothing ever counts referrals, and the leaderboard is read from the counters' index
+
+
+# Returns False when the user was already referred or the referrer is not in the database (deleted, or its
+# registration is still queued in another worker). The referrer row stays locked until the reward is credited
+def _add_referral(cursor, user_id, referrer_id, reward):
+    cursor.execute("SELECT balance FROM users WHERE id = %s FOR UPDATE", (referrer_id,))
+    if cursor.fetchone() is None:
+        return False
+
+    cursor.execute("INSERT IGNORE INTO referrals (user_id, referrer_id) VALUES (%s, %s)", (user_id, referrer_id))
+    if cursor.rowcount != 1:
+        return False
+
+    cursor.execute("INSERT INTO referral_stats (referrer_id, referrals, rewarded) VALUES (%s, 1, %s) "
+                   "ON DUPLICATE KEY UPDATE referrals = referrals + 1, rewarded = rewarded + VALUES(rewarded)", (referrer_id, reward))
+    if reward:
+        cursor.execute("UPDATE users SET balance = balance + %s WHERE id = %s", (reward, referrer_id))
+        _record(cursor, referrer_id, 'referral', reward, None, str(user_id))
+    return True
+
+
+async def add_referral(user_id, referrer_id, reward):
+    await ensure_user(referrer_id)
+    try:
+        return await transact(_add_referral, user_id, referrer_id, reward)
+    finally:
+        invalidate_user(referrer_id)
+
+
+# (referrals, rewarded) of a referrer
+async def referral_stats(referrer_id):
+    return await fetch_one("SELECT referrals, rewarded FROM referral_stats WHERE referrer_id = %s", (referrer_id,)) or (0, 0)
+
+
+# Top referrers, refreshed from the database at most once per interval
+leaderboard_cache = Cache.TTLCache(16, Keys.LEADERBOARD_INTERVAL)
+
+
+# [(referrer_id, first_name, referrals, rewarded)], best first. Both columns descending so the
+# (referrals, referrer_id) index is read backwards instead of sorting the counters
+async def top_referrers(limit):
+    return await leaderboard_cache.read_through(limit, lambda: fetch_all(
+        "SELECT s.referrer_id, u.first_name, s.referrals, s.rewarded FROM referral_stats s LEFT JOIN users u ON u.id = s.referrer_id "
+        "ORDER BY s.referrals DESC, s.referrer_id DESC LIMIT %s", (limit,)))
+
+
+### Tickets
+# A ticket is 'open' until an agent takes it ('answering') and 'closed' once the answer was sent
+_rotation = itertools.count()
+
+
+# Assign to the agent with the fewest unfinished tickets, ties are taken in turn
+def _open_ticket(cursor, user_id, kind, agents, order_id):
+    cursor.execute("SELECT agent_id, COUNT(*) FROM tickets WHERE status IN ('open', 'answering') GROUP BY agent_id")
+    load = dict(cursor.fetchall())
+    start = next(_rotation) % len(agents)
+    agent_id = min(agents[start:] + agents[:start], key=lambda agent: load.get(agent, 0))
+
+    cursor.execute("INSERT INTO tickets (user_id, agent_id, kind, order_id) VALUES (%s, %s, %s, %s)", (user_id, agent_id, kind, order_id))
+    return cursor.lastrowid, agent_id
+
+
+async def open_ticket(user_id, kind, agents, order_id=None):
+    return await transact(_open_ticket, user_id, kind, agents, order_id)
+
+
+async def get_ticket(ticket_id):
+    return await fetch_one("SELECT id, user_id, agent_id, status FROM tickets WHERE id = %s", (ticket_id,))
+
+
+async def take_ticket(ticket_id, agent_id):
+    await execute("UPDATE tickets SET status = 'answering', agent_id = %s WHERE id = %s AND status != 'closed'", (agent_id, ticket_id))
+
+
+# Returns False when the ticket was already closed (answered by someone else)
+async def close_ticket(ticket_id):
+    return await execute("UPDATE tickets SET status = 'closed', closed_at = CURRENT_TIMESTAMP WHERE id = %s AND status != 'closed'", (ticket_id,)) == 1
+
+
+# Unfinished tickets per agent and status
+async def ticket_stats():
+    return await fetch_all("SELECT agent_id, status, COUNT(*) FROM tickets WHERE status IN ('open', 'answering') GROUP BY agent_id, status")
@@ -46,7 +46,7 @@ discount_description = ("""
 
 🏵 با این لینک رفرال ما رو به دوستان خود معرفی کنید.
 
-هر کسی که با این لینک برای اولین بار وارد بات بشود 40 هزار تومن افزایش موجودی خواهد داشت و فرستنده این لینک با ورود عضو جدید کد تخفیف دریافت خواهد کرد.""")
+هر کسی که با این لینک برای اولین بار وارد بات بشود 40 هزار تومن افزایش موجودی خواهد داشت و فرستنده این لینک با ورود هر عضو جدید هدیه موجودی دریافت خواهد کرد.""")
 
 # افزایش موجودی 💰
 funds_description = ("""💳 لطفا مقدار مبلغ مورد نظرت رو برای افزایش موجودی انتخاب بکن.
@@ -89,7 +89,9 @@ mahsa_description = ("""پریویت عزیزم 🙃❤️
 # Admin
 admin_description = ("""لیست کاربرا 👥
 
-اینجا میتونی اطلاعات کاربران رو تغییر بدی ✏ یا بلاکشون 🅱 کنی""")
+اینجا میتونی اطلاعات کاربران رو تغییر بدی ✏ یا بلاکشون 🅱 کنی
+
+🔎 برای جستجو: /find آیدی، یوزرنیم یا اسم""")
 
 
 
@@ -0,0 +1,170 @@
+# Libraries
+import json
+import time
+import queue
+import atexit
+import asyncio
+import logging
+import functools
+import contextvars
+import telebot
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Files
+import Config as Keys
+import Metrics
+
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# What the current task is working on, added to every record logged from it
+update_id = contextvars.ContextVar('update_id', default=None)
+user_id = contextvars.ContextVar('user_id', default=None)
+handler = contextvars.ContextVar('handler', default=None)
+
+_handlers = []
+_listeners = []
+
+
+# Rotates when the file is too big or too old, disk use stays below (backups + 1) * max_bytes
+class RotatingHandler(RotatingFileHandler):
+    def __init__(self, filename, max_bytes, backups, interval):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding='utf-8', delay=True)
+        self.interval = interval
+        self.rollover_at = time.time() + interval
+
+    def shouldRollover(self, record):
+        if self.interval and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+
+# One JSON object per line
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'update_id': getattr(record, 'update_id', None),
+            'user_id': getattr(record, 'user_id', None),
+            'handler': getattr(record, 'handler', None),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+# Hands records to the writer thread. In the same process the record is passed as is, so the
+# message is only formatted by the writer, across processes it is formatted first to be picklable.
+class ContextQueueHandler(QueueHandler):
+    def __init__(self, target, local=True):
+        super().__init__(target)
+        self.local = local
+
+    def prepare(self, record):
+        record.update_id = update_id.get()
+        record.user_id = user_id.get()
+        record.handler = handler.get()
+        if self.local:
+            return record
+        return super().prepare(record)
+
+
+def _create_handlers():
+    formatter = JsonFormatter() if Keys.LOG_FORMAT == 'json' else logging.Formatter(FORMAT)
+    handlers = [RotatingHandler(Keys.LOG_FILE, Keys.LOG_MAX_BYTES, Keys.LOG_BACKUPS, Keys.LOG_ROTATE_INTERVAL),
+                logging.StreamHandler()]
+    for output in handlers:
+        output.setFormatter(formatter)
+    return handlers
+
+
+def _install(output):
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(output)
+    root.setLevel(Keys.LOG_LEVEL)
+
+    # pyTelegramBotAPI writes to its own console handler and logs every batch of updates at INFO
+    telebot.logger.handlers.clear()
+    telebot.logger.setLevel(max(logging.WARNING, root.level))
+
+
+# Start writing records from `source` to the log file and the console in a background thread
+def listen(source):
+    if not _handlers:
+        _handlers.extend(_create_handlers())
+    listener = QueueListener(source, *_handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+    return listener
+
+
+def stop():
+    while _listeners:
+        _listeners.pop().stop()
+    for output in _handlers:
+        output.close()
+    _handlers.clear()
+
+
+# Log through a queue written by a background thread, loggers only pay for the enqueue
+def setup():
+    records = queue.SimpleQueue()
+    listen(records)
+    _install(ContextQueueHandler(records))
+    atexit.register(stop)
+
+
+# In a worker process: send the records to the supervisor, which writes them
+def forward(target):
+    stop()
+    _install(ContextQueueHandler(target, local=False))
+
+
+# Name the handler of the current update in its logs and its metrics
+def name(function_name):
+    handler.set(function_name)
+    Metrics.name(function_name)
+
+
+# Bind the update id, user id and handler name of every update to the logs of its handling, the name to its metrics too
+def trace(bot):
+    process_new_updates = bot.process_new_updates
+
+    async def process_one(update):
+        update_id.set(update.update_id)
+        for kind in ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                     'shipping_query', 'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request'):
+            event = getattr(update, kind, None)
+            if event is not None:
+                user = getattr(event, 'from_user', None)
+                user_id.set(user.id if user else None)
+                break
+        await process_new_updates([update])
+
+    # Every update runs in its own task, so the values above stay with it
+    async def process(updates):
+        await asyncio.gather(*(process_one(update) for update in updates))
+
+    bot.process_new_updates = process
+
+    for handlers in (bot.message_handlers, bot.edited_message_handlers, bot.callback_query_handlers,
+                     bot.inline_handlers, bot.pre_checkout_query_handlers):
+        for entry in handlers:
+            entry['function'] = _named(entry['function'])
+
+
+def _named(function):
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        name(function.__name__)
+        return await function(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,110 @@
+# Libraries
+import os
+import json
+import fcntl
+import asyncio
+import hashlib
+import logging
+from telebot.asyncio_helper import ApiTelegramException
+
+# Files
+import Config as Keys
+
+
+# Uploads every local file once and reuses Telegram's file_id afterwards.
+# file_ids are keyed by the sha256 of the content, so an edited file is uploaded again.
+class MediaCache:
+    def __init__(self, path):
+        self.path = path
+        self.file_ids = {}
+        self._digests = {}      # file path -> (mtime, size, sha256)
+        self._locks = {}
+
+        self.file_ids = self._read()
+
+    def _read(self):
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logging.error("Ignoring broken media cache %s: %s", self.path, e)
+        return {}
+
+    # Hash of the file content, recomputed only when the file changed on disk
+    def digest(self, file_path):
+        stat = os.stat(file_path)
+        cached = self._digests.get(file_path)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+
+        with open(file_path, 'rb') as file:
+            digest = hashlib.sha256(file.read()).hexdigest()
+        self._digests[file_path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    # Worker processes share the file: under a lock, ids the others saved meanwhile are merged in (ours win,
+    # an upload replaces a rejected id) and the result is written to a temporary file of this process
+    def save(self):
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.file_ids = {**self._read(), **self.file_ids}
+            temporary = f"{self.path}.{os.getpid()}.tmp"
+            with open(temporary, 'w', encoding='utf-8') as file:
+                json.dump(self.file_ids, file)
+            os.replace(temporary, self.path)
+
+    # Send by a cached file_id, returns None when there is none or Telegram rejected it
+    async def _send_cached(self, send, chat_id, digest, file_path, **kwargs):
+        file_id = self.file_ids.get(digest)
+        if not file_id:
+            return None
+        try:
+            return await send(chat_id, file_id, **kwargs)
+        except ApiTelegramException as e:
+            if e.error_code != 400:
+                raise
+            logging.warning("Cached file_id for %s rejected, uploading again: %s", file_path, e)
+            if self.file_ids.get(digest) == file_id:
+                del self.file_ids[digest]
+            return None
+
+    async def _send(self, send, kind, chat_id, file_path, **kwargs):
+        digest = self.digest(file_path)
+
+        # Cached sends run concurrently, only uploads take the lock
+        message = await self._send_cached(send, chat_id, digest, file_path, **kwargs)
+        if message is not None:
+            return message
+
+        # One upload per file even when many users click at the same time
+        lock = self._locks.setdefault(digest, asyncio.Lock())
+        async with lock:
+            if not self.file_ids.get(digest):
+                return await self._upload(send, kind, chat_id, digest, file_path, **kwargs)
+
+        # Uploaded by someone else while we waited, sent without holding the lock
+        message = await self._send_cached(send, chat_id, digest, file_path, **kwargs)
+        if message is not None:
+            return message
+        async with lock:
+            return await self._upload(send, kind, chat_id, digest, file_path, **kwargs)
+
+    async def _upload(self, send, kind, chat_id, digest, file_path, **kwargs):
+        with open(file_path, 'rb') as file:
+            message = await send(chat_id, file, **kwargs)
+
+        media = getattr(message, kind)
+        self.file_ids[digest] = media[-1].file_id if kind == 'photo' else media.file_id
+        self.save()
+        return message
+
+    async def send_video(self, bot, chat_id, file_path, **kwargs):
+        return await self._send(bot.send_video, 'video', chat_id, file_path, **kwargs)
+
+    async def send_photo(self, bot, chat_id, file_path, **kwargs):
+        return await self._send(bot.send_photo, 'photo', chat_id, file_path, **kwargs)
+
+
+cache = MediaCache(Keys.MEDIA_CACHE_PATH)
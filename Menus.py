@@ -0,0 +1,77 @@
+# Libraries
+import telebot
+
+# Files
+import Config as Keys
+
+
+# Main menu buttons: name -> (text, callback data)
+MAIN_BUTTONS = {
+    'test': ('🔑 کانفیگ تستی', 'start_test'),
+    'buy': ('🛒 خرید کانفیگ', 'start_buy'),
+    'profile': ('👩‍🧑‍🦰 پروفایل من', 'start_profile'),
+    'help': ('📋 راهنمای استفاده', 'start_help'),
+    'discount': ('🎁 تخفیف ریفرال', 'start_discount'),
+    'funds': ('💰 افزایش موجودی', 'start_funds'),
+    'admin': ('💻 Admin Panel 💻', 'admin'),
+    'vip': ('🌟 VIP 🌟', 'vip'),
+    'mahsa': ('❤️ Mahsa ❤️', 'mahsa'),
+}
+
+# Rows of the main menu for every role, each group is added to the markup with row_width=2
+COMMON = ('test', 'buy', 'profile', 'help', 'discount', 'funds')
+
+MAIN_LAYOUTS = {
+    'admin': (('admin',), ('vip', 'mahsa') + COMMON),
+    'vip': (('vip',), COMMON),
+    'mahsa': (('mahsa',), COMMON),
+    'user': (COMMON,),
+}
+
+
+# Builds every role's keyboard once and keeps it serialized, lookups are a dict access
+class MenuRegistry:
+    def __init__(self, buttons, layouts):
+        self.buttons = buttons
+        self.layouts = layouts
+        self.roles = {}
+        self.markups = {}
+        self._signature = None
+
+    # Rebuild only when the role lists or the button texts changed
+    def refresh(self, admins, vips, mahsa):
+        signature = (tuple(admins), tuple(vips), mahsa,
+                     tuple(self.buttons.items()), tuple(self.layouts.items()))
+        if signature == self._signature:
+            return False
+
+        # Lowest priority first so an admin who is also a VIP stays an admin
+        roles = {mahsa: 'mahsa'}
+        roles.update(dict.fromkeys(vips, 'vip'))
+        roles.update(dict.fromkeys(admins, 'admin'))
+
+        markups = {}
+        for role, groups in self.layouts.items():
+            glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+            for group in groups:
+                glass_markup.add(*(telebot.types.InlineKeyboardButton(self.buttons[name][0], callback_data=self.buttons[name][1])
+                                   for name in group))
+            markups[role] = glass_markup.to_json()
+
+        self.roles, self.markups, self._signature = roles, markups, signature
+        return True
+
+    def role(self, chat_id):
+        return self.roles.get(chat_id, 'user')
+
+    # Serialized keyboard, pyTelegramBotAPI sends a str reply_markup as is
+    def markup(self, chat_id):
+        return self.markups[self.roles.get(chat_id, 'user')]
+
+
+main_menu = MenuRegistry(MAIN_BUTTONS, MAIN_LAYOUTS)
+main_menu.refresh(Keys.ADMIN_ID, Keys.VIPS_ID, Keys.MAHSA_ID)
+
+
+def is_admin(chat_id):
+    return main_menu.roles.get(chat_id) == 'admin'
@@ -0,0 +1,224 @@
+# Libraries
+import time
+import asyncio
+import logging
+import contextvars
+from aiohttp import web
+
+# Files
+import Config as Keys
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+_metrics = []
+_gauges = []
+
+
+# Counts of events, by labels
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}    # label values -> count
+        _metrics.append(self)
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_labels(self.labels, labels)} {value}")
+        return lines
+
+
+# Distribution of observed values in cumulative buckets, by labels
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}    # label values -> [count per bucket..., count above the last bucket, sum]
+        _metrics.append(self)
+
+    def observe(self, value, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [0] * (len(self.buckets) + 2)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[index] += 1
+                break
+        else:
+            entry[-2] += 1
+        entry[-1] += value
+
+    def count(self, *labels):
+        entry = self.values.get(labels)
+        return sum(entry[:-1]) if entry else 0
+
+    def mean(self, *labels):
+        entry = self.values.get(labels)
+        return entry[-1] / sum(entry[:-1]) if entry else 0
+
+    # Upper bound of the bucket holding the q-th quantile
+    def quantile(self, q, *labels):
+        entry = self.values.get(labels)
+        if not entry:
+            return 0
+        rank, seen = q * sum(entry[:-1]), 0
+        for bound, count in zip(self.buckets, entry):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, entry in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), labels + (bound,))} {cumulative}")
+            cumulative += entry[-2]
+            lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), labels + ('+Inf',))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {entry[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, values)) + '}'
+
+
+# Values read when the metrics are scraped, `read()` returns {label values: value}
+def gauge(name, help, labels, read):
+    _gauges.append((name, help, labels, read))
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for name, help, labels, read in _gauges:
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+        try:
+            values = read()
+        except Exception as e:
+            logging.error("Error while reading gauge %s: %s", name, e)
+            continue
+        for label_values, value in values.items():
+            lines.append(f"{name}{_labels(labels, label_values)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+updates = Histogram('bot_update_seconds', 'Time to handle one update, by handler', ('handler',))
+update_queries = Histogram('bot_update_db_queries', 'Database calls made while handling one update, by handler', ('handler',), COUNT_BUCKETS)
+queries = Histogram('bot_db_query_seconds', 'Database call latency including the wait for a connection, by handler', ('handler',))
+requests = Histogram('bot_telegram_request_seconds', 'Bot API call latency, by method', ('method',))
+request_errors = Counter('bot_telegram_errors_total', 'Bot API calls that failed, by method and error code', ('method', 'code'))
+outbox_waits = Histogram('bot_outbox_wait_seconds', 'Time a message waited for the rate limits, by lane', ('lane',))
+
+
+# What the update being handled has done so far, shared with the tasks it starts
+class Sample:
+    __slots__ = ('handler', 'queries')
+
+    def __init__(self):
+        self.handler = 'none'
+        self.queries = 0
+
+
+sample = contextvars.ContextVar('sample', default=None)
+
+
+# Name the handler of the current update (routed callbacks are only known after the router resolved them)
+def name(handler):
+    current = sample.get()
+    if current is not None:
+        current.handler = handler
+
+
+def query(seconds):
+    current = sample.get()
+    if current is None:
+        queries.observe(seconds, 'background')
+        return
+    current.queries += 1
+    queries.observe(seconds, current.handler)
+
+
+def api_call(method, seconds, code=None):
+    requests.observe(seconds, method)
+    if code is not None:
+        request_errors.inc(method, code)
+
+
+# Time every update, Log.trace names it after the handler that took it. Call before Log.trace so each update
+# reaches this wrapper alone and in its own task.
+def track(bot):
+    process_new_updates = bot.process_new_updates
+
+    async def process(batch):
+        current = Sample()
+        sample.set(current)
+        start = time.perf_counter()
+        try:
+            await process_new_updates(batch)
+        finally:
+            size = len(batch) or 1
+            for _ in range(size):
+                updates.observe((time.perf_counter() - start) / size, current.handler)
+                update_queries.observe(current.queries / size, current.handler)
+
+    bot.process_new_updates = process
+
+
+# Slowest handlers by 95th percentile, written to the log every METRICS_LOG_INTERVAL
+def summary(top=10):
+    rows = sorted(((updates.quantile(0.95, *labels), labels[0]) for labels in updates.values), reverse=True)[:top]
+    lines = [f"{handler}: {updates.count(handler)} updates, mean {updates.mean(handler) * 1000:.0f}ms, "
+             f"p95 <= {p95 * 1000:.0f}ms, {update_queries.mean(handler):.1f} db calls"
+             for p95, handler in rows]
+    return '\n'.join(lines)
+
+
+async def log_summary(interval):
+    while True:
+        await asyncio.sleep(interval)
+        if updates.values:
+            logging.info("Slowest handlers:\n%s", summary())
+
+
+async def handle_metrics(request):
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+
+# Serve /metrics on a local port and log a summary periodically, returns what to stop on shutdown
+async def serve(port):
+    tasks = []
+    if Keys.METRICS_LOG_INTERVAL:
+        tasks.append(asyncio.create_task(log_summary(Keys.METRICS_LOG_INTERVAL)))
+
+    runner = None
+    if port:
+        app = web.Application()
+        app.router.add_get('/metrics', handle_metrics)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, Keys.METRICS_HOST, port).start()
+        logging.info("Metrics on http://%s:%s/metrics", Keys.METRICS_HOST, port)
+    return runner, tasks
+
+
+async def stop(runner, tasks):
+    for task in tasks:
+        task.cancel()
+    if runner is not None:
+        await runner.cleanup()
@@ -0,0 +1,250 @@
+# Libraries
+import time
+import asyncio
+import logging
+import contextvars
+from collections import deque
+from telebot import asyncio_helper
+
+# Files
+import Config as Keys
+import Metrics
+
+
+# Priority lanes, lower goes first
+INTERACTIVE = 0
+BULK = 1
+
+# Lane of the sends made by the current task, broadcasts switch it to BULK
+lane = contextvars.ContextVar('lane', default=INTERACTIVE)
+
+# Only these calls count against Telegram's flood limits
+LIMITED = ('send', 'copy', 'forward', 'edit')
+
+
+# telebot sends chat ids as str in some methods (send_message) and as int in others, one chat must get one bucket.
+# Numeric ids become int, @username stays as it is
+def chat_key(chat_id):
+    if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
+        return int(chat_id)
+    return chat_id
+
+
+# Generic cell rate algorithm: `rate` sends per second with bursts of `burst` sends
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.interval = 1 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self.tat = 0.0      # theoretical arrival time of the next send
+
+    # Reserve the next slot and return how long to wait for it
+    def reserve(self, now):
+        tat = max(self.tat, now)
+        self.tat = tat + self.interval
+        return max(0.0, tat - self.tolerance - now)
+
+    # Seconds until a send would be allowed, without reserving it. `spare` seconds of the burst are left to others
+    def delay(self, now, spare=0.0):
+        return max(0.0, max(self.tat, now) - self.tolerance + spare - now)
+
+    def pause(self, until):
+        self.tat = max(self.tat, until + self.tolerance)
+
+
+# A TokenBucket kept in shared memory, so all processes of the bot draw on one limit.
+# `shared` is a multiprocessing.Value('d') holding the theoretical arrival time (time.monotonic is machine wide)
+class SharedTokenBucket(TokenBucket):
+    def __init__(self, rate, burst, shared):
+        self.interval = 1 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self.shared = shared
+
+    @property
+    def tat(self):
+        return self.shared.value
+
+    @tat.setter
+    def tat(self, value):
+        self.shared.value = value
+
+    def reserve(self, now):
+        with self.shared.get_lock():
+            return super().reserve(now)
+
+    def pause(self, until):
+        with self.shared.get_lock():
+            super().pause(until)
+
+
+# Paces every outgoing message: one global bucket shared by all chats, one bucket per chat,
+# and a dispatcher handing out global slots to interactive sends before bulk ones.
+# Bulk sends leave half of the global burst unused, for interactive sends of the other processes.
+class Outbox:
+    def __init__(self, rate, chat_rate, chat_burst, group_rate, retries=3):
+        self.rate = rate
+        self.bucket = TokenBucket(rate, burst=max(1, int(rate)))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.retries = retries
+
+        self.chats = {}     # chat id -> TokenBucket
+        self.lanes = (deque(), deque())
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        self._send = None
+
+        self.sent = 0
+        self.waits = 0
+        self.retried = 0
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            # Forget idle chats so the table stays bounded by the active ones
+            if len(self.chats) >= 10000:
+                self.chats = {key: value for key, value in self.chats.items() if value.tat > now}
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(self.group_rate)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chats[chat_id] = bucket
+        return bucket
+
+    # Draw global slots from a bucket shared with other processes, see SharedTokenBucket
+    def share(self, shared):
+        self.bucket = SharedTokenBucket(self.rate, max(1, int(self.rate)), shared)
+
+    # Wait for a slot of this chat and then for a global one
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        delay = self._chat_bucket(chat_id, now).reserve(now)
+        if delay:
+            self.waits += 1
+            await asyncio.sleep(delay)
+
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        slot = asyncio.get_running_loop().create_future()
+        self.lanes[lane.get()].append(slot)
+        self._wakeup.set()
+        await slot
+        Metrics.outbox_waits.observe(time.monotonic() - now, 'bulk' if lane.get() == BULK else 'interactive')
+
+    async def _dispatch(self):
+        while True:
+            waiting = next((waiting for waiting in self.lanes if waiting), None)
+            if waiting is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            spare = self.bucket.tolerance / 2 if waiting is self.lanes[BULK] else 0.0
+            delay = self.bucket.delay(time.monotonic(), spare)
+            if delay:
+                await asyncio.sleep(delay)
+                continue    # a more urgent send may have arrived meanwhile
+
+            self.bucket.reserve(time.monotonic())
+            slot = waiting.popleft()
+            if not slot.done():     # the sender may have been cancelled
+                slot.set_result(None)
+
+    # One Bot API call, timed by method and counted by error code
+    async def _call(self, token, url, method, params, files, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = await self._send(token, url, method, params, files, **kwargs)
+        except asyncio_helper.ApiTelegramException as e:
+            Metrics.api_call(url, time.perf_counter() - start, e.error_code)
+            raise
+        except Exception as e:
+            Metrics.api_call(url, time.perf_counter() - start, type(e).__name__)
+            raise
+        Metrics.api_call(url, time.perf_counter() - start)
+        return result
+
+    # Replacement of asyncio_helper._process_request, see install
+    async def _process_request(self, token, url, method='get', params=None, files=None, **kwargs):
+        chat_id = params.get('chat_id') if params else None
+        if chat_id is None or not url.startswith(LIMITED):
+            return await self._call(token, url, method, params, files, **kwargs)
+        chat_id = chat_key(chat_id)
+
+        for attempt in range(self.retries + 1):
+            await self.acquire(chat_id)
+            try:
+                result = await self._call(token, url, method, dict(params), files, **kwargs)
+                self.sent += 1
+                return result
+            except asyncio_helper.ApiTelegramException as e:
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after')
+                if e.error_code != 429 or not retry_after or attempt == self.retries:
+                    raise
+
+            # Flood control: hold this chat and everyone else for as long as Telegram asked
+            logging.warning("Flood limit on %s to %s, retrying in %ss", url, chat_id, retry_after)
+            self.retried += 1
+            until = time.monotonic() + retry_after
+            self._chat_bucket(chat_id, until).pause(until)
+            self.bucket.pause(until)
+            for file in (files or {}).values():
+                if hasattr(file, 'seek'):
+                    file.seek(0)
+
+    # Route every Bot API call of the process through the outbox
+    def install(self):
+        if self._send is None:
+            self._send = asyncio_helper._process_request
+            asyncio_helper._process_request = self._process_request
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'waits': self.waits,
+            'retried': self.retried,
+            'interactive_waiting': len(self.lanes[INTERACTIVE]),
+            'bulk_waiting': len(self.lanes[BULK]),
+            'chats': len(self.chats),
+        }
+
+
+# With WORKERS > 1 the supervisor makes every process share the global bucket, so a broadcast gets the whole rate
+outbox = Outbox(Keys.SEND_RATE, Keys.SEND_CHAT_RATE, Keys.SEND_CHAT_BURST, Keys.SEND_GROUP_RATE)
+Metrics.gauge('bot_outbox_waiting', 'Messages waiting for a global slot, by lane', ('lane',),
+              lambda: {('interactive',): len(outbox.lanes[INTERACTIVE]), ('bulk',): len(outbox.lanes[BULK])})
+
+
+# Send `send(user_id)` to every user, streaming them from the database in keyset chunks.
+# Runs in the bulk lane so interactive replies keep their priority.
+async def broadcast(users_after, send, chunk_size, concurrency=100):
+    lane.set(BULK)
+    limit = asyncio.Semaphore(concurrency)
+    result = {'sent': 0, 'failed': 0}
+
+    async def deliver(user_id):
+        try:
+            await send(user_id)
+            result['sent'] += 1
+        except Exception as e:
+            # Blocked bot, deleted account... nothing to retry
+            logging.info("Broadcast to %s failed: %s", user_id, e)
+            result['failed'] += 1
+        finally:
+            limit.release()
+
+    tasks = set()
+    after_id = 0
+    while True:
+        users = await users_after(after_id, chunk_size)
+        if not users:
+            break
+        for user_id, _ in users:
+            await limit.acquire()
+            task = asyncio.create_task(deliver(user_id))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        after_id = users[-1][0]
+
+    await asyncio.gather(*tasks)
+    return result
@@ -0,0 +1,146 @@
+# Libraries
+import asyncio
+import logging
+import aiohttp
+import mysql.connector
+from aiohttp import web
+
+# Files
+import Config as Keys
+import Database as Db
+import Metrics
+
+
+# Gateway api of zarinpal (v4), any gateway answering the same requests works, Bench.py runs a local one
+REQUEST_PATH = '/pg/v4/payment/request.json'
+VERIFY_PATH = '/pg/v4/payment/verify.json'
+
+# Verify answers 100 for a payment verified now and 101 for one verified before
+PAID_CODES = (100, 101)
+
+callbacks = Metrics.Counter('bot_payment_callbacks_total', 'Payment gateway callbacks, by result', ('result',))
+
+
+# Raised when the gateway cannot be reached or refuses a request, code is the gateway's error code when it answered
+class GatewayError(Exception):
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+def enabled():
+    return bool(Keys.PAYMENT_MERCHANT_ID and Keys.PAYMENT_CALLBACK_URL)
+
+
+async def _post(path, body):
+    try:
+        timeout = aiohttp.ClientTimeout(total=Keys.PAYMENT_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.post(Keys.PAYMENT_GATEWAY_URL + path, json={'merchant_id': Keys.PAYMENT_MERCHANT_ID, **body}) as response:
+                answer = await response.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        raise GatewayError(str(e)) from e
+
+    # Failures come with an empty data list and the reason in errors
+    data = answer.get('data') if isinstance(answer, dict) else None
+    if not isinstance(data, dict):
+        errors = answer.get('errors') if isinstance(answer, dict) else None
+        raise GatewayError(str(errors or answer), errors.get('code') if isinstance(errors, dict) else None)
+    return data
+
+
+# Start a payment of amount toman, a top-up of the balance when product is None.
+# Returns the url the user pays on
+async def create(user_id, amount, product=None):
+    data = await _post(REQUEST_PATH, {
+        'amount': amount,
+        'currency': 'IRT',
+        'description': f"Mochi Server {product or 'top-up'} ({user_id})",
+        'callback_url': Keys.PAYMENT_CALLBACK_URL,
+    })
+    if data.get('code') != 100 or not data.get('authority'):
+        raise GatewayError(f"request refused: {data}")
+
+    await Db.create_payment(user_id, amount, product, data['authority'])
+    return Keys.PAYMENT_START_URL + data['authority']
+
+
+# Ask the gateway whether the payment went through, returns its reference id or None.
+# An answer with an error code (not paid, wrong amount, expired) means no, only an unreachable gateway raises
+async def verify(authority, amount):
+    try:
+        data = await _post(VERIFY_PATH, {'amount': amount, 'authority': authority})
+    except GatewayError as e:
+        if e.code is None:
+            raise
+        logging.info("Payment %s not verified: %s", authority, e)
+        return None
+
+    if data.get('code') not in PAID_CODES:
+        return None
+    return str(data.get('ref_id'))
+
+
+# Settle the payment a callback is about, the gateway is asked and the query string only says which payment.
+# Payments stay 'pending' until verified so a forged or early callback cannot spoil a later real one,
+# and only the callback completing the payment calls on_paid(user_id, amount, product, order_id, config)
+async def settle(authority, status, on_paid):
+    payment = await Db.get_payment(authority)
+    if payment is None:
+        return 'unknown'
+
+    payment_id, user_id, amount, product, state = payment
+    if state != 'pending':
+        return 'duplicate'
+    if status != 'OK':
+        return 'cancelled'
+
+    ref_id = await verify(authority, amount)
+    if ref_id is None:
+        return 'unpaid'
+
+    completed = await Db.complete_payment(payment_id, user_id, ref_id)
+    if completed is None:
+        return 'duplicate'
+
+    logging.info("Payment %s of user %s completed, ref %s", payment_id, user_id, ref_id)
+    await on_paid(*completed)
+    return 'paid'
+
+
+PAGES = {
+    'paid': "✅ پرداخت با موفقیت انجام شد، به ربات برگردید.",
+    'duplicate': "✅ این پرداخت قبلاً ثبت شده است، به ربات برگردید.",
+    'cancelled': "❌ پرداخت لغو شد.",
+    'unpaid': "❌ پرداخت تایید نشد. اگر مبلغ کسر شده باشد تا ۷۲ ساعت بازگردانده می‌شود.",
+    'unknown': "❌ پرداخت یافت نشد.",
+    'error': "⚠️ خطا در بررسی پرداخت، لطفاً چند دقیقه دیگر صفحه را دوباره باز کنید.",
+}
+
+
+# The gateway sends the user's browser back here with ?Authority=...&Status=OK|NOK
+async def handle_callback(request):
+    authority = request.query.get('Authority', '')
+    try:
+        result = await settle(authority, request.query.get('Status', ''), request.app['on_paid'])
+    except (GatewayError, mysql.connector.Error) as e:
+        logging.error("Error while settling payment %s: %s", authority, e)
+        result = 'error'
+
+    callbacks.inc(result)
+    page = f"<html><head><meta charset='utf-8'></head><body dir='rtl'><h3>{PAGES[result]}</h3>" \
+           f"<a href='{Keys.PAYMENT_RETURN_URL}'>بازگشت به ربات</a></body></html>"
+    return web.Response(text=page, content_type='text/html', status=503 if result == 'error' else 200)
+
+
+# Start the callback endpoint, returns the runner to clean up
+async def start(on_paid):
+    app = web.Application()
+    app['on_paid'] = on_paid
+    app.router.add_get(Keys.PAYMENT_PATH, handle_callback)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, Keys.PAYMENT_HOST, Keys.PAYMENT_PORT).start()
+    logging.info("Payment callbacks on %s:%s%s", Keys.PAYMENT_HOST, Keys.PAYMENT_PORT, Keys.PAYMENT_PATH)
+    return runner
@@ -0,0 +1,144 @@
+# Libraries
+import os
+import sys
+import json
+import time
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Files
+import Config as Keys
+
+
+# Last support request of every user, capped in size and expired after a time to live.
+# Once opened with a path the requests are also kept in a local SQLite file and survive restarts,
+# the file is written on a thread of its own so handlers never wait for it.
+class PendingStore:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()      # user id -> (expires at, request, size in bytes), oldest first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+
+        self._db = None
+        self._executor = None
+
+    # Keep the requests in a SQLite file and load the ones still valid, called once at startup
+    def open(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS pending (user_id INTEGER PRIMARY KEY, expires REAL NOT NULL, request TEXT NOT NULL)")
+        self._db.execute("DELETE FROM pending WHERE expires < ?", (time.time(),))
+        self._db.commit()
+        with self._lock:
+            for user_id, expires, request in self._db.execute("SELECT user_id, expires, request FROM pending ORDER BY expires"):
+                self._put(user_id, expires, json.loads(request))
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pending')
+
+    # Runs on the executor, one statement batch after the other in the order they were queued
+    def _write(self, statements):
+        try:
+            for sql, rows in statements:
+                self._db.executemany(sql, rows)
+            self._db.commit()
+        except sqlite3.Error as e:
+            logging.error("Error while saving pending requests: %s", e)
+
+    def _save(self, *statements):
+        if self._executor is not None:
+            self._executor.submit(self._write, statements)
+
+    # Rough footprint of one entry: the request dict and its values
+    @staticmethod
+    def _sizeof(request):
+        return sys.getsizeof(request) + sum(sys.getsizeof(value) for value in request.values())
+
+    def _put(self, user_id, expires, request):
+        old = self._data.pop(user_id, None)
+        if old is not None:
+            self._bytes -= old[2]
+        size = self._sizeof(request)
+        self._data[user_id] = (expires, request, size)
+        self._bytes += size
+
+    def _remove_oldest(self):
+        user_id, entry = self._data.popitem(last=False)
+        self._bytes -= entry[2]
+        return user_id
+
+    # Every entry lives for the same ttl, so expired entries are always at the front
+    def _purge(self, now):
+        removed = []
+        while self._data:
+            if next(iter(self._data.values()))[0] >= now:
+                break
+            removed.append(self._remove_oldest())
+            self.expired += 1
+        while len(self._data) > self.maxsize:
+            removed.append(self._remove_oldest())
+            self.evicted += 1
+        return removed
+
+    def set(self, user_id, request):
+        now = time.time()
+        with self._lock:
+            self._put(user_id, now + self.ttl, request)
+            removed = self._purge(now)
+
+            self._save(("INSERT OR REPLACE INTO pending (user_id, expires, request) VALUES (?, ?, ?)",
+                        [(user_id, now + self.ttl, json.dumps(request, ensure_ascii=False))]),
+                       ("DELETE FROM pending WHERE user_id = ?", [(removed_id,) for removed_id in removed]))
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None or entry[0] < time.time():
+                return None
+            return entry[1]
+
+    def pop(self, user_id):
+        with self._lock:
+            entry = self._data.pop(user_id, None)
+            if entry is None:
+                return None
+            self._bytes -= entry[2]
+            self._save(("DELETE FROM pending WHERE user_id = ?", [(user_id,)]))
+            return entry[1] if entry[0] >= time.time() else None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'memory_bytes': self._bytes + sys.getsizeof(self._data),
+                'expired': self.expired,
+                'evicted': self.evicted,
+            }
+
+
+requests = PendingStore(Keys.PENDING_SIZE, Keys.PENDING_TTL)
+
+# With WORKERS > 1 a request lives in the worker of the user's chat, which has a file of its own (pending-<index>.db).
+# Set by Supervisor to notify(kind, user_id) like Db.notify, so an answer given in the agent's worker reaches it
+notify = None
+
+
+def shard_path(path, index):
+    root, extension = os.path.splitext(path)
+    return f"{root}-{index}{extension}"
+
+
+# Support answered the user, drop its request in whichever worker holds it
+def answered(user_id):
+    requests.pop(user_id)
+    if notify is not None:
+        notify('answered', user_id)
+
+
+# An answered() of another process reached the worker of the user
+def notified(kind, user_id):
+    requests.pop(user_id)
@@ -0,0 +1,41 @@
+# Products for sale: key (also the callback data of the product page) -> details
+PRODUCTS = {
+    'NL_alone_ircell': {
+        'price': 150000,
+        'price_text': '۱۵۰.۰۰۰',
+        'pay_url': 'https://zarinp.al/682933',
+        'back': 'NL_alone',
+    },
+    'NL_alone_hmaval': {
+        'price': 150000,
+        'price_text': '۱۵۰.۰۰۰',
+        'pay_url': 'https://zarinp.al/682932',
+        'back': 'NL_alone',
+    },
+    'NL_family_3': {
+        'price': 400000,
+        'price_text': '۴۰۰.۰۰۰',
+        'pay_url': 'https://zarinp.al/682934',
+        'back': 'NL_family',
+    },
+    'NL_family_5': {
+        'price': 690000,
+        'price_text': '۶۹۰.۰۰۰',
+        'pay_url': 'https://zarinp.al/682935',
+        'back': 'NL_family',
+    },
+}
+
+# Balance top-ups: amount in toman, button text and the fixed payment link used without the payment gateway
+TOP_UPS = [
+    {'amount': 50000, 'text': '50.000', 'pay_url': 'https://zarinp.al/681602'},
+    {'amount': 110000, 'text': '110.000', 'pay_url': 'https://zarinp.al/682929'},
+    {'amount': 150000, 'text': '150.000', 'pay_url': 'https://zarinp.al/682930'},
+    {'amount': 200000, 'text': '200.000', 'pay_url': 'https://zarinp.al/682931'},
+]
+
+# Test configs are kept in the inventory under this key, one per user
+TEST = 'test'
+
+# Keys with configs in the inventory
+INVENTORY = [*PRODUCTS, TEST]
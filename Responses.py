@@ -1,20 +1,123 @@
-# import requests
-# import logging
-# import Config as Keys
+# Libraries
+import re
+import json
+import logging
+import asyncio
+import aiohttp
 
-# Text responses
-def sample_responses(input_text):
-    # Cleaning input
-    last_value = input_text.text
-    user_message = str(last_value).lower()
+# Files
+import Config as Keys
+import Cache
+
+
+DEFAULT_ANSWER = "متوجه نشدم! 🤔"
+
+# Arabic letters typed on Arabic keyboards, Persian and Arabic digits, zero width non joiner, tatweel and diacritics
+_TRANSLATION = str.maketrans({
+    'ي': 'ی', 'ى': 'ی', 'ئ': 'ی', 'ك': 'ک', 'ة': 'ه', 'ۀ': 'ه', 'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ؤ': 'و',
+    **{chr(0x06F0 + digit): str(digit) for digit in range(10)},
+    **{chr(0x0660 + digit): str(digit) for digit in range(10)},
+    '\u200c': ' ', '\u200f': None, '\u200e': None, '\u0640': None,
+    **{chr(mark): None for mark in range(0x064B, 0x0653)},
+})
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_REPEATS = re.compile(r"([^\W\d_])\1{2,}")        # سلاااام -> سلام
+_SPACES = re.compile(r"\s+")
+
+
+# Same text however it was typed: lower case, Persian letters and Latin digits, no punctuation or stretching
+def normalize(text):
+    text = str(text).lower().translate(_TRANSLATION)
+    text = _PUNCTUATION.sub(' ', text)
+    text = _REPEATS.sub(r'\1', text)
+    return _SPACES.sub(' ', text).strip()
+
+
+# Intents loaded from a data file, indexed once:
+# whole messages in a dict, phrases in a trie of words, single keywords in a dict
+class IntentIndex:
+    def __init__(self, intents):
+        self.answers = {}
+        self.messages = {}      # normalized message -> intent
+        self.phrases = {}       # word -> {word -> ...}, None marks the end of a phrase
+        self.keywords = {}      # word -> (-position in the file, intent), earlier intents win ties
+        for order, entry in enumerate(intents):
+            intent = entry['intent']
+            self.answers[intent] = entry['answer']
+            for phrase in entry.get('phrases', ()):
+                words = normalize(phrase).split()
+                self.messages.setdefault(' '.join(words), intent)
+                node = self.phrases
+                for word in words:
+                    node = node.setdefault(word, {})
+                node.setdefault(None, (len(words), -order, intent))    # longer phrases win, then earlier intents
+            for keyword in entry.get('keywords', ()):
+                self.keywords.setdefault(normalize(keyword), (-order, intent))
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, encoding='utf-8') as file:
+                return cls(json.load(file))
+        except (OSError, ValueError) as e:
+            logging.error("Error while loading the intents of %s: %s", path, e)
+            return cls([])
 
-    # Hello
-    if user_message in ('hi', 'hello', 'hey', 'salam', 'slm', 'سلام', 'سلم'):
-        return "سلام ارادت 🫡"
+    # Intent of a normalized message: the whole message, then the longest phrase in it, then the most keywords
+    def match(self, text):
+        intent = self.messages.get(text)
+        if intent is not None:
+            return intent
 
-    # Secret Hello
-    if user_message in ('привет', 'priviet', 'پریویت'):
-        return "Priviet Azizam 🙃❤️"
+        words = text.split()
+        best = None
+        for start in range(len(words)):
+            node = self.phrases
+            for word in words[start:]:
+                node = node.get(word)
+                if node is None:
+                    break
+                if None in node and (best is None or node[None] > best):
+                    best = node[None]
+        if best is not None:
+            return best[2]
+
+        votes = {}
+        for word in words:
+            found = self.keywords.get(word)
+            if found is not None:
+                votes[found] = votes.get(found, 0) + 1
+        if votes:
+            return max(votes, key=lambda found: (votes[found], found[0]))[1]
+        return None
+
+
+index = IntentIndex.load(Keys.FAQ_PATH)
+cache = Cache.TTLCache(Keys.RESPONSE_CACHE_SIZE, Keys.RESPONSE_CACHE_TTL)
+
+
+# Optional slow responder, FALLBACK_URL receives {"text": ...} and answers {"answer": ...}
+async def fallback(text):
+    try:
+        timeout = aiohttp.ClientTimeout(total=Keys.FALLBACK_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.post(Keys.FALLBACK_URL, json={'text': text}) as response:
+                response.raise_for_status()
+                return (await response.json()).get('answer') or None
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        logging.warning("Fallback responder failed: %s", e)
+        return None
+
+
+# Text responses
+async def respond(text):
+    text = normalize(text)
+    intent = index.match(text)
+    if intent is not None:
+        return index.answers[intent]
 
-    else:
-        return "متوجه نشدم! 🤔"
+    if Keys.FALLBACK_URL and text:
+        answer = await cache.read_through(text, lambda: fallback(text))
+        if answer:
+            return answer
+    return DEFAULT_ANSWER
@@ -0,0 +1,253 @@
+# Libraries
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from telebot.asyncio_storage import StateMemoryStorage, StateStorageBase, StateDataContext
+
+# Files
+import Config as Keys
+import Cache
+
+
+# Conversation states kept in a shared backend.
+# Every chat is always handled by the same process (updates are sharded by chat id), so each process
+# keeps the records of its chats in memory: reads cost nothing and writes are sent to the backend in batches.
+# Only chats with a state are kept for the ttl, chats without one are remembered briefly in a small cache of misses.
+class PersistentStateStorage(StateStorageBase):
+    def __init__(self, backend, ttl, batch_size=100, interval=0.5, prefix='telebot', separator=':', miss_size=10000, miss_ttl=10):
+        self.backend = backend
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.interval = interval
+        self.prefix = prefix
+        self.separator = separator
+
+        self._records = {}      # key -> (expires at, {'state': ..., 'data': {...}}, or None until the delete is written)
+        self._misses = Cache.TTLCache(miss_size, miss_ttl)     # keys the backend has no record for
+        self._dirty = set()
+        self._timer = None
+        self._tasks = set()
+
+    def _key(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        return self._get_key(chat_id, user_id, self.prefix, self.separator, business_connection_id, message_thread_id, bot_id)
+
+    async def _load(self, key):
+        entry = self._records.get(key)
+        if entry is not None and entry[0] >= time.time():
+            return entry[1]
+        if self._misses.get(key):
+            return None
+
+        record = await self.backend.load(key)
+        if record is None:
+            self._records.pop(key, None)
+            self._misses.set(key, True)
+        else:
+            self._records[key] = (time.time() + self.ttl, record)
+        return record
+
+    def _store(self, key, record):
+        self._misses.invalidate(key)
+        self._records[key] = (time.time() + self.ttl, record)
+        self._dirty.add(key)
+        if len(self._dirty) >= self.batch_size:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.interval)
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._start_flush)
+
+    def _start_flush(self):
+        self._timer = None
+        task = asyncio.create_task(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    # Send every changed record to the backend in one batch, None deletes the record
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        now = time.time()
+
+        # Forget expired records so memory stays bounded by the active conversations
+        for key in [key for key, entry in self._records.items() if entry[0] < now and key not in keys]:
+            del self._records[key]
+
+        try:
+            await self.backend.write({key: self._records[key][1] for key in keys if key in self._records}, self.ttl)
+        except Exception as e:
+            logging.error("Error while saving %s states, retrying: %s", len(keys), e)
+            self._dirty |= keys
+            if self._timer is None:
+                self._schedule(self.interval)
+            return
+
+        # Deleted records are gone from the backend now, unless the chat got a state again meanwhile
+        for key in keys:
+            entry = self._records.get(key)
+            if entry is not None and entry[1] is None and key not in self._dirty:
+                del self._records[key]
+                self._misses.set(key, True)
+
+    async def set_state(self, chat_id, user_id, state, business_connection_id=None, message_thread_id=None, bot_id=None):
+        if hasattr(state, 'name'):
+            state = state.name
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        record = await self._load(key)
+        self._store(key, {'state': state, 'data': record['data'] if record else {}})
+        return True
+
+    async def get_state(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        record = await self._load(self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id))
+        return record['state'] if record else None
+
+    async def delete_state(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        if await self._load(key) is None:
+            return False
+        self._store(key, None)
+        return True
+
+    async def set_data(self, chat_id, user_id, key, value, business_connection_id=None, message_thread_id=None, bot_id=None):
+        record_key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        record = await self._load(record_key)
+        if record is None:
+            raise RuntimeError(f"PersistentStateStorage: key {record_key} does not exist.")
+        self._store(record_key, {'state': record['state'], 'data': dict(record['data'], **{key: value})})
+        return True
+
+    async def get_data(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        record = await self._load(self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id))
+        return record['data'] if record else {}
+
+    async def reset_data(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        record = await self._load(key)
+        if record is None:
+            return False
+        self._store(key, {'state': record['state'], 'data': {}})
+        return True
+
+    def get_interactive_data(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        return StateDataContext(self, chat_id=chat_id, user_id=user_id, business_connection_id=business_connection_id,
+                                message_thread_id=message_thread_id, bot_id=bot_id)
+
+    async def save(self, chat_id, user_id, data, business_connection_id=None, message_thread_id=None, bot_id=None):
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        record = await self._load(key)
+        if record is None:
+            return False
+        self._store(key, {'state': record['state'], 'data': data})
+        return True
+
+
+# States in a local SQLite file, shared by the processes of one machine.
+# sqlite3 blocks (up to the busy timeout while another process writes), so it runs on its own thread
+class SQLiteBackend:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS states (key TEXT PRIMARY KEY, expires REAL NOT NULL, record TEXT NOT NULL)")
+        self.db.commit()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='states')
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def _load(self, key):
+        row = self.db.execute("SELECT record FROM states WHERE key = ? AND expires >= ?", (key, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    async def load(self, key):
+        return await self._run(self._load, key)
+
+    def _write(self, records, ttl):
+        now = time.time()
+        self.db.executemany("INSERT OR REPLACE INTO states (key, expires, record) VALUES (?, ?, ?)",
+                            [(key, now + ttl, json.dumps(record)) for key, record in records.items() if record is not None])
+        self.db.executemany("DELETE FROM states WHERE key = ?",
+                            [(key,) for key, record in records.items() if record is None])
+        self.db.execute("DELETE FROM states WHERE expires < ?", (now,))
+        self.db.commit()
+
+    async def write(self, records, ttl):
+        await self._run(self._write, records, ttl)
+
+
+# States in Redis, works with any redis.asyncio compatible client
+class RedisBackend:
+    def __init__(self, client):
+        self.client = client
+
+    async def load(self, key):
+        value = await self.client.get(key)
+        return json.loads(value) if value else None
+
+    async def write(self, records, ttl):
+        pipe = self.client.pipeline(transaction=False)
+        for key, record in records.items():
+            if record is None:
+                pipe.delete(key)
+            else:
+                pipe.set(key, json.dumps(record), ex=int(ttl))
+        await pipe.execute()
+
+
+# In-process stand-in for a Redis server, for local runs and the load-test harness
+class FakeRedis:
+    def __init__(self):
+        self.values = {}    # key -> (expires at, value)
+
+    async def get(self, key):
+        entry = self.values.get(key)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    async def set(self, key, value, ex=None):
+        self.values[key] = (time.time() + ex if ex else float('inf'), value)
+        return True
+
+    async def delete(self, *keys):
+        return sum(self.values.pop(key, None) is not None for key in keys)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def set(self, *args, **kwargs):
+        self.commands.append(self.client.set(*args, **kwargs))
+        return self
+
+    def delete(self, *keys):
+        self.commands.append(self.client.delete(*keys))
+        return self
+
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        return [await command for command in commands]
+
+
+# Storage selected by STATE_BACKEND
+def create_storage():
+    if Keys.STATE_BACKEND == 'sqlite':
+        backend = SQLiteBackend(Keys.STATE_DB_PATH)
+    elif Keys.STATE_BACKEND == 'redis':
+        import redis.asyncio
+        backend = RedisBackend(redis.asyncio.from_url(Keys.STATE_REDIS_URL))
+    else:
+        return StateMemoryStorage()
+
+    return PersistentStateStorage(backend, Keys.STATE_TTL, Keys.STATE_BATCH_SIZE, Keys.STATE_FLUSH_INTERVAL)
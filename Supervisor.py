@@ -0,0 +1,189 @@
+# Libraries
+import queue
+import asyncio
+import logging
+import aiohttp
+import multiprocessing
+from collections import OrderedDict
+from telebot import asyncio_helper
+
+# Files
+import Config as Keys
+import Database as Db
+import Pending
+import Webhook
+import Outbox
+import Log
+import Metrics
+
+
+# Runs N worker processes and routes every update by chat id, so the updates of one chat are handled
+# by one process in order. Updates stay tracked until their worker acknowledges them: a crashed worker
+# is restarted and gets everything it had not finished yet.
+# Workers cache the users of their chats, a write to a user made elsewhere is passed to its worker as a notice.
+class Supervisor:
+    def __init__(self, target, workers, capacity):
+        self.target = target        # target(index, updates, acks, logs, notices, send_slots), runs inside the worker process
+        self.capacity = capacity    # unfinished updates per worker before submit() refuses more
+        self.context = multiprocessing.get_context('spawn')
+        self.acks = self.context.Queue()
+        self.logs = self.context.Queue()       # log records of the workers, written by this process
+        self.notices = self.context.Queue()    # (kind, user id) of the workers, for the worker of that user
+        self.send_slots = self.context.Value('d', 0.0)      # global send limit of all the processes, see Outbox.share
+        self.processes = [None] * workers
+        self.queues = [None] * workers
+        self.unacked = [OrderedDict() for _ in range(workers)]     # update id -> update, in delivery order
+
+    def _start(self, index):
+        updates = self.context.Queue()
+        process = self.context.Process(target=self.target, args=(index, updates, self.acks, self.logs, self.notices, self.send_slots),
+                                       name=f"mochi-worker-{index}", daemon=True)
+        process.start()
+        self.queues[index] = updates
+        self.processes[index] = process
+
+        # Redeliver what the previous process of this slot did not finish
+        for update in self.unacked[index].values():
+            updates.put(update)
+
+    def start(self):
+        Log.listen(self.logs)
+        Outbox.outbox.share(self.send_slots)
+        Metrics.gauge('bot_worker_unfinished', 'Updates sent to a worker process and not finished yet', ('worker',),
+                      lambda: {(index,): len(unacked) for index, unacked in enumerate(self.unacked)})
+        for index in range(len(self.processes)):
+            self._start(index)
+        logging.info("Supervisor started %s workers", len(self.processes))
+
+    def _drain_acks(self):
+        while True:
+            try:
+                index, update_id = self.acks.get_nowait()
+            except queue.Empty:
+                return
+            self.unacked[index].pop(update_id, None)
+
+    # Notices are not tracked, a restarted worker starts with empty caches anyway
+    def notify(self, kind, user_id):
+        self.queues[user_id % len(self.processes)].put((kind, user_id))
+
+    def _drain_notices(self):
+        while True:
+            try:
+                kind, user_id = self.notices.get_nowait()
+            except queue.Empty:
+                return
+            self.notify(kind, user_id)
+
+    # Returns False when the worker of this chat is full
+    def submit(self, update):
+        index = Webhook.chat_id_of(update) % len(self.processes)
+        if len(self.unacked[index]) >= self.capacity:
+            self._drain_acks()
+            if len(self.unacked[index]) >= self.capacity:
+                return False
+
+        self.unacked[index][update['update_id']] = update
+        self.queues[index].put(update)
+        return True
+
+    # Collect acknowledgements, pass notices on and restart crashed workers
+    async def monitor(self):
+        while True:
+            self._drain_acks()
+            self._drain_notices()
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logging.error("Worker %s exited with code %s, restarting with %s unfinished updates",
+                                  index, process.exitcode, len(self.unacked[index]))
+                    self._start(index)
+            await asyncio.sleep(0.05)
+
+    def stop(self):
+        for updates in self.queues:
+            updates.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+    # Long polling in the supervisor, workers never talk to getUpdates
+    async def poll(self):
+        offset = None
+        retry_delay = 5
+        while True:
+            try:
+                updates = await asyncio_helper.get_updates(Keys.API_KEY, offset=offset, timeout=20, request_timeout=25)
+                retry_delay = 5
+            except (asyncio_helper.ApiException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.error("Request exception: %s", e)
+                logging.info('Retrying in %s seconds...', retry_delay)
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 300)  # Exponential backoff with a maximum delay of 5 minutes
+                continue
+
+            for update in updates:
+                while not self.submit(update):
+                    await asyncio.sleep(0.05)
+                offset = update['update_id'] + 1
+
+
+# What a worker does with the notices for its users, see Db.notify and Pending.notify
+NOTICES = {
+    'invalidate': Db.notified,
+    'forget': Db.notified,
+    'answered': Pending.notified,
+}
+
+
+# Inside a worker process: hand updates from the supervisor to the bot and acknowledge them when done.
+# Writes to users of other workers are sent to them through the supervisor, notices for this worker's users are applied
+async def work(bot, index, updates, acks, notices, send_slots):
+    loop = asyncio.get_running_loop()
+    Outbox.outbox.share(send_slots)
+
+    def notify(kind, user_id):
+        if user_id % Keys.WORKERS != index:
+            notices.put((kind, user_id))
+    Db.notify = Pending.notify = notify
+
+    pool = Webhook.WorkerPool(bot, Keys.WEBHOOK_WORKERS, Keys.WEBHOOK_QUEUE_SIZE,
+                              on_done=lambda update: acks.put((index, update['update_id'])))
+    pool.start()
+
+    while True:
+        update = await loop.run_in_executor(None, updates.get)
+        if update is None:
+            break
+        if isinstance(update, tuple):
+            NOTICES[update[0]](*update)
+            continue
+        while not pool.submit(update):
+            await asyncio.sleep(0.01)
+
+    await pool.stop()
+
+
+# Run the supervisor in the configured mode until cancelled
+async def serve(bot, target):
+    supervisor = Supervisor(target, Keys.WORKERS, max(1, Keys.WEBHOOK_QUEUE_SIZE // Keys.WORKERS))
+    supervisor.start()
+    # Payment callbacks are settled in this process, the worker of the user drops what it cached
+    Db.notify = supervisor.notify
+    monitor = asyncio.create_task(supervisor.monitor())
+    metrics = await Metrics.serve(Keys.METRICS_PORT)
+
+    runner = None
+    try:
+        if Keys.RUN_MODE == 'webhook':
+            runner = await Webhook.start(bot, supervisor)
+            await asyncio.Event().wait()
+        else:
+            await bot.remove_webhook()
+            await supervisor.poll()
+    finally:
+        monitor.cancel()
+        await Metrics.stop(*metrics)
+        if runner is not None:
+            await runner.cleanup()
+        supervisor.stop()
@@ -0,0 +1,117 @@
+# Libraries
+import string
+
+# Files
+import Description as Des
+
+
+# Escapers for values inserted into a formatted message by parse mode, one str.translate each
+ESCAPES = {
+    None: None,
+    'HTML': str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;'}),
+}
+
+
+# Description texts are indented in their source, drop the trailing spaces that leaves on every line
+def _clean(text):
+    return '\n'.join(line.rstrip() for line in text.split('\n'))
+
+
+# A message format parsed once: literal parts and the names of the values between them.
+# Values are escaped for the parse mode the message is sent with, the literal parts are written in it.
+class Template:
+    def __init__(self, source, parse_mode=None, cache_size=0):
+        self.parse_mode = parse_mode
+        self._escape = ESCAPES[parse_mode]
+        self._parts = []
+        for literal, field, _, _ in string.Formatter().parse(_clean(source)):
+            if literal:
+                self._parts.append((literal, None))
+            if field is not None:
+                self._parts.append((None, field))
+
+        # Templates rendered with few distinct values (a product page per product) keep their results
+        self._cache_size = cache_size
+        self._cache = {}
+
+    def render(self, **values):
+        if self._cache_size:
+            key = tuple(sorted(values.items()))
+            text = self._cache.get(key)
+            if text is None:
+                text = self._render(values)
+                if len(self._cache) < self._cache_size:
+                    self._cache[key] = text
+            return text
+        return self._render(values)
+
+    def _render(self, values):
+        escape = self._escape
+        pieces = []
+        for literal, field in self._parts:
+            if field is None:
+                pieces.append(literal)
+            elif escape is None:
+                pieces.append(str(values[field]))
+            else:
+                pieces.append(str(values[field]).translate(escape))
+        return ''.join(pieces)
+
+
+# Static messages, sent without a parse mode
+start = _clean(Des.start_description)
+buy_one = _clean(Des.buy_one_description)
+buy_two = _clean(Des.buy_two_description)
+buy_three = _clean(Des.buy_three_description)
+buy_four = _clean(Des.buy_four_description)
+test_config = _clean(Des.test_config_description)
+receipt = _clean(Des.receipt_description)
+guide = _clean(Des.help_description)
+funds = _clean(Des.funds_description)
+admin = _clean(Des.admin_description)
+vip = _clean(Des.VIP_description)
+mahsa = _clean(Des.mahsa_description)
+config_ready = "🛑 کانفیگ زیر را کپی کنید یا QR کد آن را با برنامه V2ray اسکن کنید"
+
+# Messages with values
+product_page = Template("قیمت: {price} تومان 🪙" + Des.transaction_description, cache_size=64)
+config = Template("<code>{config}</code>", 'HTML')            # tap to copy
+low_stock = Template("⚠️ Low stock: {product}, {count} unused configs left.\nAdd more with /import {product}")
+import_done = Template("✅ {count} configs added to {product}.")
+payment = Template("💳 مبلغ: {amount} تومان\n\nبا دکمه زیر پرداخت کنید، نتیجه بلافاصله بعد از پرداخت همینجا اعلام می‌شود. ⬇")
+top_up_done = Template("✅ پرداخت تایید شد و {amount} تومان به موجودی شما اضافه شد. 🪙")
+profile = Template("""پروفایل من 👩‍🦰🧑‍🦰
+
+🌐 شناسه کاربری: {user_id}
+🍀 یوزرنیم: {username}
+🍷 نام: {name}
+💰 موجودی: {balance}
+
+-----------------------------------------------------------------------
+
+کانفیگ های خریداری شده ⬇
+{history}""")
+
+# Ledger entries in the profile, newest first
+LEDGER_KINDS = {
+    'opening': '📒 موجودی اولیه',
+    'bonus': '🎁 هدیه',
+    'referral': '🎖 ریفرال',
+    'top_up': '💰 افزایش موجودی',
+    'purchase': '🛒 خرید',
+    'order': '🌐 خرید اینترنتی',
+    'admin': '✏️ اصلاح موجودی',
+}
+history_entry = Template("{date} {kind}{note}\n      {amount} ← {balance} 🪙")
+history_empty = "هنوز تراکنشی ندارید."
+
+referral = Template("🎖 لینک رفرال: https://t.me/MochiServer_bot?start={user_id}\n👥 دعوت‌های شما: {referrals}" + Des.discount_description)
+referral_reward = Template("🎖 {name} با لینک شما وارد شد و {amount} تومان به موجودی شما اضافه شد. 🪙")
+leaderboard_entry = Template("{rank}. {name} ({user_id}): {referrals} دعوت، {rewarded} تومان")
+
+# Support notifications, user input is escaped for HTML
+support_header = Template("🎫 Ticket #{ticket_id}\nRecived a message from: <code>{user_id}</code>\nName: {name}\nUsername: @{username}\n\n", 'HTML')
+support_header_without_ticket = Template("Recived a message from: <code>{user_id}</code>\nName: {name}\nUsername: @{username}\n\n", 'HTML')
+support_request = Template("Message text:\n{text}", 'HTML')
+support_test = Template("Message text: Request Test Config 🏴‍☠", 'HTML')
+support_order = Template("Message text:\nPayment successful, please send the config.\nOrder: {order_id} ({product})\nAmount paid: {price} تومان", 'HTML')
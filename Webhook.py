@@ -0,0 +1,123 @@
+# Libraries
+import ssl
+import json
+import asyncio
+import logging
+import telebot
+from aiohttp import web
+
+# Files
+import Config as Keys
+import Metrics
+
+
+# Chat id of a raw update, every update of a chat goes to the same worker so its order is kept
+def chat_id_of(update):
+    for key, value in update.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        if 'chat' in value:
+            return value['chat']['id']
+        if isinstance(value.get('message'), dict):
+            return value['message']['chat']['id']
+        if 'from' in value:
+            return value['from']['id']
+    return update.get('update_id', 0)
+
+
+# Bounded pool of worker tasks, one queue per worker
+class WorkerPool:
+    def __init__(self, bot, workers, queue_size, on_done=None):
+        self.bot = bot
+        self.on_done = on_done      # called with every raw update once it was handled
+        self.queues = [asyncio.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+        self.tasks = []
+        Metrics.gauge('bot_update_queue', 'Updates waiting for a worker task', (), lambda: {(): sum(q.qsize() for q in self.queues)})
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._work(q)) for q in self.queues]
+
+    async def stop(self):
+        for q in self.queues:
+            await q.put(None)
+        await asyncio.gather(*self.tasks)
+
+    # Returns False when the worker queue is full so the caller can ask Telegram to retry
+    def submit(self, update):
+        q = self.queues[chat_id_of(update) % len(self.queues)]
+        try:
+            q.put_nowait(update)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def _work(self, q):
+        while True:
+            update = await q.get()
+            if update is None:
+                return
+            try:
+                await self.bot.process_new_updates([telebot.types.Update.de_json(update)])
+            except Exception as e:
+                logging.error("Error while processing update %s: %s", update.get('update_id'), e)
+            if self.on_done is not None:
+                self.on_done(update)
+
+
+# HTTP endpoint receiving updates from Telegram
+async def handle_update(request):
+    if Keys.WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != Keys.WEBHOOK_SECRET:
+        return web.Response(status=403)
+
+    try:
+        update = json.loads(await request.read())
+    except ValueError:
+        return web.Response(status=400)
+
+    if not isinstance(update, dict):
+        return web.Response(status=400)
+
+    # Acknowledge right away, the update is handled by the worker pool
+    if not request.app['pool'].submit(update):
+        logging.warning("Webhook queue full, update %s rejected", update.get('update_id'))
+        return web.Response(status=503)
+    return web.Response()
+
+
+# Start the endpoint, updates go to pool.submit(update), returns the runner to clean up
+async def start(bot, pool):
+    app = web.Application()
+    app['pool'] = pool
+    app.router.add_post(Keys.WEBHOOK_PATH, handle_update)
+
+    context = None
+    if Keys.WEBHOOK_CERT and Keys.WEBHOOK_KEY:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(Keys.WEBHOOK_CERT, Keys.WEBHOOK_KEY)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, Keys.WEBHOOK_HOST, Keys.WEBHOOK_PORT, ssl_context=context).start()
+
+    # Without a public url the endpoint only serves local requests (useful for replaying recorded updates)
+    if Keys.WEBHOOK_URL:
+        await bot.remove_webhook()
+        await bot.set_webhook(url=Keys.WEBHOOK_URL + Keys.WEBHOOK_PATH,
+                              secret_token=Keys.WEBHOOK_SECRET or None,
+                              max_connections=100)
+
+    logging.info("Webhook listening on %s:%s%s", Keys.WEBHOOK_HOST, Keys.WEBHOOK_PORT, Keys.WEBHOOK_PATH)
+    return runner
+
+
+# Run the bot in webhook mode until cancelled
+async def serve(bot):
+    pool = WorkerPool(bot, Keys.WEBHOOK_WORKERS, Keys.WEBHOOK_QUEUE_SIZE)
+    pool.start()
+
+    runner = await start(bot, pool)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await pool.stop()
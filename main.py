@@ -1,671 +1,1103 @@
 # Libraries
-import re
-import time
-import requests
+import asyncio
+import datetime
 import telebot
 import logging
+import aiohttp
 import mysql.connector
-from telebot.storage import StateMemoryStorage
-from telebot.handler_backends import State, StatesGroup
-from telebot import custom_filters
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_handler_backends import State, StatesGroup
+from telebot import asyncio_filters
 
 # Files
-import Description as Des
+import Templates
 import Config as Keys
 import Responses as Res
-
-# Configure the logger
-logging.basicConfig(
-    level=logging.INFO,                                             # Set level to INFO to log startup messages
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',  # Include timestamp, log level, and message
-    handlers=[
-        logging.FileHandler("bot.log"),                             # Log messages into a file
-        logging.StreamHandler()                                     # Also log messages to the console
-    ]
-)
+import Database as Db
+import Webhook
+import Supervisor
+import Outbox
+import Log
+import Metrics
+import Menus
+import Media
+import Products
+import Pending
+import Payments
+import States
+from Router import Router
+
+# Configure the logger, records are written to bot.log and the console by a background thread
+Log.setup()
 
 
 # Create a bot object
-state_storage = StateMemoryStorage()
+state_storage = States.create_storage()
 
-bot = telebot.TeleBot(Keys.API_KEY, state_storage=state_storage)
+bot = AsyncTeleBot(Keys.API_KEY, state_storage=state_storage)
 logging.info('Start bot...')
 
+# Every message goes through the rate limited outbox
+Outbox.outbox.install()
+broadcasts = set()
+
+# Callback routes
+router = Router()
+
 
 # States
 class buy(StatesGroup):
     request = State()
     respond = State()
+    edit = State()
+    broadcast = State()
+    import_configs = State()
 
 
-# Function to escape all special characters with a backslash
-def escape_special_characters(text):
-    special_characters = r"([\*\_\[\]\(\)\~\`\>\#\+\-\=\|\{\}\.\!])"
-    return re.sub(special_characters, r'\\\1', text)
-
-
-# fetch data
-def balance_fetch(user_id):
+# fetch balance
+async def balance_fetch(user_id):
     try:
-        with mysql.connector.connect(**Keys.db_config) as connection:
-            with connection.cursor() as cursor:
-                sql = "SELECT * FROM users WHERE id = %s"
-                cursor.execute(sql, (user_id,))
-                result = cursor.fetchall()
-                if result:
-                    return result
-                else:
-                    return [(None, None, None, None, 0)]  # Default balance if user not found
+        user = await Db.get_user(user_id)
+        if user:
+            return user[4]
+        else:
+            return 0  # Default balance if user not found
 
     except Exception as e:
-        logging.error(f"Error while fetching data: {e}")
-        return [(None, None, None, None, 0)]  # Default balance in case of error
+        logging.error("Error while fetching data: %s", e)
+        return 0  # Default balance in case of error
 
 
 # /start Command
 @bot.message_handler(commands=['start'])
-def start_command(user_message):
-    # check or create user in database
+async def start_command(user_message):
+    # check or create user in database, new users opening the referral link of a user get the referral bonus
     try:
-        with mysql.connector.connect(**Keys.db_config) as connection:
-            with connection.cursor() as cursor:
-                sql = "INSERT INTO users (id, username, first_name, last_name) VALUES (%s, %s, %s, %s)"
-                values = (user_message.chat.id, user_message.chat.username, user_message.chat.first_name, user_message.chat.last_name)
-                cursor.execute(sql, values)
-                connection.commit()
+        referrer_id = await referrer_of(user_message)
+        if await Db.register_user(user_message.chat, balance=Keys.REFERRAL_BONUS if referrer_id else 0):
+            logging.info("User %s added to database", user_message.chat.id)
+            if referrer_id:
+                await reward_referrer(referrer_id, user_message.chat)
+        else:
+            await bot.send_message(user_message.chat.id, "بازگشت به منو 🏡")
+
+    except mysql.connector.Error as err:
+        logging.error("Error while registering user: %s", err)
 
-                token = user_message.text.split()
-                if len(token) > 1:
-                    sql = "UPDATE users SET balance = balance + 40000 WHERE id = %s"
-                    cursor.execute(sql, (user_message.chat.id,))
-                    connection.commit()
+    await bot.send_message(chat_id=user_message.chat.id, text=Templates.start, reply_markup=Menus.main_menu.markup(user_message.chat.id))
+    await bot.delete_state(user_id=user_message.from_user.id, chat_id=user_message.chat.id)
 
-        logging.info(f"User {user_message.chat.id} added to database")
 
+# Referrer in a /start <id> link, only an existing user other than the new one counts
+async def referrer_of(user_message):
+    token = user_message.text.split()
+    if len(token) < 2 or not token[1].isdigit() or int(token[1]) == user_message.chat.id:
+        return None
+    referrer_id = int(token[1])
+    return referrer_id if await Db.get_user(referrer_id) else None
+
+
+# Store the referral of a new user and reward the referrer, once per referred user
+async def reward_referrer(referrer_id, chat):
+    try:
+        if not await Db.add_referral(chat.id, referrer_id, Keys.REFERRER_REWARD):
+            return
     except mysql.connector.Error as err:
-        logging.error(f"User already exist: {err}")
-        bot.send_message(user_message.chat.id, "بازگشت به منو 🏡")
+        logging.error("Error while adding the referral of %s by %s: %s", chat.id, referrer_id, err)
+        return
 
-    # Create Buttons
-    first_button = telebot.types.InlineKeyboardButton('🔑 کانفیگ تستی', callback_data='start_test')
-    second_button = telebot.types.InlineKeyboardButton('🛒 خرید کانفیگ', callback_data='start_buy')
-    third_button = telebot.types.InlineKeyboardButton('👩‍🧑‍🦰 پروفایل من', callback_data='start_profile')
-    fourth_button = telebot.types.InlineKeyboardButton('📋 راهنمای استفاده', callback_data='start_help')
-    fifth_button = telebot.types.InlineKeyboardButton('🎁 تخفیف ریفرال', callback_data='start_discount')
-    sixth_button = telebot.types.InlineKeyboardButton('💰 افزایش موجودی', callback_data='start_funds')
-    seventh_button = telebot.types.InlineKeyboardButton('💻 Admin Panel 💻', callback_data='admin')
-    eighth_button = telebot.types.InlineKeyboardButton('🌟 VIP 🌟', callback_data='vip')
-    nineth_button = telebot.types.InlineKeyboardButton('❤️ Mahsa ❤️', callback_data='mahsa')
+    logging.info("User %s referred by %s", chat.id, referrer_id)
+    if Keys.REFERRER_REWARD:
+        await bot.send_message(chat_id=referrer_id, text=Templates.referral_reward.render(name=chat.first_name, amount=f"{Keys.REFERRER_REWARD:,}"))
 
-    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
 
-    if user_message.chat.id in Keys.ADMIN_ID:
-        glass_markup.add(seventh_button)
-        glass_markup.add(eighth_button, nineth_button, first_button, second_button, third_button, fourth_button, fifth_button, sixth_button)
+# Open a ticket and send the request to the least busy support agent, `text` is rendered from a support template
+async def send_to_support(user, kind, text, photo=None, order_id=None):
+    glass_markup = None
 
-    elif user_message.chat.id in Keys.VIPS_ID:
-        glass_markup.add(eighth_button)
-        glass_markup.add(first_button, second_button, third_button, fourth_button, fifth_button, sixth_button)
+    try:
+        ticket_id, agent_id = await Db.open_ticket(user.id, kind, Keys.SUPPORT_IDS, order_id)
+        first_button = telebot.types.InlineKeyboardButton("Send Config", callback_data=f"answer_{ticket_id}")
+        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+        glass_markup.add(first_button)
+        header = Templates.support_header.render(ticket_id=ticket_id, user_id=user.id, name=user.first_name, username=user.username)
 
-    elif user_message.chat.id == Keys.MAHSA_ID:
-        glass_markup.add(nineth_button)
-        glass_markup.add(first_button, second_button, third_button, fourth_button, fifth_button, sixth_button)
+    # Without a ticket the request still reaches support, it is answered by hand
+    except mysql.connector.Error as err:
+        logging.error("Error while opening a ticket for %s: %s", user.id, err)
+        agent_id = Keys.SUPPORT_IDS[0]
+        header = Templates.support_header_without_ticket.render(user_id=user.id, name=user.first_name, username=user.username)
 
+    if photo is not None:
+        await bot.send_photo(chat_id=agent_id, photo=photo, caption=header + text, parse_mode='HTML', reply_markup=glass_markup)
     else:
-        glass_markup.add(first_button, second_button, third_button, fourth_button, fifth_button, sixth_button)
-
-    bot.send_message(chat_id=user_message.chat.id, text=Des.start_description, reply_markup=glass_markup)
-    bot.delete_state(user_id=user_message.from_user.id, chat_id=user_message.chat.id)
+        await bot.send_message(chat_id=agent_id, text=header + text, parse_mode='HTML', reply_markup=glass_markup)
 
 
-# Handling requests
-@bot.callback_query_handler(func=lambda call: call.data == "answer")
-def answer(call):
-    pattern = r"Recived a message from: (\d+)"  # Extract user id from the message
-    user_id_match = re.findall(pattern=pattern, string=call.message.caption if call.message.caption else call.message.text)
-    
-    if not user_id_match:
-        bot.send_message(chat_id=call.message.chat.id, text="User ID not found in the message.")
+# Handling requests, the ticket says who is waiting for the answer
+@router.prefix('answer_', clear=False, answers=True)
+async def answer(call, ticket_id):
+    ticket = await Db.get_ticket(int(ticket_id))
+    if ticket is None or ticket[3] == 'closed':
+        await alert(call, "✅ این درخواست قبلاً پاسخ داده شده است.", show_alert=False)
         return
-    
-    user = user_id_match[0]
 
-    bot.send_message(chat_id=call.message.chat.id, text=f"Send your answer to: {user}", reply_markup=telebot.types.ForceReply())
-    bot.set_state(user_id=call.from_user.id, state=buy.respond, chat_id=call.message.chat.id)
+    await Db.take_ticket(ticket[0], call.from_user.id)
+    await show(call, text=f"Send your answer to: {ticket[1]} (ticket #{ticket[0]})", reply_markup=telebot.types.ForceReply())
+    await bot.set_state(user_id=call.from_user.id, state=buy.respond, chat_id=call.message.chat.id)
+    await bot.add_data(user_id=call.from_user.id, chat_id=call.message.chat.id, ticket_id=ticket[0], ticket_user_id=ticket[1])
+
+
+# answer buttons sent before tickets carry no id, these requests are answered by hand
+@router.route('answer', clear=False, answers=True)
+async def answer_without_ticket(call):
+    await alert(call, "❌ این درخواست تیکت ندارد، لطفاً مستقیم به کاربر پاسخ دهید.", show_alert=True)
 
 
 # User info and actions
-@bot.callback_query_handler(func=lambda call: call.data.startswith('user_'))
-def user_info(call):
-    user_id = call.data.split('_')[1]
-    
+@router.prefix('user_')
+async def user_info(call, user_id):
     try:
-        with mysql.connector.connect(**Keys.db_config) as connection:
-            with connection.cursor() as cursor:
-                cursor.execute("SELECT id, username, first_name, last_name, balance FROM users WHERE id = %s", (user_id,))
-                user = cursor.fetchone()
-                
-                if user:
-                    text = f"""👤 اطلاعات کاربر:
+        user = await Db.get_user(int(user_id))
+
+        if user:
+            text = f"""👤 اطلاعات کاربر:
                     🌐 شناسه کاربری: {user[0]}
                     🍀 یوزرنیم: {user[1]}
                     🍷 نام: {user[2]}
                     🍷 نام خانوادگی: {user[3]}
                     💰 موجودی: {user[4]}"""
 
-                    edit_button = telebot.types.InlineKeyboardButton("✏️ ویرایش اطلاعات", callback_data=f"edit_{user[0]}")
-                    block_button = telebot.types.InlineKeyboardButton("🚫 مسدود کردن", callback_data=f"block_{user[0]}")
-                    back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='admin')
+            edit_button = telebot.types.InlineKeyboardButton("✏️ ویرایش اطلاعات", callback_data=f"edit_{user[0]}")
+            block_button = telebot.types.InlineKeyboardButton("🚫 مسدود کردن", callback_data=f"block_{user[0]}")
+            back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='admin')
 
-                    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-                    glass_markup.add(edit_button, block_button)
-                    glass_markup.add(back_button)
+            glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+            glass_markup.add(edit_button, block_button)
+            glass_markup.add(back_button)
 
-                    bot.send_message(chat_id=call.message.chat.id, text=text, reply_markup=glass_markup)
-                else:
-                    bot.send_message(chat_id=call.message.chat.id, text="❌ کاربر یافت نشد.")
+            await show(call, text=text, reply_markup=glass_markup)
+        else:
+            await show(call, text="❌ کاربر یافت نشد.")
 
     except Exception as e:
-        logging.error(f"Error while fetching user info: {e}")
-        bot.send_message(chat_id=call.message.chat.id, text="❌ خطا در دریافت اطلاعات کاربر.")
+        logging.error("Error while fetching user info: %s", e)
+        await show(call, text="❌ خطا در دریافت اطلاعات کاربر.")
 
 
 # Edit user info
-@bot.callback_query_handler(func=lambda call: call.data.startswith('edit_'))
-def edit_user(call):
-    try:
-        bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
-    except Exception as e:
-        logging.error(f"Error while deleting message: {e}")
-
-    user_id = call.data.split('_')[1]
-    bot.send_message(chat_id=call.message.chat.id, text=f"✏️ اطلاعات جدید کاربر {user_id} را وارد کنید (فرمت: username,first_name,last_name,balance):")
-    bot.set_state(user_id=call.from_user.id, state=buy.request, chat_id=call.message.chat.id)
-    Keys.edit_user_id = user_id
+@router.prefix('edit_', clear=True)
+async def edit_user(call, user_id):
+    await show(call, text=f"✏️ اطلاعات جدید کاربر {user_id} را وارد کنید (فرمت: username,first_name,last_name,balance):")
+    await bot.set_state(user_id=call.from_user.id, state=buy.edit, chat_id=call.message.chat.id)
+    await bot.add_data(user_id=call.from_user.id, chat_id=call.message.chat.id, edit_user_id=user_id)
 
 
 # Block user
-@bot.callback_query_handler(func=lambda call: call.data.startswith('block_'))
-def block_user(call):
-    user_id = call.data.split('_')[1]
-    
+@router.prefix('block_')
+async def block_user(call, user_id):
     try:
-        with mysql.connector.connect(**Keys.db_config) as connection:
-            with connection.cursor() as cursor:
-                cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
-                connection.commit()
+        await Db.ensure_user(int(user_id))
+        await Db.execute("DELETE FROM users WHERE id = %s", (user_id,))
+        Db.forget_user(int(user_id))
 
-        bot.send_message(chat_id=call.message.chat.id, text="🚫 کاربر با موفقیت مسدود شد.")
+        await show(call, text="🚫 کاربر با موفقیت مسدود شد.")
     
     except Exception as e:
-        logging.error(f"Error while blocking user: {e}")
-        bot.send_message(chat_id=call.message.chat.id, text="❌ خطا در مسدود کردن کاربر.")
+        logging.error("Error while blocking user: %s", e)
+        await show(call, text="❌ خطا در مسدود کردن کاربر.")
 
 
-# Callbacks
+# Callbacks, every callback data is dispatched through the router
 @bot.callback_query_handler(func=lambda call: True)
-def callback(call):
+async def callback(call):
+    handler, argument, clear, answers = router.resolve(call.data)
+    if handler is not None:
+        Log.name(handler.__name__)
+
+    # Stop the client's spinner right away while the handler runs, unless the handler may answer with a notice
+    answering = None if answers else asyncio.create_task(answer_quietly(call.id))
+
+    # The first show(call, ...) of a clearing route edits the clicked message instead of sending a new one
+    call.replace = clear
+
+    if handler is None:
+        await alert(call, "🔴🔴🔴 Unknown 🔴🔴🔴", show_alert=False)
+    elif argument is None:
+        await handler(call)
+    else:
+        await handler(call, argument)
+
+    # Nothing took the place of the clicked message (media was sent, or only an alert), remove it
+    if call.replace:
+        try:
+            await bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
+        except Exception as e:
+            logging.info("Error while deleting message: %s", e)
+
+    if answering is not None:
+        await answering
+    elif not getattr(call, 'answered', False):
+        await answer_quietly(call.id)
+
+
+async def answer_quietly(callback_query_id):
     try:
-        bot.delete_message(chat_id=call.message.chat.id, message_id=call.message.message_id)
+        await bot.answer_callback_query(callback_query_id)
     except Exception as e:
-        logging.error(f"Error while deleting message: {e}")
-
-    # Back home
-    if call.data == 'BACK_HOME':
-        # Create Buttons
-        first_button = telebot.types.InlineKeyboardButton('🔑 کانفیگ تستی', callback_data='start_test')
-        second_button = telebot.types.InlineKeyboardButton('🛒 خرید کانفیگ', callback_data='start_buy')
-        third_button = telebot.types.InlineKeyboardButton('👩‍🧑‍🦰 پروفایل من', callback_data='start_profile')
-        fourth_button = telebot.types.InlineKeyboardButton('📋 راهنمای استفاده', callback_data='start_help')
-        fifth_button = telebot.types.InlineKeyboardButton('🎁 تخفیف ریفرال', callback_data='start_discount')
-        sixth_button = telebot.types.InlineKeyboardButton('💰 افزایش موجودی', callback_data='start_funds')
-        seventh_button = telebot.types.InlineKeyboardButton('💻 Admin Panel 💻', callback_data='admin')
-        eighth_button = telebot.types.InlineKeyboardButton('🌟 VIP 🌟', callback_data='vip')
-        nineth_button = telebot.types.InlineKeyboardButton('❤️ Mahsa ❤️', callback_data='mahsa')
+        logging.info("Error while answering callback query: %s", e)
 
-        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
 
-        if call.message.chat.id in Keys.ADMIN_ID:
-            glass_markup.add(seventh_button)
-            glass_markup.add(eighth_button, nineth_button, first_button, second_button, third_button, fourth_button, fifth_button, sixth_button)
+# Answer a click with a notice, routes registered with answers=True call this before the query is answered for them
+async def alert(call, text, show_alert=False):
+    call.answered = True
+    await bot.answer_callback_query(call.id, text, show_alert=show_alert)
 
-        elif call.message.chat.id in Keys.VIPS_ID:
-            glass_markup.add(eighth_button)
-            glass_markup.add(first_button, second_button, third_button, fourth_button, fifth_button, sixth_button)
 
-        elif call.message.chat.id == Keys.MAHSA_ID:
-            glass_markup.add(nineth_button)
-            glass_markup.add(first_button, second_button, third_button, fourth_button, fifth_button, sixth_button)
+# Show a message in answer to a click: replaces the clicked message when the route clears it,
+# text messages are edited in place and media messages, which cannot become text, are deleted after a new send
+async def show(call, text, reply_markup=None, parse_mode=None):
+    message = call.message
+    if getattr(call, 'replace', False) and getattr(message, 'content_type', None) == 'text':
+        try:
+            await bot.edit_message_text(text, chat_id=message.chat.id, message_id=message.message_id,
+                                        reply_markup=reply_markup, parse_mode=parse_mode)
+            call.replace = False
+            return
+        except telebot.asyncio_helper.ApiTelegramException as e:
+            # Same menu clicked twice, it is already shown
+            if 'message is not modified' in e.description:
+                call.replace = False
+                return
+            logging.info("Error while editing message, sending it instead: %s", e)
 
-        else:
-            glass_markup.add(first_button, second_button, third_button, fourth_button, fifth_button, sixth_button)
+    await bot.send_message(chat_id=message.chat.id, text=text, reply_markup=reply_markup, parse_mode=parse_mode)
 
-        bot.send_message(chat_id=call.message.chat.id, text=Des.start_description, reply_markup=glass_markup)
-        # bot.delete_state(user_id=call.message.from_user.id, chat_id=call.message.chat.id)
 
-    # Buy config
-    elif call.data == 'start_buy':
-        first_button = telebot.types.InlineKeyboardButton('اتریش 🇦🇹', callback_data='buy_NL')
-        back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME')
+# Back home
+@router.route('BACK_HOME')
+async def back_home(call):
+    await show(call, text=Templates.start, reply_markup=Menus.main_menu.markup(call.message.chat.id))
+    # await bot.delete_state(user_id=call.message.from_user.id, chat_id=call.message.chat.id)
 
-        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-        glass_markup.add(first_button)
-        glass_markup.add(back_button)
 
-        bot.send_message(chat_id=call.message.chat.id, text=Des.buy_one_description, reply_markup=glass_markup)
+# Buy config
+@router.route('start_buy')
+async def start_buy(call):
+    first_button = telebot.types.InlineKeyboardButton('اتریش 🇦🇹', callback_data='buy_NL')
+    back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME')
 
-    # Test config
-    elif call.data == 'start_test':
-        first_button = telebot.types.InlineKeyboardButton('ایرانسل - رایتل 🎏️', callback_data='request_test')
-        second_button = telebot.types.InlineKeyboardButton('همراه اول - مخابرات 🎏', callback_data='request_test')
-        back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME')
+    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    glass_markup.add(first_button)
+    glass_markup.add(back_button)
 
-        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-        glass_markup.add(first_button, second_button)
-        glass_markup.add(back_button)
+    await show(call, text=Templates.buy_one, reply_markup=glass_markup)
 
-        bot.send_message(chat_id=call.message.chat.id, text=Des.test_config_description, reply_markup=glass_markup)
 
-    
-    # Request test
-    elif call.data == 'request_test':
-        try:
-            with mysql.connector.connect(**Keys.db_config) as connection:
-                with connection.cursor() as cursor:
-                    cursor.execute("SELECT test_config_used FROM users WHERE id = %s", (call.from_user.id,))
-                    result = cursor.fetchone()
-                    
-                    if result and result[0]:
-                        bot.answer_callback_query(call.id, "❌ شما قبلاً از کانفیگ تستی استفاده کرده‌اید.", show_alert=False)
-                        return
-
-                    # Mark test config as used
-                    cursor.execute("UPDATE users SET test_config_used = TRUE WHERE id = %s", (call.from_user.id,))
-                    connection.commit()
+# Test config
+@router.route('start_test')
+async def start_test(call):
+    first_button = telebot.types.InlineKeyboardButton('ایرانسل - رایتل 🎏️', callback_data='request_test')
+    second_button = telebot.types.InlineKeyboardButton('همراه اول - مخابرات 🎏', callback_data='request_test')
+    back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME')
+
+    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    glass_markup.add(first_button, second_button)
+    glass_markup.add(back_button)
+
+    await show(call, text=Templates.test_config, reply_markup=glass_markup)
+
+
+# Send a config claimed from the inventory, the previous message (edited in place) already says what it is
+async def deliver_config(chat_id, config):
+    await bot.send_message(chat_id=chat_id, text=Templates.config.render(config=config), parse_mode='HTML')
+
+
+# Products already reported low on stock, reported again after their next import
+low_stock_alerted = set()
+
+
+# Tell the admins once when a product is running out of configs
+async def check_stock(product):
+    if product in low_stock_alerted:
+        return
+
+    # Taken while counting so concurrent purchases do not alert twice
+    low_stock_alerted.add(product)
+    try:
+        left = await Db.free_configs(product, Keys.CONFIG_LOW_STOCK + 1)
+    except mysql.connector.Error as err:
+        logging.error("Error while counting configs of %s: %s", product, err)
+        left = None
+
+    if left is None or left > Keys.CONFIG_LOW_STOCK:
+        low_stock_alerted.discard(product)
+    else:
+        logging.warning("Low stock: %s has %s unused configs", product, left)
+        for admin_id in Keys.ADMIN_ID:
+            await bot.send_message(chat_id=admin_id, text=Templates.low_stock.render(product=product, count=left))
 
+
+# Request test, a config from the inventory is sent right away and support is asked only when none is left
+@router.route('request_test')
+async def request_test(call):
+    back_button = telebot.types.InlineKeyboardButton("بازگشت به خانه 🏡", callback_data='BACK_HOME')
+
+    back_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    back_markup.add(back_button)
+
+    try:
+        user = await Db.get_user(call.from_user.id)
+
+        if user and user[5]:
+            await show(call, text="❌ شما قبلاً از کانفیگ تستی استفاده کرده‌اید.", reply_markup=back_markup)
+            return
+
+        # Mark test config as used and claim one
+        config = await Db.claim_test(call.from_user.id, Products.TEST)
+        if config is False:
+            await show(call, text="❌ شما قبلاً از کانفیگ تستی استفاده کرده‌اید.", reply_markup=back_markup)
+            return
+
+        if config is not None:
+            await show(call, text=Templates.config_ready, reply_markup=back_markup)
+            await deliver_config(call.message.chat.id, config)
+        else:
             # Send request to support
-            first_button = telebot.types.InlineKeyboardButton("Send Config", callback_data='answer')
-            back_button = telebot.types.InlineKeyboardButton("بازگشت به خانه 🏡", callback_data='BACK_HOME')
+            await send_to_support(call.from_user, 'test', Templates.support_test.render())
+            await show(call, text=Templates.receipt, reply_markup=back_markup)
+        await check_stock(Products.TEST)
 
-            glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-            glass_markup.add(first_button)
 
-            back_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-            back_markup.add(back_button)
+    except Exception as e:
+        logging.error("Error while checking or updating test config usage: %s", e)
+        await show(call, text="❌ خطا از کانفیگ تستی.")
 
-            bot.send_message(chat_id=Keys.SUPPORT_ID, text=f"Recived a message from: {call.from_user.id}\nName: {call.from_user.first_name}\nUsername: @{call.from_user.username}\n\nMessage text: Request Test Config 🏴‍☠", reply_markup=glass_markup)
-            bot.send_message(chat_id=call.message.chat.id, text=Des.receipt_description, reply_markup=back_markup)
-            
-        except Exception as e:
-            logging.error(f"Error while checking or updating test config usage: {e}")
-            bot.send_message(chat_id=call.message.chat.id, text="❌ خطا از کانفیگ تستی.")
 
-    
-    # Profile
-    elif call.data == 'start_profile':
-        balance = balance_fetch(call.from_user.id)
+# Profile, the balance is the cached running total and the history one page of the ledger
+@router.route('start_profile')
+async def start_profile(call):
+    await profile_page(call, None)
 
-        back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME')
 
-        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-        glass_markup.add(back_button)
+# Older history entries, the callback data carries the cursor: time and id of the last entry shown
+@router.prefix('history_', clear=True)
+async def history(call, cursor):
+    try:
+        stamp, entry_id = cursor.split('_')
+        before = (datetime.datetime.strptime(stamp, '%Y%m%d%H%M%S'), int(entry_id))
+    except ValueError:
+        before = None
+    await profile_page(call, before)
 
-        bot.send_message(chat_id=call.message.chat.id, text=f"""پروفایل من 👩‍🦰🧑‍🦰
 
-🌐 شناسه کاربری: {call.from_user.id}
-🍀 یوزرنیم: {call.from_user.username}
-🍷 نام: {call.from_user.first_name}
-💰 موجودی: {balance[0][4]}
+async def profile_page(call, before):
+    balance = await balance_fetch(call.from_user.id)
 
------------------------------------------------------------------------
+    try:
+        entries = await Db.history(call.from_user.id, Keys.HISTORY_PAGE_SIZE + 1, before)
+    except mysql.connector.Error as err:
+        logging.error("Error while reading the history of %s: %s", call.from_user.id, err)
+        entries = []
 
-کانفیگ های خریداری شده ⬇
-""", reply_markup=glass_markup)
+    lines = []
+    for entry_id, kind, amount, entry_balance, note, created_at in entries[:Keys.HISTORY_PAGE_SIZE]:
+        lines.append(Templates.history_entry.render(date=created_at.strftime('%Y-%m-%d'), kind=Templates.LEDGER_KINDS.get(kind, kind),
+                                                    note=f" {note}" if kind in ('purchase', 'order') else '',
+                                                    amount=f"{amount:+,}", balance=f"{entry_balance:,}"))
 
-    # help
-    elif call.data == 'start_help':
-        # Create Buttons
-        first_button = telebot.types.InlineKeyboardButton("ios - V2Box",
-                                                        url="https://apps.apple.com/us/app/v2box-v2ray-client/id6446814690")
-        second_button = telebot.types.InlineKeyboardButton("android - V2ay",
-                                                        url="https://play.google.com/store/apps/details?id=com.v2ray.ang&hl=en&gl=US")
-        third_button = telebot.types.InlineKeyboardButton("windows - V2rayN",
-                                                        url="https://sourceforge.net/projects/v2rayn.mirror/")
-        fourth_button = telebot.types.InlineKeyboardButton("mac - Fair",
-                                                        url="https://apps.apple.com/us/app/fair-vpn/id1533873488")
-        back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME')
+    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    page_buttons = []
+    if before is not None:
+        page_buttons.append(telebot.types.InlineKeyboardButton("🔝 جدیدترین", callback_data='start_profile'))
+    if len(entries) > Keys.HISTORY_PAGE_SIZE:
+        last = entries[Keys.HISTORY_PAGE_SIZE - 1]
+        page_buttons.append(telebot.types.InlineKeyboardButton("قدیمی‌تر ⬅️", callback_data=f"history_{last[5]:%Y%m%d%H%M%S}_{last[0]}"))
+    if page_buttons:
+        glass_markup.row(*page_buttons)
+    glass_markup.add(telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME'))
+
+    await show(call, text=Templates.profile.render(user_id=call.from_user.id, username=call.from_user.username, name=call.from_user.first_name,
+                                                   balance=f"{balance:,}", history='\n'.join(lines) or Templates.history_empty),
+               reply_markup=glass_markup)
+
+
+# help
+@router.route('start_help')
+async def start_help(call):
+    # Create Buttons
+    first_button = telebot.types.InlineKeyboardButton("ios - V2Box",
+                                                    url="https://apps.apple.com/us/app/v2box-v2ray-client/id6446814690")
+    second_button = telebot.types.InlineKeyboardButton("android - V2ay",
+                                                    url="https://play.google.com/store/apps/details?id=com.v2ray.ang&hl=en&gl=US")
+    third_button = telebot.types.InlineKeyboardButton("windows - V2rayN",
+                                                    url="https://sourceforge.net/projects/v2rayn.mirror/")
+    fourth_button = telebot.types.InlineKeyboardButton("mac - Fair",
+                                                    url="https://apps.apple.com/us/app/fair-vpn/id1533873488")
+    back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME')
 
-        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-        glass_markup.add(first_button, second_button, third_button, fourth_button)
-        glass_markup.add(back_button)
+    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    glass_markup.add(first_button, second_button, third_button, fourth_button)
+    glass_markup.add(back_button)
 
-        bot.send_message(chat_id=call.message.chat.id, text=Des.help_description, reply_markup=glass_markup)
+    await show(call, text=Templates.guide, reply_markup=glass_markup)
 
-    # discount
-    elif call.data == 'start_discount':
-        
-        # Create Buttons
-        back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME')
-        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-        glass_markup.add(back_button)
 
-        with open("Mochi_2.mp4", "rb") as video:
-            bot.send_video(call.message.chat.id, 
-                           video, 
-                           caption=f"🎖 لینک رفرال: https://t.me/MochiServer_bot?start={call.from_user.id}" + Des.discount_description,
-                           supports_streaming=True, 
-                           reply_markup=glass_markup
-                           )
-
-    # funds
-    elif call.data == 'start_funds':
-        # Create Buttons
-        first_button = telebot.types.InlineKeyboardButton("50.000 🪙", url="https://zarinp.al/681602")
-        second_button = telebot.types.InlineKeyboardButton("110.000 🪙", url="https://zarinp.al/682929")
-        third_button = telebot.types.InlineKeyboardButton("150.000 🪙", url="https://zarinp.al/682930")
-        fourth_button = telebot.types.InlineKeyboardButton("200.000 🪙", url="https://zarinp.al/682931")
-        back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME')
+# discount
+@router.route('start_discount')
+async def start_discount(call):
+    # Create Buttons
+    back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME')
+    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    glass_markup.add(back_button)
 
-        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-        glass_markup.add(first_button, second_button, third_button, fourth_button)
-        glass_markup.add(back_button)
+    try:
+        referrals, _ = await Db.referral_stats(call.from_user.id)
+    except mysql.connector.Error as err:
+        logging.error("Error while reading the referrals of %s: %s", call.from_user.id, err)
+        referrals = 0
 
-        bot.send_message(chat_id=call.message.chat.id, text=Des.funds_description, reply_markup=glass_markup)
+    await Media.cache.send_video(bot,
+                                 call.message.chat.id,
+                                 "Mochi_2.mp4",
+                                 caption=Templates.referral.render(user_id=call.from_user.id, referrals=referrals),
+                                 supports_streaming=True,
+                                 reply_markup=glass_markup
+                                 )
 
-    # buy NL buttons
-    elif call.data == 'buy_NL':
-        first_button = telebot.types.InlineKeyboardButton('خرید کانفیگ تک نفره 🧜‍♂️', callback_data='NL_alone')
-        second_button = telebot.types.InlineKeyboardButton('خرید کانفیگ خانوادگی 👫', callback_data='NL_family')
-        back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='start_buy')
 
-        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-        glass_markup.add(first_button, second_button)
-        glass_markup.add(back_button)
+# funds
+@router.route('start_funds')
+async def start_funds(call):
+    # Create Buttons
+    amount_buttons = []
+    for top_up in Products.TOP_UPS:
+        if Payments.enabled():
+            amount_buttons.append(telebot.types.InlineKeyboardButton(f"{top_up['text']} 🪙", callback_data=f"topup_{top_up['amount']}"))
+        else:
+            amount_buttons.append(telebot.types.InlineKeyboardButton(f"{top_up['text']} 🪙", url=top_up['pay_url']))
+    back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME')
 
-        bot.send_message(chat_id=call.message.chat.id, text=Des.buy_two_description, reply_markup=glass_markup)
+    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    glass_markup.add(*amount_buttons)
+    glass_markup.add(back_button)
 
-    # buy NL alone button
-    elif call.data == 'NL_alone':
-        first_button = telebot.types.InlineKeyboardButton('ایرانسل - رایتل 🎏️', callback_data='NL_alone_ircell')
-        second_button = telebot.types.InlineKeyboardButton('همراه اول - مخابرات 🎏', callback_data='NL_alone_hmaval')
-        back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='buy_NL')
+    await show(call, text=Templates.funds, reply_markup=glass_markup)
 
-        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-        glass_markup.add(first_button, second_button)
-        glass_markup.add(back_button)
 
-        bot.send_message(chat_id=call.message.chat.id, text=Des.buy_three_description, reply_markup=glass_markup)
+# buy NL buttons
+@router.route('buy_NL')
+async def buy_nl(call):
+    first_button = telebot.types.InlineKeyboardButton('خرید کانفیگ تک نفره 🧜‍♂️', callback_data='NL_alone')
+    second_button = telebot.types.InlineKeyboardButton('خرید کانفیگ خانوادگی 👫', callback_data='NL_family')
+    back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='start_buy')
 
-    # buy NL alone button
-    elif call.data == 'NL_family':
-        first_button = telebot.types.InlineKeyboardButton('۳ نفره 👨‍👩‍👦️', callback_data='NL_family_3')
-        second_button = telebot.types.InlineKeyboardButton('۵ نفره 👨‍👩‍👧‍👦', callback_data='NL_family_5')
-        back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='buy_NL')
+    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    glass_markup.add(first_button, second_button)
+    glass_markup.add(back_button)
 
-        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-        glass_markup.add(first_button, second_button)
-        glass_markup.add(back_button)
+    await show(call, text=Templates.buy_two, reply_markup=glass_markup)
 
-        bot.send_message(chat_id=call.message.chat.id, text=Des.buy_four_description, reply_markup=glass_markup)
 
-    ### Transactions
-    # buy NL alone ircell
-    elif call.data == 'NL_alone_ircell':
-        first_button = telebot.types.InlineKeyboardButton('🌐 پرداخت اینترنتی', url="https://zarinp.al/682933")
-        second_button = telebot.types.InlineKeyboardButton('💳 پرداخت با موجودی', callback_data='wallet')
-        third_button = telebot.types.InlineKeyboardButton("📨 ارسال رسید", callback_data='receipt')
-        back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='NL_alone')
+# buy NL alone button
+@router.route('NL_alone')
+async def nl_alone(call):
+    first_button = telebot.types.InlineKeyboardButton('ایرانسل - رایتل 🎏️', callback_data='NL_alone_ircell')
+    second_button = telebot.types.InlineKeyboardButton('همراه اول - مخابرات 🎏', callback_data='NL_alone_hmaval')
+    back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='buy_NL')
 
-        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-        glass_markup.add(first_button, second_button, third_button)
-        glass_markup.add(back_button)
+    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    glass_markup.add(first_button, second_button)
+    glass_markup.add(back_button)
 
-        bot.send_message(chat_id=call.message.chat.id, text="قیمت: ۱۵۰.۰۰۰ تومان 🪙"+Des.transaction_description, reply_markup=glass_markup)
-        Keys.price = 150000
+    await show(call, text=Templates.buy_three, reply_markup=glass_markup)
 
 
-    # buy NL alone hmaval
-    elif call.data == 'NL_alone_hmaval':
-        first_button = telebot.types.InlineKeyboardButton('🌐 پرداخت اینترنتی', url="https://zarinp.al/682932")
-        second_button = telebot.types.InlineKeyboardButton('💳 پرداخت با موجودی', callback_data='wallet')
-        third_button = telebot.types.InlineKeyboardButton("📨 ارسال رسید", callback_data='receipt')
-        back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='NL_alone')
+# buy NL family button
+@router.route('NL_family')
+async def nl_family(call):
+    first_button = telebot.types.InlineKeyboardButton('۳ نفره 👨‍👩‍👦️', callback_data='NL_family_3')
+    second_button = telebot.types.InlineKeyboardButton('۵ نفره 👨‍👩‍👧‍👦', callback_data='NL_family_5')
+    back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='buy_NL')
 
-        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-        glass_markup.add(first_button, second_button, third_button)
-        glass_markup.add(back_button)
+    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    glass_markup.add(first_button, second_button)
+    glass_markup.add(back_button)
 
-        bot.send_message(chat_id=call.message.chat.id, text="قیمت: ۱۵۰.۰۰۰ تومان 🪙"+Des.transaction_description, reply_markup=glass_markup)
-        Keys.price = 150000
+    await show(call, text=Templates.buy_four, reply_markup=glass_markup)
 
 
-    # buy NL family 3
-    elif call.data == 'NL_family_3':
-        first_button = telebot.types.InlineKeyboardButton('🌐 پرداخت اینترنتی', url="https://zarinp.al/682934")
-        second_button = telebot.types.InlineKeyboardButton('💳 پرداخت با موجودی', callback_data='wallet')
-        third_button = telebot.types.InlineKeyboardButton("📨 ارسال رسید", callback_data='receipt')
-        back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='NL_family')
+### Transactions
+# product page, the product travels in the callback data of the payment buttons
+async def product_page(call):
+    product = Products.PRODUCTS[call.data]
 
-        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-        glass_markup.add(first_button, second_button, third_button)
-        glass_markup.add(back_button)
+    if Payments.enabled():
+        first_button = telebot.types.InlineKeyboardButton('🌐 پرداخت اینترنتی', callback_data=f"pay_{call.data}")
+    else:
+        first_button = telebot.types.InlineKeyboardButton('🌐 پرداخت اینترنتی', url=product['pay_url'])
+    second_button = telebot.types.InlineKeyboardButton('💳 پرداخت با موجودی', callback_data=f"wallet_{call.data}")
+    third_button = telebot.types.InlineKeyboardButton("📨 ارسال رسید", callback_data='receipt')
+    back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data=product['back'])
 
-        bot.send_message(chat_id=call.message.chat.id, text="قیمت: ۴۰۰.۰۰۰ تومان 🪙"+Des.transaction_description, reply_markup=glass_markup)
-        Keys.price = 400000
+    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    glass_markup.add(first_button, second_button, third_button)
+    glass_markup.add(back_button)
 
+    await show(call, text=Templates.product_page.render(price=product['price_text']), reply_markup=glass_markup)
 
-    # buy NL family 5
-    elif call.data == 'NL_family_5':
-        first_button = telebot.types.InlineKeyboardButton('🌐 پرداخت اینترنتی', url="https://zarinp.al/682935")
-        second_button = telebot.types.InlineKeyboardButton('💳 پرداخت با موجودی', callback_data='wallet')
-        third_button = telebot.types.InlineKeyboardButton("📨 ارسال رسید", callback_data='receipt')
-        back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='NL_family')
 
-        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-        glass_markup.add(first_button, second_button, third_button)
-        glass_markup.add(back_button)
+for product_key in Products.PRODUCTS:
+    router.route(product_key)(product_page)
 
-        bot.send_message(chat_id=call.message.chat.id, text="قیمت: ۶۹۰.۰۰۰ تومان 🪙"+Des.transaction_description, reply_markup=glass_markup)
-        Keys.price = 690000
 
+# A button of a product or amount that is no longer sold, the query is already answered so the message says it
+async def unknown(call):
+    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    glass_markup.add(telebot.types.InlineKeyboardButton("بازگشت به خانه 🏡", callback_data='BACK_HOME'))
+    await show(call, text="🔴🔴🔴 Unknown 🔴🔴🔴", reply_markup=glass_markup)
 
-    # wallet
-    elif call.data == 'wallet':
-        back_button = telebot.types.InlineKeyboardButton("بازگشت به خانه 🏡", callback_data='BACK_HOME')
 
-        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-        glass_markup.add(back_button)
+# wallet, the debit, the order and the config claimed for it are one transaction.
+# The query is answered before the purchase starts, so the spinner stops at once
+@router.prefix('wallet_', clear=True)
+async def wallet(call, product_key):
+    back_button = telebot.types.InlineKeyboardButton("بازگشت به خانه 🏡", callback_data='BACK_HOME')
 
-        balance = balance_fetch(call.from_user.id)
-        if balance[0][4] >= Keys.price:
-            # Update balance
-            try:
-                with mysql.connector.connect(**Keys.db_config) as connection:
-                    with connection.cursor() as cursor:
-                        sql = "UPDATE users SET balance = balance - %s WHERE id = %s"
-                        cursor.execute(sql, (Keys.price, call.from_user.id))
-                        connection.commit()
+    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    glass_markup.add(back_button)
 
-                logging.info(f"User {call.from_user.id} balance updated")
-                bot.send_message(chat_id=call.message.chat.id, text=Des.receipt_description, reply_markup=glass_markup)
+    product = Products.PRODUCTS.get(product_key)
+    if product is None:
+        await unknown(call)
+        return
 
-                # Send request to support
-                first_button = telebot.types.InlineKeyboardButton("Send Config", callback_data='answer')
-                glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-                glass_markup.add(first_button)
+    try:
+        purchase = await Db.purchase(call.from_user.id, product_key, product['price'])
 
-                bot.send_message(chat_id=Keys.SUPPORT_ID, text=f"Recived a message from: {call.from_user.id}\nName: {call.from_user.first_name}\nUsername: @{call.from_user.username}\n\nMessage text:\n{escape_special_characters(f'Payment successful, please send the config.')}\nAmount paid: {Keys.price} تومان", reply_markup=glass_markup)
-                Keys.texts[call.from_user.id] = {'type': 'text', 'text': f'Payment successful, please send the config. Amount paid: {Keys.price} تومان'}
+    except mysql.connector.Error as err:
+        logging.error("Error while updating balance: %s", err)
+        await show(call, text="❌ خطا در پرداخت. 🪙", reply_markup=glass_markup)
+        return
 
-            except mysql.connector.Error as err:
-                logging.error(f"Error while updating balance: {err}")
-                bot.send_message(chat_id=call.message.chat.id, text="❌ خطا در پرداخت. 🪙", reply_markup=glass_markup)
+    if purchase is None:
+        await show(call, text="❌ موجودی شما کافی نمیباشد. 🪙", reply_markup=glass_markup)
+        return
 
-        else:
-            bot.send_message(chat_id=call.message.chat.id, text="❌ موجودی شما کافی نمیباشد. 🪙", reply_markup=glass_markup)
+    order_id, config = purchase
+    logging.info("User %s balance updated, order %s", call.from_user.id, order_id)
 
+    if config is not None:
+        await show(call, text=Templates.config_ready, reply_markup=glass_markup)
+        await deliver_config(call.message.chat.id, config)
+    else:
+        # Out of stock, send request to support
+        await show(call, text=Templates.receipt, reply_markup=glass_markup)
+        await send_to_support(call.from_user, 'order', Templates.support_order.render(order_id=order_id, product=product_key, price=product['price']), order_id=order_id)
+        Pending.requests.set(call.from_user.id, {'type': 'text', 'text': f"Payment successful, please send the config. Amount paid: {product['price']} تومان"})
+    await check_stock(product_key)
+
+
+# Online payment of a product, a payment is created at the gateway for this user and product
+@router.prefix('pay_', clear=True)
+async def pay(call, product_key):
+    product = Products.PRODUCTS.get(product_key)
+    if product is None:
+        await unknown(call)
+        return
 
-    # receipt
-    elif call.data == 'receipt':
-        bot.send_message(chat_id=call.message.chat.id , text="📸 عکس رسید پرداخت خود را ارسال کنید.\n📨 یا شناسه پرداخت خود را بنویسید.\n\n⬇⬇⬇") #, reply_markup=glass_markup)
-        bot.set_state(user_id=call.from_user.id, state=buy.request, chat_id=call.message.chat.id)
+    await start_payment(call, product['price'], product_key, product['back'])
 
 
-    # Admin panel
-    elif call.data == 'admin':
-        # Fetch user list from the database
-        try:
-            with mysql.connector.connect(**Keys.db_config) as connection:
-                with connection.cursor() as cursor:
-                    cursor.execute("SELECT id, username, first_name, last_name, balance FROM users")
-                    users = cursor.fetchall()
-                    
-                    user_buttons = []
-                    for user in users:
-                        user_buttons.append(telebot.types.InlineKeyboardButton(f"{user[2]} ({user[0]})", callback_data=f"user_{user[0]}"))
-
-                    back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME')
-                    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-                    glass_markup.add(*user_buttons)
-                    glass_markup.add(back_button)
-
-                    bot.send_message(chat_id=call.message.chat.id, text=Des.admin_description, reply_markup=glass_markup)
+# Online top-up of the balance
+@router.prefix('topup_', clear=True)
+async def top_up(call, amount):
+    if not any(str(top_up['amount']) == amount for top_up in Products.TOP_UPS):
+        await unknown(call)
+        return
 
-        except Exception as e:
-            logging.error(f"Error while fetching users: {e}")
-            bot.send_message(chat_id=call.message.chat.id, text="❌ خطا در دریافت لیست کاربران.")
+    await start_payment(call, int(amount), None, 'start_funds')
 
-    # VIPS
-    elif call.data == 'vip':
-        back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME')
 
-        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+async def start_payment(call, amount, product_key, back):
+    back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data=back)
+    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+
+    try:
+        url = await Payments.create(call.from_user.id, amount, product_key)
+
+    except (Payments.GatewayError, mysql.connector.Error) as e:
+        logging.error("Error while creating a payment for %s: %s", call.from_user.id, e)
         glass_markup.add(back_button)
+        await show(call, text="❌ خطا در اتصال به درگاه پرداخت، لطفاً دوباره تلاش کنید.", reply_markup=glass_markup)
+        return
+
+    glass_markup.add(telebot.types.InlineKeyboardButton('🌐 پرداخت', url=url))
+    glass_markup.add(back_button)
+    await show(call, text=Templates.payment.render(amount=f"{amount:,}"), reply_markup=glass_markup)
 
-        bot.send_message(chat_id=call.message.chat.id, text=Des.VIP_description, reply_markup=glass_markup)
-        with open("VIP.png", "rb") as picture:
-            bot.send_photo(call.message.chat.id, picture, caption=Keys.vip_config)
 
+# A verified payment was completed by Payments.settle: top-ups are credited, products delivered from the inventory
+async def payment_completed(user_id, amount, product, order_id, config):
+    try:
+        if product is None:
+            await bot.send_message(chat_id=user_id, text=Templates.top_up_done.render(amount=f"{amount:,}"))
+            return
 
-    # Mahsa
-    elif call.data == 'mahsa':
-        back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME')
+        if config is not None:
+            await bot.send_message(chat_id=user_id, text=Templates.config_ready)
+            await deliver_config(user_id, config)
+        else:
+            # Out of stock, send request to support
+            await bot.send_message(chat_id=user_id, text=Templates.receipt)
+            user = await Db.get_user(user_id) or (user_id, None, '')
+            await send_to_support(telebot.types.User(user_id, False, user[2] or '', username=user[1]), 'order',
+                                  Templates.support_order.render(order_id=order_id, product=product, price=amount), order_id=order_id)
+        await check_stock(product)
 
-        glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-        glass_markup.add(back_button)
+    except Exception as e:
+        logging.error("Error while notifying user %s of payment for order %s: %s", user_id, order_id, e)
 
-        bot.send_message(chat_id=call.message.chat.id, text=Des.mahsa_description, reply_markup=glass_markup)
-        with open("Mahsa.png", "rb") as picture:
-            bot.send_photo(call.message.chat.id, picture, caption=Keys.mahsa_config)
 
+# wallet buttons sent before products were carried in the callback data
+@router.route('wallet')
+async def wallet_without_product(call):
+    await start_buy(call)
+
+
+# receipt
+@router.route('receipt')
+async def receipt(call):
+    await bot.send_message(chat_id=call.message.chat.id , text="📸 عکس رسید پرداخت خود را ارسال کنید.\n📨 یا شناسه پرداخت خود را بنویسید.\n\n⬇⬇⬇") #, reply_markup=glass_markup)
+    await bot.set_state(user_id=call.from_user.id, state=buy.request, chat_id=call.message.chat.id)
 
-    else:
-        bot.answer_callback_query(call.id, "🔴🔴🔴 Unknown 🔴🔴🔴", show_alert=False)
 
+# Admin panel, one page of users at a time
+def admin_markup(users, has_prev, has_next):
+    user_buttons = []
+    for user in users:
+        user_buttons.append(telebot.types.InlineKeyboardButton(f"{user[1]} ({user[0]})", callback_data=f"user_{user[0]}"))
 
-@bot.message_handler(state=buy.request, content_types=['text'])
-def update_user_info(user_message):
+    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    glass_markup.add(*user_buttons)
+
+    page_buttons = []
+    if has_prev and users:
+        page_buttons.append(telebot.types.InlineKeyboardButton("⬅️ قبلی", callback_data=f"admin_prev_{users[0][0]}"))
+    if has_next and users:
+        page_buttons.append(telebot.types.InlineKeyboardButton("بعدی ➡️", callback_data=f"admin_next_{users[-1][0]}"))
+    if page_buttons:
+        glass_markup.row(*page_buttons)
+
+    glass_markup.add(telebot.types.InlineKeyboardButton("📢 ارسال همگانی", callback_data='broadcast'))
+    glass_markup.add(telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME'))
+    return glass_markup
+
+
+async def send_admin_page(call, users, has_prev, has_next):
+    await show(call, text=Templates.admin, reply_markup=admin_markup(users, has_prev, has_next))
+
+
+@router.route('admin')
+async def admin_panel(call):
+    await admin_next(call, '0')
+
+
+@router.prefix('admin_next_', clear=True)
+async def admin_next(call, after_id):
     try:
-        user_id = Keys.edit_user_id
+        users = await Db.users_after(int(after_id), Keys.ADMIN_PAGE_SIZE + 1)
+        await send_admin_page(call, users[:Keys.ADMIN_PAGE_SIZE], int(after_id) > 0, len(users) > Keys.ADMIN_PAGE_SIZE)
+
+    except Exception as e:
+        logging.error("Error while fetching users: %s", e)
+        await show(call, text="❌ خطا در دریافت لیست کاربران.")
+
+
+@router.prefix('admin_prev_', clear=True)
+async def admin_prev(call, before_id):
+    try:
+        users = await Db.users_before(int(before_id), Keys.ADMIN_PAGE_SIZE + 1)
+        await send_admin_page(call, users[-Keys.ADMIN_PAGE_SIZE:], len(users) > Keys.ADMIN_PAGE_SIZE, True)
+
+    except Exception as e:
+        logging.error("Error while fetching users: %s", e)
+        await show(call, text="❌ خطا در دریافت لیست کاربران.")
+
+
+# Broadcast a message to every user
+@router.route('broadcast')
+async def broadcast_request(call):
+    if not Menus.is_admin(call.message.chat.id):
+        return
+
+    await show(call, text="📢 پیامی که باید برای همه کاربران ارسال شود را بفرستید (یا /cancel):")
+    await bot.set_state(user_id=call.from_user.id, state=buy.broadcast, chat_id=call.message.chat.id)
+
+
+# Nothing is sent before the admin confirmed the preview, the message waiting for it is in the state data
+@router.route('broadcast_confirm')
+async def broadcast_confirm(call):
+    if not Menus.is_admin(call.message.chat.id):
+        return
+
+    async with bot.retrieve_data(user_id=call.from_user.id, chat_id=call.message.chat.id) as data:
+        message_id = data.get('broadcast_message_id') if data else None
+    await bot.delete_state(user_id=call.from_user.id, chat_id=call.message.chat.id)
+    if message_id is None:
+        await show(call, text="❌ پیامی برای ارسال همگانی در انتظار نیست.")
+        return
+
+    task = asyncio.create_task(broadcast_message(call.message.chat.id, message_id))
+    broadcasts.add(task)
+    task.add_done_callback(broadcasts.discard)
+    await show(call, text="📢 ارسال همگانی شروع شد.")
+
+
+@router.route('broadcast_cancel')
+async def broadcast_cancel(call):
+    await bot.delete_state(user_id=call.from_user.id, chat_id=call.message.chat.id)
+    await show(call, text="❌ ارسال همگانی لغو شد.")
+
+
+async def broadcast_message(chat_id, message_id):
+    result = await Outbox.broadcast(Db.users_after,
+                                    lambda user_id: bot.copy_message(chat_id=user_id, from_chat_id=chat_id, message_id=message_id),
+                                    Keys.BROADCAST_CHUNK_SIZE)
+    logging.info("Broadcast finished: %s", result)
+    await bot.send_message(chat_id=chat_id, text=f"✅ ارسال همگانی تمام شد.\n\nارسال شده: {result['sent']}\nناموفق: {result['failed']}")
+
+
+# VIPS
+@router.route('vip')
+async def vip(call):
+    back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME')
+
+    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    glass_markup.add(back_button)
+
+    await show(call, text=Templates.vip, reply_markup=glass_markup)
+    await Media.cache.send_photo(bot, call.message.chat.id, "VIP.png", caption=Keys.vip_config)
+
+
+# Mahsa
+@router.route('mahsa')
+async def mahsa(call):
+    back_button = telebot.types.InlineKeyboardButton("❌ بازگشت", callback_data='BACK_HOME')
+
+    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    glass_markup.add(back_button)
+
+    await show(call, text=Templates.mahsa, reply_markup=glass_markup)
+    await Media.cache.send_photo(bot, call.message.chat.id, "Mahsa.png", caption=Keys.mahsa_config)
+
+
+@bot.message_handler(state=buy.edit, content_types=['text'])
+async def update_user_info(user_message):
+    try:
+        async with bot.retrieve_data(user_id=user_message.from_user.id, chat_id=user_message.chat.id) as data:
+            user_id = data['edit_user_id']
         new_info = user_message.text.split(',')
         if len(new_info) != 4:
-            bot.send_message(chat_id=user_message.chat.id, text="❌ فرمت اطلاعات نادرست است.")
+            await bot.send_message(chat_id=user_message.chat.id, text="❌ فرمت اطلاعات نادرست است.")
             return
 
-        with mysql.connector.connect(**Keys.db_config) as connection:
-            with connection.cursor() as cursor:
-                cursor.execute("UPDATE users SET username = %s, first_name = %s, last_name = %s, balance = %s WHERE id = %s",
-                               (new_info[0], new_info[1], new_info[2], new_info[3], user_id))
-                connection.commit()
+        if not await Db.update_user(int(user_id), new_info[0], new_info[1], new_info[2], int(new_info[3]), user_message.from_user.id):
+            await bot.send_message(chat_id=user_message.chat.id, text="❌ کاربر یافت نشد.")
+            return
 
-        bot.send_message(chat_id=user_message.chat.id, text="✅ اطلاعات کاربر با موفقیت به‌روزرسانی شد.")
-        bot.delete_state(user_id=user_message.from_user.id, chat_id=user_message.chat.id)
+        await bot.send_message(chat_id=user_message.chat.id, text="✅ اطلاعات کاربر با موفقیت به‌روزرسانی شد.")
+        await bot.delete_state(user_id=user_message.from_user.id, chat_id=user_message.chat.id)
 
     except Exception as e:
-        logging.error(f"Error while updating user info: {e}")
-        bot.send_message(chat_id=user_message.chat.id, text="❌ خطا در به‌روزرسانی اطلاعات کاربر.")
+        logging.error("Error while updating user info: %s", e)
+        await bot.send_message(chat_id=user_message.chat.id, text="❌ خطا در به‌روزرسانی اطلاعات کاربر.")
+
+
+# Show the message to broadcast as every user will get it, it is sent (in the background, in the bulk lane) only
+# after the admin confirms. Commands are never broadcast, /cancel leaves the broadcast
+@bot.message_handler(state=buy.broadcast, content_types=['text', 'photo', 'video', 'document', 'animation', 'audio', 'voice', 'sticker'])
+async def start_broadcast(user_message):
+    if not Menus.is_admin(user_message.chat.id):
+        await bot.delete_state(user_id=user_message.from_user.id, chat_id=user_message.chat.id)
+        return
+
+    if user_message.content_type == 'text' and user_message.text.startswith('/'):
+        if user_message.text.split()[0] == '/cancel':
+            await bot.delete_state(user_id=user_message.from_user.id, chat_id=user_message.chat.id)
+            await bot.send_message(chat_id=user_message.chat.id, text="❌ ارسال همگانی لغو شد.")
+        else:
+            await bot.send_message(chat_id=user_message.chat.id, text="❌ دستورها ارسال همگانی نمی‌شوند، پیام را بفرستید یا /cancel.")
+        return
+
+    await bot.add_data(user_id=user_message.from_user.id, chat_id=user_message.chat.id, broadcast_message_id=user_message.message_id)
+
+    confirm_button = telebot.types.InlineKeyboardButton("✅ ارسال برای همه", callback_data='broadcast_confirm')
+    cancel_button = telebot.types.InlineKeyboardButton("❌ لغو", callback_data='broadcast_cancel')
+
+    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
+    glass_markup.add(confirm_button, cancel_button)
+
+    await bot.send_message(chat_id=user_message.chat.id, text="👀 پیش‌نمایش پیامی که برای همه ارسال می‌شود:")
+    await bot.copy_message(chat_id=user_message.chat.id, from_chat_id=user_message.chat.id, message_id=user_message.message_id, reply_markup=glass_markup)
 
 
 # Request config
 @bot.message_handler(state=buy.request, content_types=['photo', 'text'])
-def request_config(user_message):
+async def request_config(user_message):
     # Create Buttons
-    first_button = telebot.types.InlineKeyboardButton("Send Config", callback_data='answer')
     back_button = telebot.types.InlineKeyboardButton("بازگشت به خانه 🏡", callback_data='BACK_HOME')
 
-    glass_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
-    glass_markup.add(first_button)
-
     back_markup = telebot.types.InlineKeyboardMarkup(row_width=2)
     back_markup.add(back_button)
 
     if user_message.content_type == 'photo':
         caption = user_message.caption if user_message.caption is not None else ""
-        bot.send_photo(chat_id=Keys.SUPPORT_ID, photo=user_message.photo[-1].file_id, caption=f"Recived a message from: {user_message.from_user.id}\nName: {user_message.from_user.first_name}\nUsername: @{user_message.from_user.username}\n\nMessage text:\n{escape_special_characters(caption)}", reply_markup=glass_markup)
-        bot.send_message(chat_id=user_message.chat.id, text=Des.receipt_description, reply_markup=back_markup)
-        Keys.texts[user_message.from_user.id] = {'type': 'photo', 'file_id': user_message.photo[-1].file_id, 'caption': caption}
+        await send_to_support(user_message.from_user, 'request', Templates.support_request.render(text=caption), photo=user_message.photo[-1].file_id)
+        await bot.send_message(chat_id=user_message.chat.id, text=Templates.receipt, reply_markup=back_markup)
+        Pending.requests.set(user_message.from_user.id, {'type': 'photo', 'file_id': user_message.photo[-1].file_id, 'caption': caption})
 
     elif user_message.content_type == 'text':
-        bot.send_message(chat_id=Keys.SUPPORT_ID, text=f"Recived a message from: {user_message.from_user.id}\nName: {user_message.from_user.first_name}\nUsername: @{user_message.from_user.username}\n\nMessage text:\n{escape_special_characters(user_message.text)}", reply_markup=glass_markup)
-        bot.send_message(chat_id=user_message.chat.id, text=Des.receipt_description, reply_markup=back_markup)
-        Keys.texts[user_message.from_user.id] = {'type': 'text', 'text': user_message.text}
+        await send_to_support(user_message.from_user, 'request', Templates.support_request.render(text=user_message.text))
+        await bot.send_message(chat_id=user_message.chat.id, text=Templates.receipt, reply_markup=back_markup)
+        Pending.requests.set(user_message.from_user.id, {'type': 'text', 'text': user_message.text})
 
     else:
-        bot.send_message(chat_id=user_message.chat.id, text="❌ فقط متن یا عکس پذیرفته میشود. 📸")
+        await bot.send_message(chat_id=user_message.chat.id, text="❌ فقط متن یا عکس پذیرفته میشود. 📸")
 
-    bot.delete_state(user_id=user_message.from_user.id, chat_id=user_message.chat.id)
+    await bot.delete_state(user_id=user_message.from_user.id, chat_id=user_message.chat.id)
 
 
 # Respond config
 @bot.message_handler(state=buy.respond, content_types=['photo', 'text'])
-def respond_config(user_message):
-    pattern = r"Send your answer to: \d+"
-    user_id_match = int(re.findall(pattern=pattern, string=user_message.reply_to_message.text)[0].split()[4])
-    
-    if not user_id_match:
-        bot.send_message(chat_id=user_message.chat.id, text="User ID not found.")
+async def respond_config(user_message):
+    async with bot.retrieve_data(user_id=user_message.from_user.id, chat_id=user_message.chat.id) as data:
+        ticket_id = data.get('ticket_id')
+        user_id_match = data.get('ticket_user_id')
+
+    if ticket_id is None:
+        await bot.send_message(chat_id=user_message.chat.id, text="Ticket not found.")
+        await bot.delete_state(user_id=user_message.from_user.id, chat_id=user_message.chat.id)
+        return
+
+    # Closing first makes sure only one agent answers a ticket
+    if not await Db.close_ticket(ticket_id):
+        await bot.send_message(chat_id=user_message.chat.id, text=f"Ticket #{ticket_id} was already answered.")
+        await bot.delete_state(user_id=user_message.from_user.id, chat_id=user_message.chat.id)
         return
 
     if user_message.content_type == 'photo':
         caption = user_message.caption if user_message.caption is not None else ""
-        bot.send_message(chat_id=user_id_match, text="🛑 کانفیگ زیر را کپی کنید یا QR کد آن را با برنامه V2ray اسکن کنید")
-        bot.send_photo(chat_id=user_id_match, photo=user_message.photo[-1].file_id, caption=caption)
+        await bot.send_message(chat_id=user_id_match, text=Templates.config_ready)
+        await bot.send_photo(chat_id=user_id_match, photo=user_message.photo[-1].file_id, caption=caption)
 
     elif user_message.content_type == 'text':
-        bot.send_message(chat_id=user_id_match, text="🛑 کانفیگ زیر را کپی کنید یا QR کد آن را با برنامه V2ray اسکن کنید")
-        bot.send_message(chat_id=user_id_match, text=user_message.text)
+        await bot.send_message(chat_id=user_id_match, text=Templates.config_ready)
+        await bot.send_message(chat_id=user_id_match, text=user_message.text)
     
-    bot.send_message(chat_id=user_message.chat.id, text="Message sent to the user.")
-    bot.delete_state(user_id=user_message.from_user.id, chat_id=user_message.chat.id)
+    await bot.send_message(chat_id=user_message.chat.id, text=f"Message sent to the user, ticket #{ticket_id} closed.")
+    Pending.answered(user_id_match)
+    await bot.delete_state(user_id=user_message.from_user.id, chat_id=user_message.chat.id)
+
+
+# Search users by id, username or name prefix
+@bot.message_handler(commands=['find'], func=lambda message: Menus.is_admin(message.chat.id))
+async def find_command(user_message):
+    token = user_message.text.split(maxsplit=1)
+    if len(token) < 2:
+        await bot.send_message(chat_id=user_message.chat.id, text="🔎 /find <id | username | name>")
+        return
+
+    try:
+        users = await Db.search_users(token[1].strip(), Keys.ADMIN_PAGE_SIZE)
+        if users:
+            await bot.send_message(chat_id=user_message.chat.id, text=Templates.admin, reply_markup=admin_markup(users, False, False))
+        else:
+            await bot.send_message(chat_id=user_message.chat.id, text="❌ کاربر یافت نشد.")
+
+    except Exception as e:
+        logging.error("Error while searching users: %s", e)
+        await bot.send_message(chat_id=user_message.chat.id, text="❌ خطا در دریافت لیست کاربران.")
+
+
+# Bulk import of configs: /import <product>, then a message or a text file with one config per line
+@bot.message_handler(commands=['import'], func=lambda message: Menus.is_admin(message.chat.id))
+async def import_command(user_message):
+    token = user_message.text.split()
+    if len(token) < 2 or token[1] not in Products.INVENTORY:
+        await bot.send_message(chat_id=user_message.chat.id, text="📦 /import <" + " | ".join(Products.INVENTORY) + ">")
+        return
+
+    await bot.set_state(user_id=user_message.from_user.id, state=buy.import_configs, chat_id=user_message.chat.id)
+    await bot.add_data(user_id=user_message.from_user.id, chat_id=user_message.chat.id, import_product=token[1])
+    await bot.send_message(chat_id=user_message.chat.id, text=f"📦 Send the configs of {token[1]}, one per line (a message or a .txt file).")
+
+
+@bot.message_handler(state=buy.import_configs, content_types=['text', 'document'])
+async def import_configs(user_message):
+    async with bot.retrieve_data(user_id=user_message.from_user.id, chat_id=user_message.chat.id) as data:
+        product = data.get('import_product')
+    await bot.delete_state(user_id=user_message.from_user.id, chat_id=user_message.chat.id)
+    if product is None or not Menus.is_admin(user_message.chat.id):
+        return
+
+    try:
+        if user_message.content_type == 'document':
+            file_info = await bot.get_file(user_message.document.file_id)
+            text = (await bot.download_file(file_info.file_path)).decode('utf-8')
+        else:
+            text = user_message.text
+
+        configs = [line.strip() for line in text.splitlines() if line.strip()]
+        count = await Db.import_configs(product, configs) if configs else 0
+
+    except (mysql.connector.Error, telebot.asyncio_helper.ApiTelegramException, UnicodeDecodeError) as e:
+        logging.error("Error while importing configs of %s: %s", product, e)
+        await bot.send_message(chat_id=user_message.chat.id, text="❌ خطا در افزودن کانفیگ‌ها.")
+        return
+
+    logging.info("%s configs imported to %s", count, product)
+    low_stock_alerted.discard(product)
+    await bot.send_message(chat_id=user_message.chat.id, text=Templates.import_done.render(count=count, product=product))
+
+
+# Referral leaderboard, served from the cached top of referral_stats
+@bot.message_handler(commands=['top'], func=lambda message: Menus.is_admin(message.chat.id))
+async def top_command(user_message):
+    try:
+        rows = await Db.top_referrers(Keys.LEADERBOARD_SIZE)
+    except mysql.connector.Error as err:
+        logging.error("Error while reading the leaderboard: %s", err)
+        await bot.send_message(chat_id=user_message.chat.id, text="❌ خطا در دریافت لیست ریفرال‌ها.")
+        return
+
+    lines = [Templates.leaderboard_entry.render(rank=rank, name=name or '-', user_id=referrer_id, referrals=referrals, rewarded=f"{rewarded:,}")
+             for rank, (referrer_id, name, referrals, rewarded) in enumerate(rows, 1)]
+    await bot.send_message(chat_id=user_message.chat.id, text="🏆 Top referrers\n\n" + ("\n".join(lines) or "-"))
+
+
+# Database pool and cache metrics for admins
+@bot.message_handler(commands=['stats'], func=lambda message: Menus.is_admin(message.chat.id))
+async def stats_command(user_message):
+    text = "📊 Database pool\n\n" + "\n".join(f"{name}: {value}" for name, value in Db.pool_stats().items())
+    text += "\n\n👤 User cache\n\n" + "\n".join(f"{name}: {value}" for name, value in Db.user_cache.stats().items())
+    text += "\n\n📨 Pending requests\n\n" + "\n".join(f"{name}: {value}" for name, value in Pending.requests.stats().items())
+    try:
+        text += "\n\n🎫 Open tickets\n\n" + "\n".join(f"{agent_id} {status}: {count}" for agent_id, status, count in await Db.ticket_stats())
+    except mysql.connector.Error as err:
+        logging.error("Error while counting tickets: %s", err)
+    try:
+        text += "\n\n📦 Unused configs\n\n" + "\n".join(f"{product}: {count}" for product, count in await Db.config_stock())
+    except mysql.connector.Error as err:
+        logging.error("Error while counting configs: %s", err)
+    text += "\n\n📤 Outbox\n\n" + "\n".join(f"{name}: {value}" for name, value in Outbox.outbox.stats().items())
+    await bot.send_message(chat_id=user_message.chat.id, text=text)
 
 
 # Message response
 @bot.message_handler()
-def message_response(user_message):
-    response = Res.sample_responses(user_message)
-    bot.send_message(user_message.chat.id, response)
+async def message_response(user_message):
+    response = await Res.respond(user_message.text)
+    await bot.send_message(user_message.chat.id, response)
 
 
-# Starting the bot and adding the state filter as a custom filter
-if __name__ == '__main__':
-    bot.add_custom_filter(custom_filters.StateFilter(bot))
-
+# Long polling with exponential backoff on network errors
+async def run_polling():
     logging.info('start pulling...')
     retry_delay = 5  # Initial delay in seconds
 
     while True:
         try:
-            bot.polling()
-        except requests.exceptions.ProxyError as e:
-            logging.error(f"Proxy error: {e}")
-            logging.info(f'Retrying in {retry_delay} seconds...')
-            time.sleep(retry_delay)
+            await bot.polling(non_stop=True)
+        except aiohttp.ClientProxyConnectionError as e:
+            logging.error("Proxy error: %s", e)
+            logging.info('Retrying in %s seconds...', retry_delay)
+            await asyncio.sleep(retry_delay)
             retry_delay = min(retry_delay * 2, 300)  # Exponential backoff with a maximum delay of 5 minutes
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Request exception: {e}")
-            logging.info(f'Retrying in {retry_delay} seconds...')
-            time.sleep(retry_delay)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error("Request exception: %s", e)
+            logging.info('Retrying in %s seconds...', retry_delay)
+            await asyncio.sleep(retry_delay)
             retry_delay = min(retry_delay * 2, 300)  # Exponential backoff with a maximum delay of 5 minutes
         else:
             retry_delay = 5  # Reset delay after a successful polling
-    logging.info('end pulling...')
\ No newline at end of file
+    logging.info('end pulling...')
+
+
+# Write everything still queued in memory
+async def flush_queues():
+    await Db.registrations.flush()
+    if isinstance(state_storage, States.PersistentStateStorage):
+        await state_storage.flush()
+
+
+# Payment callbacks are served by one process, the bot itself or the supervisor (which passes the cache invalidation
+# of the paying user on to its worker)
+async def start_payments():
+    return await Payments.start(payment_completed) if Payments.enabled() else None
+
+
+async def stop_payments(runner):
+    if runner is not None:
+        await runner.cleanup()
+
+
+# Run the bot in the configured mode, queued writes are flushed on the way out
+async def run():
+    metrics = await Metrics.serve(Keys.METRICS_PORT)
+    payments = await start_payments()
+    try:
+        if Keys.RUN_MODE == 'webhook':
+            logging.info('start webhook...')
+            await Webhook.serve(bot)
+            logging.info('end webhook...')
+
+        else:
+            await run_polling()
+
+    finally:
+        await stop_payments(payments)
+        await Metrics.stop(*metrics)
+        await flush_queues()
+
+
+async def supervise():
+    payments = await start_payments()
+    try:
+        await Supervisor.serve(bot, run_worker)
+    finally:
+        await stop_payments(payments)
+
+
+# Entry point of a worker process started by the supervisor
+async def work(index, updates, acks, notices, send_slots):
+    metrics = await Metrics.serve(Keys.METRICS_PORT + 1 + index if Keys.METRICS_PORT else 0)
+    try:
+        await Supervisor.work(bot, index, updates, acks, notices, send_slots)
+    finally:
+        await Metrics.stop(*metrics)
+        await flush_queues()
+        await bot.close_session()
+
+
+def run_worker(index, updates, acks, logs, notices, send_slots):
+    Log.forward(logs)
+    if Keys.PENDING_DB_PATH:
+        Pending.requests.open(Pending.shard_path(Keys.PENDING_DB_PATH, index))
+    bot.add_custom_filter(asyncio_filters.StateFilter(bot))
+    Metrics.track(bot)
+    Log.trace(bot)
+    asyncio.run(work(index, updates, acks, notices, send_slots))
+
+
+# Starting the bot and adding the state filter as a custom filter
+if __name__ == '__main__':
+    if Keys.WORKERS > 1:
+        asyncio.run(supervise())
+    else:
+        if Keys.PENDING_DB_PATH:
+            Pending.requests.open(Keys.PENDING_DB_PATH)
+        bot.add_custom_filter(asyncio_filters.StateFilter(bot))
+        Metrics.track(bot)
+        Log.trace(bot)
+        asyncio.run(run())
@@ -0,0 +1,102 @@
+-- Mochi Server database schema (MySQL 8)
+-- on an existing database run only the statements that are missing
+
+CREATE TABLE IF NOT EXISTS users (
+    id BIGINT PRIMARY KEY,
+    username VARCHAR(64),
+    first_name VARCHAR(128),
+    last_name VARCHAR(128),
+    balance BIGINT NOT NULL DEFAULT 0,
+    test_config_used BOOLEAN NOT NULL DEFAULT FALSE
+);
+
+-- Prefix search in the admin panel (/find)
+CREATE INDEX users_username ON users (username);
+CREATE INDEX users_first_name ON users (first_name);
+CREATE INDEX users_last_name ON users (last_name);
+
+-- Purchases paid from the wallet
+CREATE TABLE IF NOT EXISTS orders (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    product VARCHAR(32) NOT NULL,
+    price BIGINT NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'paid',
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    INDEX orders_user (user_id, created_at)
+);
+
+-- Every balance movement and purchase, rows are only inserted. amount is the change of the balance (0 for purchases
+-- paid online) and balance the balance it left, so the history of a user adds up to users.balance
+CREATE TABLE IF NOT EXISTS ledger (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    kind VARCHAR(16) NOT NULL,
+    amount BIGINT NOT NULL,
+    balance BIGINT NOT NULL,
+    order_id BIGINT,
+    note VARCHAR(64),
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    INDEX ledger_user (user_id, created_at)
+);
+
+-- Once, when adding the ledger to an existing database: the balances so far become opening entries
+-- INSERT INTO ledger (user_id, kind, amount, balance) SELECT id, 'opening', balance, balance FROM users WHERE balance != 0;
+
+-- Config inventory, a config is unused while user_id is NULL and is claimed in the purchase transaction
+CREATE TABLE IF NOT EXISTS configs (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    product VARCHAR(32) NOT NULL,
+    config TEXT NOT NULL,
+    user_id BIGINT,
+    order_id BIGINT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    claimed_at TIMESTAMP NULL,
+    INDEX configs_free (product, user_id, id)
+);
+
+-- Online payments, the authority given by the gateway is unique so a payment is completed only once
+CREATE TABLE IF NOT EXISTS payments (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    amount BIGINT NOT NULL,
+    product VARCHAR(32),
+    authority VARCHAR(64) NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    ref_id VARCHAR(64),
+    order_id BIGINT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    paid_at TIMESTAMP NULL,
+    UNIQUE INDEX payments_authority (authority),
+    INDEX payments_user (user_id, created_at)
+);
+
+-- Who brought each user, a user is referred at most once
+CREATE TABLE IF NOT EXISTS referrals (
+    user_id BIGINT PRIMARY KEY,
+    referrer_id BIGINT NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    INDEX referrals_referrer (referrer_id, created_at)
+);
+
+-- Counters per referrer, updated with every referral so the leaderboard never counts rows
+CREATE TABLE IF NOT EXISTS referral_stats (
+    referrer_id BIGINT PRIMARY KEY,
+    referrals INT NOT NULL DEFAULT 0,
+    rewarded BIGINT NOT NULL DEFAULT 0,
+    INDEX referral_stats_rank (referrals, referrer_id)
+);
+
+-- Support requests, the id travels in the callback data of the agent's answer button
+CREATE TABLE IF NOT EXISTS tickets (
+    id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    agent_id BIGINT NOT NULL,
+    kind VARCHAR(16) NOT NULL,
+    order_id BIGINT,
+    status VARCHAR(16) NOT NULL DEFAULT 'open',
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    closed_at TIMESTAMP NULL,
+    INDEX tickets_status (status, agent_id),
+    INDEX tickets_user (user_id, created_at)
+);